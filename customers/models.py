@@ -1,8 +1,13 @@
+from django.conf import settings
 from django.db import models
+from django.db.models.signals import post_delete, post_save
+from django.utils import timezone
 
 from customers import choices as customer_choices
 from readings import choices as readings_choices
 
+from utils.cache import LRUCache
+
 
 class CustomerPlan(models.Model):
     """Customer plan"""
@@ -69,7 +74,7 @@ class CustomerCallLog(models.Model):
     """Log data for each customer API call"""
     call_type = models.CharField(max_length=255, choices=customer_choices.CALL_TYPES, default=customer_choices.CALL_READINGS)
     customer = models.ForeignKey(Customer)
-    timestamp = models.DateTimeField(auto_now_add=True)
+    timestamp = models.DateTimeField(default=timezone.now, editable=False)
     min_latitude = models.FloatField()
     max_latitude = models.FloatField()
     min_longitude = models.FloatField()
@@ -93,3 +98,34 @@ class CustomerCallLog(models.Model):
 
     def __unicode__(self):
         return '%s: %s' % (self.customer, self.timestamp)
+
+
+# Customers resolved by API key, cached in each process for at most
+# CUSTOMER_CACHE_TIMEOUT seconds and cleared on any customer change
+customer_cache = LRUCache(settings.CUSTOMER_CACHE_SIZE, settings.CUSTOMER_CACHE_TIMEOUT)
+
+
+def get_customer(api_key):
+    """Returns the customer with the given API key and its type, or None"""
+    if not api_key:
+        return None
+
+    customer = customer_cache.get(api_key)
+    if customer is None:
+        customers = list(Customer.objects.select_related('customer_type').filter(
+            api_key=api_key).order_by('-api_key_enabled')[:1])
+        if not customers:
+            return None
+
+        customer = customers[0]
+        customer_cache.set(api_key, customer)
+
+    return customer
+
+
+def clear_customer_cache(sender, **kwargs):
+    customer_cache.clear()
+
+for model in (Customer, CustomerType):
+    post_save.connect(clear_customer_cache, sender=model)
+    post_delete.connect(clear_customer_cache, sender=model)
@@ -1,5 +1,3 @@
-from django.conf import settings
-
 import django_filters
 
 from readings.models import Reading, Condition
@@ -12,11 +10,6 @@ class DateLocationFilterSet(django_filters.FilterSet):
     max_longitude = django_filters.NumberFilter(name='longitude', lookup_type='lte')
     start_time = django_filters.NumberFilter(name='daterecorded', lookup_type='gte')
     end_time = django_filters.NumberFilter(name='daterecorded', lookup_type='lte')
-    limit = django_filters.NumberFilter(action=lambda queryset, limit: queryset[:limit])
-
-    @property
-    def qs(self):
-        return super(DateLocationFilterSet, self).qs[:settings.MAX_CALL_LENGTH]
 
 
 class ReadingListFilter(DateLocationFilterSet):
@@ -30,7 +23,6 @@ class ReadingListFilter(DateLocationFilterSet):
             'max_longitude',
             'start_time',
             'end_time',
-            'limit',
         )
 
 
@@ -45,5 +37,4 @@ class ConditionListFilter(DateLocationFilterSet):
             'max_longitude',
             'start_time',
             'end_time',
-            'limit',
         )
@@ -38,11 +38,14 @@ class ReadingForm(Logger, forms.ModelForm):
             'package_name',
         )
 
+    def get_block_data(self):
+        reading_data = copy.copy(self.cleaned_data)
+        del reading_data['client_key']
+        return reading_data
+
     def save(self, *args, **kwargs):
         try:
-            reading_data = copy.copy(self.cleaned_data)
-            del reading_data['client_key']
-            BlockSorter().apply(args=[reading_data])
+            BlockSorter().apply(args=[self.get_block_data()])
         except Exception, e:
             self.log(error=str(e))
         return super(ReadingForm, self).save(*args, **kwargs)
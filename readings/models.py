@@ -39,6 +39,7 @@ class Reading(DateLocationMeasurementModel):
     class Meta:
         verbose_name = 'reading'
         verbose_name_plural = 'readings'
+        index_together = [['daterecorded', 'id']]
 
     def __unicode__(self):
         return '%s: %s' % (self.user_id, self.reading)
@@ -62,6 +63,7 @@ class Condition(DateLocationMeasurementModel):
     class Meta:
         verbose_name = 'condition'
         verbose_name_plural = 'conditions'
+        index_together = [['daterecorded', 'id']]
 
     def __unicode__(self):
         return '%s: %s' % (self.user_id, self.general_condition)
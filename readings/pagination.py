@@ -0,0 +1,86 @@
+import base64
+
+from django.conf import settings
+from django.db.models import Q
+
+from rest_framework.exceptions import ParseError
+
+
+def encode_cursor(daterecorded, pk):
+    return base64.urlsafe_b64encode('%d:%d' % (daterecorded, pk))
+
+
+def decode_cursor(cursor):
+    try:
+        daterecorded, pk = base64.urlsafe_b64decode(str(cursor)).split(':')
+        return long(daterecorded), long(pk)
+    except (TypeError, ValueError):
+        raise ParseError('Invalid cursor')
+
+
+def filter_after(queryset, daterecorded, pk):
+    """
+    Filter measurements to the ones after (daterecorded, pk) in
+    (daterecorded, id) order.
+    """
+    # The range on daterecorded keeps the (daterecorded, id) index usable
+    return queryset.filter(daterecorded__gte=daterecorded).filter(
+        Q(daterecorded__gt=daterecorded) | Q(id__gt=pk))
+
+
+class KeysetPaginationMixin(object):
+    """
+    Page through measurements in (daterecorded, id) order.  A page holds
+    at most `limit` measurements, the `cursor` parameter resumes after the
+    last measurement of the previous page and a full page is sent with the
+    cursor of the next one in the X-Next-Cursor and Link headers.
+    """
+
+    @property
+    def default_limit(self):
+        return settings.MAX_CALL_LENGTH
+
+    @property
+    def max_limit(self):
+        return settings.MAX_CALL_LENGTH
+
+    def get_limit(self):
+        try:
+            limit = int(self.request.QUERY_PARAMS.get('limit', self.default_limit))
+        except ValueError:
+            raise ParseError('Invalid limit')
+
+        if limit < 0:
+            raise ParseError('Invalid limit')
+
+        return min(limit, self.max_limit) if self.max_limit else limit
+
+    def filter_queryset(self, queryset):
+        queryset = super(KeysetPaginationMixin, self).filter_queryset(queryset)
+
+        cursor = self.request.QUERY_PARAMS.get('cursor')
+        if cursor:
+            queryset = filter_after(queryset, *decode_cursor(cursor))
+
+        self.limit = self.get_limit()
+        return queryset.order_by('daterecorded', 'id')[:self.limit]
+
+    def get_next_cursor(self):
+        objects = list(self.object_list)
+        if not objects or len(objects) < self.limit:
+            return None
+
+        return encode_cursor(objects[-1].daterecorded, objects[-1].pk)
+
+    def list(self, request, *args, **kwargs):
+        response = super(KeysetPaginationMixin, self).list(request, *args, **kwargs)
+
+        next_cursor = self.get_next_cursor()
+        if next_cursor:
+            parameters = request.GET.copy()
+            parameters['cursor'] = next_cursor
+            response['X-Next-Cursor'] = next_cursor
+            response['Link'] = '<%s>; rel="next"' % request.build_absolute_uri(
+                '%s?%s' % (request.path, parameters.urlencode()))
+
+        return response
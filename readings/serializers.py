@@ -1,7 +1,6 @@
 from rest_framework import serializers
 
 from customers import choices as customers_choices
-from customers.models import Customer
 from readings.models import Reading, Condition
 
 
@@ -47,8 +46,7 @@ class ReadingLiveSerializer(serializers.ModelSerializer):
     def get_fields(self):
         fields = super(ReadingLiveSerializer, self).get_fields()
 
-        api_key = self.context['view'].request.GET.get('api_key', '')
-        customer = Customer.objects.get(api_key=api_key)  # TODO: Handle DoesNotExist case
+        customer = self.context['view'].customer
 
         if customer.customer_type == customers_choices.CUSTOMER_PUBLIC:
             del fields['user_id']
@@ -1,9 +1,20 @@
+# -*- coding: utf-8 -*-
+import StringIO
 import copy
+import csv
 import datetime
+import itertools
+import os
+import pickle
 import random
+import shutil
+import tempfile
+import time
 import uuid
 
 from django.conf import settings
+from django.core.cache import cache
+from django.core.management import call_command
 from django.core.urlresolvers import reverse
 from django.test import TestCase
 from django.test.utils import override_settings
@@ -11,10 +22,28 @@ from django.utils import simplejson as json
 
 import factory
 import mock
+from boto.exception import S3ResponseError
 
+from customers.models import Customer, CustomerCallLog, CustomerType, customer_cache, get_customer
 from readings import choices as readings_choices
 from readings.models import Reading, Condition, ConditionFilter
 
+from tasks.aggregator import (
+    READING_KEY_FIELDS, S3_WRITERS, BlockContext, BlockHandler, BlockProcessor,
+    CallLogWriter, CSVS3Writer, DataHandler, DynamoDBHandler, JSONS3Writer,
+    PartialWriteError, PrivateS3Handler, PrivateS3UserHandler, RollupHandler,
+    S3Writer, StatisticsRollup, clean_call_log, decode_block_reading, decode_summary,
+    encode_block_reading, encode_summary, get_file_path, get_manifest_path,
+    get_output_fields, get_segment_path, load_writer_data, release_writer_data,
+    store_writer_data, write_outputs)
+
+from utils import dynamodb
+from utils import geohash
+from utils.blocks import BlockData
+from utils import s3
+from utils import statistics
+from utils.cache import DiskCache
+from utils.records import RECORD_FIELDS, decode_reading, encode_reading, is_record
 from utils.time_utils import to_unix
 
 
@@ -298,6 +327,28 @@ class DateLocationFilteredListTests(object):
 
         self.assertEquals(len(data), 27)
 
+    def test_list_view_pages_with_cursor(self):
+        # Two measurements share a daterecorded and are ordered by id
+        for latitude, daterecorded in enumerate([300, 100, 200, 200, 400]):
+            self.factory(latitude=latitude, daterecorded=daterecorded).save()
+
+        parameters = {'start_time': 0, 'limit': 2}
+        pages = []
+        while True:
+            response = self.client.get(reverse(self.url_name), parameters)
+            pages.append([measurement['latitude'] for measurement in json.loads(response.content)])
+
+            if not response.has_header('X-Next-Cursor'):
+                break
+            parameters['cursor'] = response['X-Next-Cursor']
+
+        self.assertEquals(pages, [[1, 2], [3, 0], [4]])
+
+    def test_list_view_rejects_invalid_cursor(self):
+        response = self.client.get(reverse(self.url_name), {'cursor': 'invalid'})
+
+        self.assertEquals(response.status_code, 400)
+
 
 class ReadingsListTests(DateLocationFilteredListTests, TestCase):
     url_name = 'readings-list'
@@ -330,7 +381,243 @@ class ConditionsListTests(DateLocationFilteredListTests, TestCase):
 
 
 class ReadingLiveTests(TestCase):
-    pass
+
+    def setUp(self):
+        cache.clear()
+        customer_cache.clear()
+        self.customer_type = CustomerType.objects.create(
+            name='Researcher', description='', sharing=readings_choices.SHARING_RESEARCHERS)
+        self.customer = Customer.objects.create(
+            customer_type=self.customer_type,
+            contact_name='Researcher',
+            contact_mail='researcher@example.com',
+            api_key='abc',
+        )
+
+    @mock.patch('readings.views.advance_customer_cursor')
+    @mock.patch('readings.views.buffer_call_log')
+    def test_live_view_resolves_customer_once(self, mock_buffer, mock_advance):
+        ReadingFactory().save()
+
+        # The customer and the readings, the call log is buffered
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse('readings-live'), {'api_key': 'abc'})
+
+        self.assertEqual(response.status_code, 200)
+        call_log = mock_buffer.call_args[0][0]
+        self.assertEqual(call_log['customer_id'], self.customer.id)
+        self.assertEqual(call_log['results_returned'], 1)
+
+    def get_since_last_call(self, **parameters):
+        parameters.update(api_key='abc', since_last_call='')
+        response = self.client.get(reverse('readings-live'), parameters)
+        return [reading['reading'] for reading in response.data]
+
+    @mock.patch('readings.views.get_customer_cursor')
+    @mock.patch('readings.views.advance_customer_cursor')
+    @mock.patch('readings.views.buffer_call_log')
+    def test_since_last_call_resumes_from_cursor(self, mock_buffer, mock_advance, mock_cursor):
+        delivered = ReadingFactory(daterecorded=1000, reading=1.0)
+        delivered.save()
+        ReadingFactory(daterecorded=1000, reading=2.0).save()
+        new = ReadingFactory(daterecorded=2000, reading=3.0)
+        new.save()
+
+        mock_cursor.return_value = (1000, delivered.pk)
+        self.assertEqual(self.get_since_last_call(**{'global': 'true'}), [2.0, 3.0])
+        mock_cursor.assert_called_with(self.customer.id)
+        mock_advance.assert_called_with(self.customer.id, 2000, new.pk)
+
+    @mock.patch('readings.views.get_customer_cursor')
+    @mock.patch('readings.views.advance_customer_cursor')
+    @mock.patch('readings.views.buffer_call_log')
+    def test_since_last_call_pages_through_equal_daterecorded(self, mock_buffer, mock_advance, mock_cursor):
+        for reading in range(4):
+            ReadingFactory(daterecorded=1000 + reading // 3, reading=float(reading)).save()
+        cursors = {}
+        mock_cursor.side_effect = cursors.get
+        mock_advance.side_effect = lambda customer_id, daterecorded, pk: cursors.__setitem__(
+            customer_id, (daterecorded, pk))
+        cursors[self.customer.id] = (0, 0)
+
+        pages = [self.get_since_last_call(**{'global': 'true', 'limit': 2}) for page in range(3)]
+
+        self.assertEqual(pages, [[0.0, 1.0], [2.0, 3.0], []])
+
+    @mock.patch('readings.views.get_customer_cursor')
+    @mock.patch('readings.views.advance_customer_cursor')
+    @mock.patch('readings.views.buffer_call_log')
+    def test_missing_cursor_is_seeded_from_latest_call(self, mock_buffer, mock_advance, mock_cursor):
+        mock_cursor.return_value = None
+        call_log = CustomerCallLog.objects.create(
+            customer=self.customer, min_latitude=0, max_latitude=0, min_longitude=0,
+            max_longitude=0, global_data=True, since_last_call=True, start_time=0,
+            end_time=0, results_limit=0, data_format='json', use_utc=False, path='',
+            query='', processing_time=0, results_returned=0)
+        called = to_unix(call_log.timestamp)
+        ReadingFactory(daterecorded=called - 1, reading=1.0).save()
+        since = ReadingFactory(daterecorded=called, reading=2.0)
+        since.save()
+
+        self.assertEqual(self.get_since_last_call(**{'global': 'true'}), [2.0])
+        self.assertEqual(mock_advance.call_args_list, [
+            mock.call(self.customer.id, called, 0),
+            mock.call(self.customer.id, called, since.pk),
+        ])
+
+    @mock.patch('readings.views.advance_customer_cursor')
+    @mock.patch('readings.views.buffer_call_log')
+    def test_live_view_streams_formats(self, mock_buffer, mock_advance):
+        ReadingFactory(daterecorded=1000).save()
+        latest = ReadingFactory(daterecorded=2000)
+        latest.save()
+        parameters = {'api_key': 'abc', 'global': 'true', 'stream': '', 'start_time': 0}
+
+        for data_format in ('json', 'ndjson', 'csv'):
+            parameters['format'] = data_format
+            response = self.client.get(reverse('readings-live'), parameters)
+            content = ''.join(response.streaming_content)
+
+            if data_format == 'json':
+                readings = json.loads(content)
+            elif data_format == 'ndjson':
+                readings = [json.loads(line) for line in content.splitlines()]
+            else:
+                readings = list(csv.DictReader(StringIO.StringIO(content)))
+
+            self.assertEqual(
+                sorted(int(reading['daterecorded']) for reading in readings), [1000, 2000])
+            self.assertEqual(mock_buffer.call_args[0][0]['results_returned'], 2)
+            mock_advance.assert_called_with(self.customer.id, 2000, latest.pk)
+
+    def test_live_view_rejects_unknown_stream_format(self):
+        response = self.client.get(reverse('readings-live'), {
+            'api_key': 'abc', 'stream': '', 'format': 'xml'})
+
+        self.assertEqual(response.status_code, 400)
+
+    @mock.patch('tasks.aggregator.REDIS')
+    def test_call_log_writer_bulk_creates_buffered_logs(self, mock_redis):
+        call_log = {
+            'customer_id': self.customer.id,
+            'min_latitude': -90,
+            'max_latitude': 90,
+            'min_longitude': -180,
+            'max_longitude': 180,
+            'global_data': True,
+            'since_last_call': False,
+            'start_time': 0,
+            'end_time': 1,
+            'results_limit': 10,
+            'data_format': 'json',
+            'use_utc': False,
+            'path': '/live/',
+            'query': '',
+            'processing_time': 0.1,
+            'results_returned': 5,
+        }
+        mock_redis.pipeline().execute.side_effect = [
+            [[pickle.dumps(call_log)] * 2, True],
+            [[], True],
+        ]
+        mock_redis.get.return_value = '3'
+
+        with self.settings(CALL_LOG_BATCH_SIZE=2):
+            result = CallLogWriter().handle()
+
+        self.assertEqual(CustomerCallLog.objects.filter(customer=self.customer).count(), 2)
+        self.assertEqual(result['written_logs'], 2)
+        self.assertEqual(result['dropped_logs'], 3)
+
+    @mock.patch('tasks.aggregator.REDIS')
+    def test_call_log_writer_quarantines_malformed_logs(self, mock_redis):
+        call_log = {
+            'customer_id': self.customer.id,
+            'min_latitude': -90,
+            'max_latitude': 90,
+            'min_longitude': -180,
+            'max_longitude': 180,
+            'global_data': True,
+            'since_last_call': False,
+            'start_time': 0,
+            'end_time': 1,
+            'results_limit': 10,
+            'data_format': 'json',
+            'use_utc': False,
+            'path': '/live/',
+            'query': '',
+            'processing_time': 0.1,
+            'results_returned': 5,
+        }
+        malformed = pickle.dumps(dict(call_log, min_latitude='abc'))
+        mock_redis.pipeline().execute.side_effect = [
+            [[pickle.dumps(call_log), malformed, pickle.dumps(call_log)], True],
+            [1, True, 1],
+        ]
+
+        with self.settings(CALL_LOG_BATCH_SIZE=4):
+            result = CallLogWriter().handle()
+
+        self.assertEqual(CustomerCallLog.objects.filter(customer=self.customer).count(), 2)
+        self.assertEqual(result['written_logs'], 2)
+        self.assertEqual(result['quarantined_logs'], 1)
+        mock_redis.pipeline().rpush.assert_called_once_with('call-log-quarantine', malformed)
+        mock_redis.pipeline().incrby.assert_called_once_with('call-log-quarantined', 1)
+        self.assertFalse(mock_redis.lpush.called)
+
+    @mock.patch('tasks.aggregator.REDIS')
+    @mock.patch.object(CallLogWriter, 'is_database_available')
+    def test_call_log_writer_requeues_logs_without_database(self, mock_available, mock_redis):
+        call_logs = [pickle.dumps({'customer_id': self.customer.id, 'min_latitude': 'abc'})]
+        mock_redis.pipeline().execute.side_effect = [[call_logs, True]]
+        mock_available.return_value = False
+
+        self.assertRaises(Exception, CallLogWriter().handle)
+
+        mock_redis.lpush.assert_called_once_with('call-log-buffer', *call_logs)
+
+    @mock.patch('readings.views.advance_customer_cursor')
+    @mock.patch('readings.views.buffer_call_log')
+    def test_call_log_parameters_are_cleaned(self, mock_buffer, mock_advance):
+        response = self.client.get(reverse('readings-live'), {
+            'api_key': 'abc',
+            'global': 'true',
+            'min_lat': 'abc',
+            'max_lat': 'nan',
+            'limit': '99999999999',
+        })
+
+        self.assertEqual(response.status_code, 200)
+        call_log = mock_buffer.call_args[0][0]
+        self.assertEqual(call_log['min_latitude'], 0.0)
+        self.assertEqual(call_log['max_latitude'], 0.0)
+        self.assertEqual(call_log['results_limit'], 2 ** 31 - 1)
+        self.assertEqual(call_log['max_longitude'], 180.0)
+
+        call_log = clean_call_log(dict(call_log, start_time='1e30', end_time='-inf', data_format='x' * 20))
+        self.assertEqual(call_log['start_time'], 2 ** 63 - 1)
+        self.assertEqual(call_log['end_time'], 0)
+        self.assertEqual(call_log['data_format'], 'x' * 10)
+
+    def test_live_view_rejects_disabled_api_key(self):
+        self.customer.api_key_enabled = False
+        self.customer.save()
+
+        response = self.client.get(reverse('readings-live'), {'api_key': 'abc'})
+
+        self.assertEqual(response.status_code, 405)
+
+    def test_customer_cache_is_cleared_on_save(self):
+        self.assertEqual(get_customer('abc'), self.customer)
+
+        with self.assertNumQueries(0):
+            get_customer('abc')
+
+        self.customer.api_key = 'def'
+        self.customer.save()
+
+        self.assertEqual(get_customer('abc'), None)
+        self.assertEqual(get_customer('def'), self.customer)
 
 
 class CreateReadingTests(TestCase):
@@ -363,6 +650,113 @@ class CreateReadingTests(TestCase):
             self.assertEqual(Reading.objects.count(), 1)
 
 
+class CreateReadingBatchTests(TestCase):
+
+    def post_batch(self, readings_data):
+        return self.client.post(
+            reverse('readings-create-reading-batch'),
+            json.dumps(readings_data),
+            content_type='application/json',
+        )
+
+    @mock.patch('readings.views.BatchBlockSorter')
+    def test_create_reading_batch_inserts_valid_readings(self, mock_sorter):
+        valid_data = [RawReadingFactory.attributes() for i in range(2)]
+        invalid_data = RawReadingFactory.attributes()
+        del invalid_data['reading']
+
+        response = self.post_batch(valid_data + [invalid_data])
+
+        response_json = json.loads(response.content)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [item['success'] for item in response_json], [True, True, False])
+        self.assertEqual(
+            [item['client_key'] for item in response_json],
+            [datum['client_key'] for datum in valid_data + [invalid_data]],
+        )
+        self.assertEqual(Reading.objects.count(), 2)
+
+        sorted_readings = mock_sorter().apply.call_args[1]['args'][0]
+        self.assertEqual(len(sorted_readings), 2)
+        for sorted_reading in sorted_readings:
+            self.assertNotIn('client_key', sorted_reading)
+
+    @mock.patch('readings.views.BatchBlockSorter')
+    def test_create_reading_batch_rejects_non_array(self, mock_sorter):
+        response = self.post_batch(RawReadingFactory.attributes())
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Reading.objects.count(), 0)
+        self.assertFalse(mock_sorter().apply.called)
+
+    @override_settings(MAX_BATCH_LENGTH=1)
+    @mock.patch('readings.views.BatchBlockSorter')
+    def test_create_reading_batch_rejects_oversized_batch(self, mock_sorter):
+        response = self.post_batch(
+            [RawReadingFactory.attributes() for i in range(2)])
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Reading.objects.count(), 0)
+
+
+class ReadingStatisticsTests(TestCase):
+
+    def get_stats(self, **parameters):
+        params = {
+            'min_lat': 43.6,
+            'max_lat': 43.7,
+            'min_lon': -79.5,
+            'max_lon': -79.4,
+            'start_time': 0,
+            'end_time': 2 * 60 * 60 * 1000 - 1,
+            'duration': 'hourly',
+        }
+        params.update(parameters)
+        return self.client.post(reverse('readings-stats'), params)
+
+    @mock.patch('readings.views.get_conn')
+    @mock.patch('readings.views.get_table')
+    @mock.patch('readings.views.get_cached_items')
+    def test_stats_fetches_cover_in_one_batch(self, mock_get_items, mock_get_table, mock_get_conn):
+        table = mock_get_table()
+        table.schema.hash_key_name = 'geohash'
+        table.schema.range_key_name = 'block'
+        mock_get_items.return_value = [{
+            'geohash': 'hourly-dpz83',
+            'block': 3600000,
+            'min': 1000.0,
+            'max': 1010.0,
+            'mean': 1005.0,
+            'median': 1005.0,
+            'std_dev': 1.0,
+            'samples': 10,
+            'users': 3,
+        }]
+
+        response = self.get_stats()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(mock_get_items.call_count, 1)
+        keys = mock_get_items.call_args[0][2]
+        is_cacheable = mock_get_items.call_args[0][3]
+        self.assertTrue(all(is_cacheable(key) for key in keys))
+        self.assertEqual(set(block for geo_key, block in keys), set([0, 3600000]))
+        self.assertTrue(all(geo_key.startswith('hourly-') for geo_key, block in keys))
+        self.assertTrue(len(keys) <= settings.MAX_STATISTICS_KEYS)
+
+        response_json = json.loads(response.content)
+        self.assertEqual(response_json['fields'][0], 'block')
+        self.assertEqual(response_json['cells']['dpz83'][0][0], 3600000)
+
+    @mock.patch('readings.views.get_cached_items')
+    def test_stats_rejects_unknown_duration(self, mock_get_items):
+        response = self.get_stats(duration='weekly')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(mock_get_items.called)
+
+
 class CreateConditionTests(TestCase):
 
     def test_create_reading_inserts_into_db(self):
@@ -371,3 +765,1264 @@ class CreateConditionTests(TestCase):
 
         self.assertEqual(response.status_code, 200)
         self.assertEqual(Condition.objects.count(), 1)
+
+
+def make_reading(**kwargs):
+    reading = {
+        'latitude': 43.65,
+        'longitude': -79.38,
+        'altitude': 120.5,
+        'reading': 1013.25,
+        'reading_accuracy': 1.0,
+        'location_accuracy': 25.0,
+        'daterecorded': 1400000000000,
+        'tzoffset': -14400000,
+        'sharing': readings_choices.SHARING_RESEARCHERS_FORECASTERS,
+        'user_id': u'abc123',
+        'provider': u'gps',
+        'observation_type': u'pressure',
+        'observation_unit': u'mbar',
+        'is_charging': u'Yes',
+        'model_type': u'Nexus 5',
+        'version_number': u'4.2.1',
+        'package_name': u'ca.cumulonimbus.barometernetwork',
+    }
+    reading.update(kwargs)
+    return reading
+
+
+class FakeRedis(object):
+    """
+    The strings and sorted sets of a Redis server held in a dict, with
+    the block claim script, for tests that follow keys through Redis.
+    """
+
+    def __init__(self):
+        self.data = {}
+        self.expires = {}
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def exists(self, key):
+        return key in self.data
+
+    def type(self, key):
+        return 'zset' if isinstance(self.data.get(key), dict) else 'string'
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def setex(self, key, expire, value):
+        self.data[key] = str(value)
+        self.expires[key] = expire
+        return True
+
+    def decr(self, key):
+        value = int(self.data.get(key, 0)) - 1
+        self.data[key] = str(value)
+        return value
+
+    def delete(self, *keys):
+        deleted = [key for key in keys if self.data.pop(key, None) is not None]
+        return len(deleted)
+
+    def rename(self, key, new_key):
+        self.data[new_key] = self.data.pop(key)
+        return True
+
+    def expire(self, key, expire):
+        self.expires[key] = expire
+        return key in self.data
+
+    def zadd(self, key, *args):
+        members = self.data.setdefault(key, {})
+        for score, member in zip(args[::2], args[1::2]):
+            members[member] = float(score)
+        return len(args) / 2
+
+    def zrem(self, key, *members):
+        zset = self.data.get(key, {})
+        removed = [member for member in members if zset.pop(member, None) is not None]
+        if not zset:
+            self.data.pop(key, None)
+        return len(removed)
+
+    def zrange(self, key, start, end):
+        return self.zrangebyscore(key, '-inf', '+inf')[start:None if end == -1 else end + 1]
+
+    def zrangebyscore(self, key, low, high):
+        return [
+            member for score, member in sorted(
+                (score, member) for member, score in self.data.get(key, {}).items())
+            if float(low) <= score <= float(high)
+        ]
+
+    def claim_block(self, keys, args):
+        registry_key, block_key, new_block_key = keys
+        if not self.zrem(registry_key, block_key):
+            return 0
+        if not self.exists(block_key):
+            return 0
+        self.rename(block_key, new_block_key)
+        self.expire(new_block_key, args[0])
+        return 1
+
+
+class FakePipeline(object):
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def __getattr__(self, name):
+        def command(*args, **kwargs):
+            self.commands.append((getattr(self.redis, name), args, kwargs))
+            return self
+        return command
+
+    def execute(self):
+        commands, self.commands = self.commands, []
+        return [command(*args, **kwargs) for command, args, kwargs in commands]
+
+
+class RecordTests(TestCase):
+
+    def test_record_round_trip(self):
+        reading = make_reading()
+        content = encode_reading(reading)
+
+        self.assertTrue(is_record(content))
+        self.assertEqual(decode_reading(content), reading)
+        self.assertEqual(sorted(decode_reading(content)), sorted(RECORD_FIELDS))
+
+    def test_record_round_trip_unicode_strings(self):
+        reading = make_reading(user_id=u'été-☃', model_type=u'日本')
+
+        decoded = decode_reading(encode_reading(reading))
+
+        self.assertEqual(decoded['user_id'], u'été-☃')
+        self.assertEqual(decoded['model_type'], u'日本')
+
+    def test_record_missing_strings_decode_empty(self):
+        reading = make_reading()
+        del reading['package_name']
+        reading['model_type'] = None
+
+        decoded = decode_reading(encode_reading(reading))
+
+        self.assertEqual(decoded['package_name'], u'')
+        self.assertEqual(decoded['model_type'], u'')
+
+    def test_decode_rejects_unknown_version(self):
+        with self.assertRaises(ValueError):
+            decode_reading(chr(2) + encode_reading(make_reading())[1:])
+
+
+class BlockReadingTests(TestCase):
+
+    def get_reading(self):
+        reading = RawReadingFactory.attributes()
+        del reading['client_key']
+        reading['daterecorded'] = long(reading['daterecorded'])
+        return reading
+
+    def test_block_readings_are_records(self):
+        reading = self.get_reading()
+        content = encode_block_reading(reading)
+
+        self.assertTrue(is_record(content))
+        self.assertEqual(decode_block_reading(content)['user_id'], reading['user_id'])
+        self.assertEqual(decode_block_reading(content)['reading'], reading['reading'])
+
+    def test_pickled_block_readings_are_decoded(self):
+        reading = self.get_reading()
+
+        for protocol in (0, pickle.HIGHEST_PROTOCOL):
+            self.assertEqual(decode_block_reading(pickle.dumps(reading, protocol)), reading)
+
+    @override_settings(BLOCK_RECORD_FORMAT='pickle')
+    def test_block_readings_can_be_pickled(self):
+        reading = self.get_reading()
+
+        self.assertEqual(decode_block_reading(encode_block_reading(reading)), reading)
+
+
+class BlockDataTests(TestCase):
+
+    def get_block(self, keys, user_id=u'old'):
+        return BlockData.from_readings([
+            make_reading(daterecorded=daterecorded, latitude=latitude, longitude=-79.0,
+                         reading=1000.0 + index, user_id=user_id)
+            for index, (daterecorded, latitude) in enumerate(keys)
+        ])
+
+    def get_keys(self, block):
+        return [(reading['daterecorded'], reading['latitude'], reading['longitude'])
+                for reading in block.to_dicts()]
+
+    def test_sort_orders_readings_by_key(self):
+        block = self.get_block([(3, 1.0), (1, 2.0), (1, 1.0), (2, 0.5)]).sort(READING_KEY_FIELDS)
+
+        self.assertEqual(self.get_keys(block), [
+            (1, 1.0, -79.0), (1, 2.0, -79.0), (2, 0.5, -79.0), (3, 1.0, -79.0)])
+
+    def test_sort_keeps_last_of_equal_keys(self):
+        unsorted = self.get_block([(2, 1.0), (1, 1.0), (2, 1.0), (1, 1.0)])
+        presorted = self.get_block([(1, 1.0), (1, 1.0), (2, 1.0), (2, 1.0)])
+
+        self.assertEqual(
+            [reading['reading'] for reading in unsorted.sort(READING_KEY_FIELDS).to_dicts()],
+            [1003.0, 1002.0])
+        self.assertEqual(
+            [reading['reading'] for reading in presorted.sort(READING_KEY_FIELDS).to_dicts()],
+            [1001.0, 1003.0])
+
+    def test_sort_empty_block(self):
+        self.assertEqual(len(BlockData().sort(READING_KEY_FIELDS)), 0)
+
+    def test_merge_replaces_existing_readings_with_equal_keys(self):
+        existing = self.get_block([(1, 1.0), (2, 1.0), (2, 3.0), (4, 1.0)])
+        new = self.get_block([(0, 1.0), (2, 1.0), (2, 2.0), (4, 1.0), (5, 1.0)], user_id=u'new')
+
+        merged = BlockData.merge(existing, new, READING_KEY_FIELDS)
+
+        self.assertEqual([(key[:2], reading['user_id']) for key, reading
+                          in zip(self.get_keys(merged), merged.to_dicts())], [
+            ((0, 1.0), u'new'),
+            ((1, 1.0), u'old'),
+            ((2, 1.0), u'new'),
+            ((2, 2.0), u'new'),
+            ((2, 3.0), u'old'),
+            ((4, 1.0), u'new'),
+            ((5, 1.0), u'new'),
+        ])
+
+    def test_merge_with_empty_sides(self):
+        block = self.get_block([(1, 1.0), (2, 1.0)])
+
+        self.assertEqual(self.get_keys(BlockData.merge(BlockData(), block, READING_KEY_FIELDS)),
+                         self.get_keys(block))
+        self.assertEqual(self.get_keys(BlockData.merge(block, BlockData(), READING_KEY_FIELDS)),
+                         self.get_keys(block))
+        self.assertEqual(len(BlockData.merge(BlockData(), BlockData(), READING_KEY_FIELDS)), 0)
+
+    def test_merge_matches_replacing_readings_by_key(self):
+        rng = random.Random(18)
+        for attempt in range(20):
+            existing_keys = [(rng.randint(0, 5), rng.randint(0, 3) / 2.0) for i in range(rng.randint(0, 12))]
+            new_keys = [(rng.randint(0, 5), rng.randint(0, 3) / 2.0) for i in range(rng.randint(0, 12))]
+            existing = self.get_block(existing_keys).sort(READING_KEY_FIELDS)
+            new = self.get_block(new_keys, user_id=u'new').sort(READING_KEY_FIELDS)
+
+            expected = dict((key, reading) for key, reading in zip(self.get_keys(existing), existing.to_dicts()))
+            expected.update(zip(self.get_keys(new), new.to_dicts()))
+
+            merged = BlockData.merge(existing, new, READING_KEY_FIELDS)
+
+            self.assertEqual(merged.to_dicts(), [expected[key] for key in sorted(expected)])
+
+    def test_merge_data_sorts_legacy_files(self):
+        existing = self.get_block([(3, 1.0), (1, 1.0), (2, 1.0), (1, 1.0)])
+        new = self.get_block([(2, 1.0), (0, 1.0)], user_id=u'new')
+
+        merged = PrivateS3Handler().merge_data(existing, new)
+
+        self.assertEqual([(key[0], reading['user_id']) for key, reading
+                          in zip(self.get_keys(merged), merged.to_dicts())], [
+            (0, u'new'), (1, u'old'), (2, u'new'), (3, u'old')])
+        self.assertEqual(merged.to_dicts()[1]['reading'], 1003.0)
+
+
+class WriterTests(TestCase):
+
+    def setUp(self):
+        self.readings = [
+            make_reading(daterecorded=1400000000000 + index, reading=1000.0 + index / 4.0)
+            for index in range(5)
+        ]
+        self.readings[1].update(user_id=u'us\xe9r, "quoted"', model_type=u'line\nbreak')
+        self.readings[3].update(version_number=None)
+        self.data = BlockData.from_readings(self.readings)
+        self.outputs = {}
+
+    def write(self, *writers, **kwargs):
+        outputs = self.outputs
+        failed_paths = kwargs.get('failed_paths', ())
+
+        class FakeBucketWriter(object):
+            def __init__(self, bucket, key, content_type='', compress=False, cache=False):
+                self.key = key
+                self.content = []
+
+            def write(self, content):
+                self.content.append(content)
+
+            def close(self):
+                if self.key in failed_paths:
+                    return None
+                outputs[self.key] = ''.join(self.content)
+                return self
+
+        with mock.patch('tasks.aggregator.get_bucket'):
+            with mock.patch('tasks.aggregator.BucketWriter', FakeBucketWriter):
+                write_outputs('bucket', [
+                    (writer(), 'output.%s' % writer.file_format) for writer in writers
+                ], self.data)
+
+        return [outputs['output.%s' % writer.file_format] for writer in writers]
+
+    def get_csv_rows(self, content):
+        return [
+            [value.decode('utf-8') for value in row]
+            for row in csv.reader(StringIO.StringIO(content))
+        ]
+
+    def get_expected_csv_rows(self, readings):
+        # The CSV files written before streaming, one row per reading dict
+        output = StringIO.StringIO()
+        writer = csv.writer(output)
+        writer.writerow(readings[0].keys())
+        for reading in readings:
+            writer.writerow([
+                value.encode('utf-8') if isinstance(value, unicode) else value
+                for value in reading.values()
+            ])
+
+        rows = self.get_csv_rows(output.getvalue())
+        return [dict(zip(rows[0], row)) for row in rows[1:]]
+
+    def test_json_output_parses_to_readings(self):
+        for batch_size in (1, 2, 1000):
+            with self.settings(OUTPUT_BATCH_SIZE=batch_size):
+                content, = self.write(JSONS3Writer)
+
+            self.assertEqual(json.loads(content), json.loads(json.dumps(self.readings)))
+
+    def test_ndjson_output_parses_to_readings(self):
+        with self.settings(OUTPUT_BATCH_SIZE=2):
+            content, = self.write(S3_WRITERS['ndjson'])
+
+        self.assertEqual([json.loads(line) for line in content.splitlines()],
+                         json.loads(json.dumps(self.readings)))
+
+    def test_csv_header_and_rows_across_batches(self):
+        for batch_size in (1, 2, 1000):
+            with self.settings(OUTPUT_BATCH_SIZE=batch_size):
+                content, = self.write(CSVS3Writer)
+
+            rows = self.get_csv_rows(content)
+            self.assertEqual(rows[0], get_output_fields(self.data))
+            self.assertEqual(len(rows), len(self.readings) + 1)
+            self.assertEqual([dict(zip(rows[0], row)) for row in rows[1:]],
+                             self.get_expected_csv_rows(self.readings))
+
+    @mock.patch('tasks.aggregator.REDIS', new_callable=FakeRedis)
+    def test_writer_data_is_deleted_after_its_last_reader(self, mock_redis):
+        data_key = store_writer_data(self.data, 3)
+        readers_key = '%s:readers' % data_key
+        self.assertEqual(mock_redis.expires[data_key], settings.WRITER_DATA_EXPIRE)
+        self.assertEqual(mock_redis.expires[readers_key], settings.WRITER_DATA_EXPIRE)
+
+        for reader in range(2):
+            self.assertEqual(load_writer_data(data_key).to_dicts(), self.data.to_dicts())
+            release_writer_data(data_key)
+            self.assertTrue(mock_redis.exists(data_key))
+
+        load_writer_data(data_key)
+        release_writer_data(data_key)
+
+        self.assertFalse(mock_redis.exists(data_key))
+        self.assertFalse(mock_redis.exists(readers_key))
+        self.assertRaises(KeyError, load_writer_data, data_key)
+
+    def test_failed_uploads_raise(self):
+        self.assertRaises(IOError, self.write, JSONS3Writer, CSVS3Writer, failed_paths=['output.csv'])
+        self.assertIn('output.json', self.outputs)
+
+    def test_outputs_match_prepared_content(self):
+        with self.settings(OUTPUT_BATCH_SIZE=2):
+            contents = self.write(JSONS3Writer, CSVS3Writer)
+
+            self.assertEqual(contents, [JSONS3Writer().prepare(self.data), CSVS3Writer().prepare(self.data)])
+
+
+class DiskCacheTests(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.disk_cache = DiskCache(self.directory, 1000)
+        patcher = mock.patch('utils.s3.disk_cache', self.disk_cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(shutil.rmtree, self.directory)
+
+        self.bucket = mock.Mock()
+        self.bucket.name = 'bucket'
+        self.key = self.bucket.new_key.return_value
+        self.key.content_encoding = ''
+
+    def test_entries_are_read_back_with_their_etag(self):
+        self.disk_cache.set('bucket', 'file.json', '"etag"', 'content')
+
+        self.assertEqual(self.disk_cache.get('bucket', 'file.json'), ('"etag"', 'content'))
+        self.assertEqual(self.disk_cache.get('bucket', 'other.json'), None)
+
+    def test_least_recently_used_entries_are_evicted(self):
+        for index in range(4):
+            self.disk_cache.set('bucket', 'file-%d' % index, '"etag"', 'x' * 200)
+            os.utime(self.disk_cache.get_path('bucket', 'file-%d' % index), (index, index))
+
+        self.disk_cache.set('bucket', 'file-4', '"etag"', 'x' * 200)
+
+        self.assertEqual(self.disk_cache.get('bucket', 'file-0'), None)
+        self.assertEqual(self.disk_cache.get('bucket', 'file-4')[1], 'x' * 200)
+        self.assertTrue(self.disk_cache.total_bytes <= 1000)
+
+    def test_commits_only_scan_the_directory_past_the_budget(self):
+        self.disk_cache.set('bucket', 'file-0', '"etag"', 'x' * 100)
+
+        with mock.patch('utils.cache.os.listdir', side_effect=os.listdir) as mock_listdir:
+            for index in range(1, 4):
+                self.disk_cache.set('bucket', 'file-%d' % index, '"etag"', 'x' * 100)
+            self.assertEqual(mock_listdir.call_count, 0)
+
+            self.disk_cache.set('bucket', 'file-4', '"etag"', 'x' * 500)
+            self.assertEqual(mock_listdir.call_count, 1)
+
+    def test_read_revalidates_cached_files(self):
+        self.disk_cache.set('bucket', 'file.json', '"etag"', 'cached')
+        self.key.get_contents_as_string.side_effect = S3ResponseError(304, 'Not Modified')
+
+        self.assertEqual(s3.read_from_bucket(self.bucket, 'file.json'), 'cached')
+        self.key.get_contents_as_string.assert_called_once_with(
+            headers={'If-None-Match': '"etag"'})
+
+    def test_read_caches_changed_files(self):
+        self.disk_cache.set('bucket', 'file.json', '"etag"', 'cached')
+        self.key.get_contents_as_string.return_value = 'changed'
+        self.key.etag = '"changed"'
+
+        self.assertEqual(s3.read_from_bucket(self.bucket, 'file.json'), 'changed')
+        self.assertEqual(self.disk_cache.get('bucket', 'file.json'), ('"changed"', 'changed'))
+
+    def test_read_of_deleted_file_invalidates_it(self):
+        self.disk_cache.set('bucket', 'file.json', '"etag"', 'cached')
+        self.key.get_contents_as_string.side_effect = S3ResponseError(404, 'Not Found')
+
+        self.assertEqual(s3.read_from_bucket(self.bucket, 'file.json'), None)
+        self.assertEqual(self.disk_cache.get('bucket', 'file.json'), None)
+
+    @mock.patch('utils.s3.Key')
+    def test_only_cached_outputs_are_kept(self, mock_key):
+        mock_key.return_value.etag = '"etag"'
+        mock_key.return_value.key = 'file.json'
+
+        for cache in (False, True):
+            writer = s3.BucketWriter(self.bucket, 'file.json', cache=cache)
+            writer.write('content')
+            writer.close()
+
+            self.assertEqual(self.disk_cache.get('bucket', 'file.json'),
+                             ('"etag"', 'content') if cache else None)
+
+    @mock.patch('tasks.aggregator.BucketWriter')
+    @mock.patch('tasks.aggregator.get_bucket')
+    def test_write_outputs_caches_combined_private_json_files(self, mock_bucket, mock_writer):
+        data = BlockData.from_readings([make_reading()])
+        paths = [
+            get_file_path('json', 'daily', 0, path_prefix='combined/%s' % readings_choices.SHARING_PRIVATE),
+            get_segment_path('json', 'daily', 0, 'late', path_prefix='combined/%s' % readings_choices.SHARING_PRIVATE),
+            get_file_path('csv', 'daily', 0, path_prefix='combined/%s' % readings_choices.SHARING_PRIVATE),
+            get_file_path('json', 'daily', 0, path_prefix='user/abc123'),
+        ]
+
+        write_outputs('bucket', [(JSONS3Writer(), path) for path in paths], data)
+
+        self.assertEqual([call[1]['cache'] for call in mock_writer.call_args_list],
+                         [True, True, False, False])
+
+
+class RegisterBlocksTests(TestCase):
+
+    @mock.patch('utils.management.commands.register_blocks.REDIS')
+    def test_existing_blocks_are_registered_by_block_end(self, mock_redis):
+        mock_redis.scan_iter.return_value = iter([
+            'block:10minute:1400000400000',
+            'block:daily:1382400000000',
+            'block:unknown:1400000400000',
+            'block:10minute:not-a-block',
+        ])
+
+        call_command('register_blocks', stdout=StringIO.StringIO())
+
+        pipe = mock_redis.pipeline()
+        self.assertItemsEqual(pipe.zadd.call_args_list, [
+            mock.call('block-registry', 1400000400000 + 10 * 60 * 1000, 'block:10minute:1400000400000'),
+            mock.call('block-registry', 1382400000000 + 24 * 60 * 60 * 1000, 'block:daily:1382400000000'),
+        ])
+        self.assertTrue(pipe.execute.called)
+
+
+class BlockHandlerTests(TestCase):
+
+    def setUp(self):
+        self.redis = FakeRedis()
+        for target, replacement in (
+                ('tasks.aggregator.REDIS', self.redis),
+                ('tasks.aggregator.claim_block', self.redis.claim_block)):
+            patcher = mock.patch(target, replacement)
+            self.addCleanup(patcher.stop)
+            patcher.start()
+
+        self.now = int(time.time() * 1000)
+        for block_key, end in (('block:10minute:1', self.now - 1000), ('block:10minute:2', self.now + 60000)):
+            self.redis.zadd('block-registry', end, block_key)
+            self.redis.zadd(block_key, 1, encode_block_reading(make_reading()))
+
+    @mock.patch.object(BlockHandler, 'processor')
+    def test_due_blocks_are_claimed_once(self, mock_processor):
+        mock_processor.get_handlers.return_value = [PrivateS3Handler]
+
+        self.assertEqual(BlockHandler().handle(), {'due_blocks': 1, 'handled_blocks': 1})
+
+        claimed_key, duration, block = mock_processor().delay.call_args[0]
+        self.assertEqual((duration, block), ('10minute', '1'))
+        self.assertEqual(len(self.redis.zrange(claimed_key, 0, -1)), 1)
+        self.assertEqual(self.redis.expires[claimed_key], BlockHandler.block_expire)
+        self.assertFalse(self.redis.exists('block:10minute:1'))
+        self.assertEqual(self.redis.zrange('block-registry', 0, -1), ['block:10minute:2'])
+
+        self.assertEqual(BlockHandler().handle(), {'due_blocks': 0, 'handled_blocks': 0})
+        self.assertFalse(BlockHandler().handle_block('block:10minute:1'))
+        self.assertEqual(mock_processor().delay.call_count, 1)
+
+    @mock.patch.object(BlockHandler, 'processor')
+    def test_blocks_not_yet_due_are_left_alone(self, mock_processor):
+        BlockHandler().handle()
+
+        self.assertEqual(self.redis.zrange('block-registry', 0, -1), ['block:10minute:2'])
+        self.assertEqual(len(self.redis.zrange('block:10minute:2', 0, -1)), 1)
+
+
+class S3HandlerTests(TestCase):
+    duration = '10minute'
+    block = 1400000400000
+    private_prefix = 'combined/%s' % readings_choices.SHARING_PRIVATE
+
+    def setUp(self):
+        self.files = {}
+        self.failures = {}
+
+        bucket = mock.Mock()
+        bucket.get_key.side_effect = lambda path: path if path in self.files else None
+        bucket.delete_keys.side_effect = lambda paths: [self.files.pop(path, None) for path in paths]
+
+        # Writer tasks run as they are queued unless defer_writers is set
+        self.defer_writers = False
+        self.queued_writers = []
+        s3_writer = mock.Mock()
+        s3_writer.return_value.delay.side_effect = self.queue_writer
+
+        self.redis = mock.MagicMock()
+
+        for target, replacement in (
+                ('tasks.aggregator.REDIS', self.redis),
+                ('tasks.aggregator.get_bucket', mock.Mock(return_value=bucket)),
+                ('tasks.aggregator.read_from_bucket', self.read_file),
+                ('tasks.aggregator.write_to_bucket', self.write_file),
+                ('tasks.aggregator.write_outputs', self.write_outputs),
+                ('tasks.aggregator.store_writer_data', lambda data, readers: data),
+                ('tasks.aggregator.load_writer_data', lambda data: data),
+                ('tasks.aggregator.release_writer_data', lambda data: None),
+                ('tasks.aggregator.S3Writer', s3_writer)):
+            patcher = mock.patch(target, replacement)
+            self.addCleanup(patcher.stop)
+            patcher.start()
+
+    def queue_writer(self, *args):
+        self.queued_writers.append(args)
+        if not self.defer_writers:
+            self.run_writers()
+
+    def run_writers(self):
+        while self.queued_writers:
+            S3Writer().handle(*self.queued_writers.pop(0))
+
+    def read_file(self, bucket, path):
+        return self.files.get(path)
+
+    def write_file(self, bucket, path, content, content_type='', cache=False):
+        self.files[path] = content
+
+    def write_outputs(self, bucket_name, outputs, data):
+        for path_prefix, failures in self.failures.items():
+            if failures and '/%s/' % path_prefix in outputs[0][1]:
+                self.failures[path_prefix] -= 1
+                raise IOError('Unable to upload %s' % outputs[0][1])
+
+        for writer, path in outputs:
+            self.files[path] = writer.prepare(data)
+
+    def get_reading(self, offset):
+        return make_reading(
+            daterecorded=self.block + offset,
+            user_id=u'user-%d' % offset,
+            sharing=readings_choices.SHARING_PUBLIC,
+        )
+
+    def flush(self, readings, segment):
+        context = BlockContext(segment, self.duration, self.block)
+        context.new_data = BlockData.from_readings(readings).sort(READING_KEY_FIELDS)
+        return PrivateS3Handler().handle_context(context)
+
+    def get_block_path(self, segment=None):
+        if segment:
+            return get_segment_path('json', self.duration, self.block, segment, self.private_prefix)
+        return get_file_path('json', self.duration, self.block, self.private_prefix)
+
+    def get_dates(self, path):
+        return [reading['daterecorded'] for reading in json.loads(self.files[path])]
+
+    def get_manifest(self):
+        return json.loads(self.files[get_manifest_path('sharing', self.duration, self.block)])
+
+    def write_legacy_block(self):
+        self.files[self.get_block_path()] = json.dumps([self.get_reading(0)])
+
+    def test_first_flush_writes_block_files(self):
+        result = self.flush([self.get_reading(1)], 'first')
+
+        self.assertEqual(result['segment'], None)
+        self.assertEqual(self.get_dates(self.get_block_path()), [self.block + 1])
+        self.assertEqual(self.get_manifest(), {'segments': []})
+
+    def test_late_flush_writes_segment(self):
+        self.flush([self.get_reading(1)], 'first')
+        result = self.flush([self.get_reading(2)], 'late')
+
+        self.assertEqual(result['segment'], 'late')
+        self.assertEqual(self.get_dates(self.get_block_path()), [self.block + 1])
+        self.assertEqual(self.get_dates(self.get_block_path('late')), [self.block + 2])
+        segments = self.get_manifest()['segments']
+        self.assertEqual([segment for segment, path_prefixes in segments], ['late'])
+        self.assertIn(self.private_prefix, segments[0][1])
+
+    def test_late_flush_keeps_block_files_written_without_manifest(self):
+        self.write_legacy_block()
+
+        result = self.flush([self.get_reading(1)], 'late')
+
+        self.assertEqual(result['segment'], 'late')
+        self.assertEqual(self.get_dates(self.get_block_path()), [self.block])
+        self.assertEqual(self.get_dates(self.get_block_path('late')), [self.block + 1])
+
+    def test_compaction_merges_segments_into_block_files(self):
+        self.write_legacy_block()
+        self.flush([self.get_reading(2)], 'late')
+        self.flush([self.get_reading(1)], 'later')
+
+        compacted = PrivateS3Handler().compact(self.duration, self.block)
+
+        self.assertEqual(compacted, 2)
+        self.assertEqual(
+            self.get_dates(self.get_block_path()),
+            [self.block, self.block + 1, self.block + 2])
+        self.assertNotIn(self.get_block_path('late'), self.files)
+        self.assertNotIn(self.get_block_path('later'), self.files)
+        self.assertEqual(self.get_manifest(), {'segments': []})
+
+    def test_late_segment_is_registered_once_written(self):
+        self.flush([self.get_reading(1)], 'first')
+        self.defer_writers = True
+
+        self.flush([self.get_reading(2)], 'late')
+
+        self.assertEqual(self.get_manifest(), {'segments': []})
+        self.run_writers()
+        segments = self.get_manifest()['segments']
+        self.assertEqual([segment for segment, path_prefixes in segments], ['late'])
+        self.assertIn(self.private_prefix, segments[0][1])
+
+    def test_compaction_keeps_segments_whose_files_are_missing(self):
+        self.write_legacy_block()
+        self.flush([self.get_reading(2)], 'late')
+        self.flush([self.get_reading(1)], 'later')
+        later_file = self.files.pop(self.get_block_path('later'))
+
+        PrivateS3Handler().compact(self.duration, self.block)
+
+        self.assertEqual(self.get_dates(self.get_block_path()), [self.block, self.block + 2])
+        self.assertNotIn(self.get_block_path('late'), self.files)
+        self.assertEqual(self.get_manifest(), {'segments': [['later', [self.private_prefix]]]})
+        key, score, block_key = self.redis.zadd.call_args[0]
+        self.assertEqual(key, 'compaction-registry')
+
+        self.files[self.get_block_path('later')] = later_file
+        PrivateS3Handler().compact(self.duration, self.block)
+
+        self.assertEqual(
+            self.get_dates(self.get_block_path()),
+            [self.block, self.block + 1, self.block + 2])
+        self.assertEqual(self.get_manifest(), {'segments': []})
+
+    @mock.patch('readings.views.get_file')
+    def test_get_s3_file_merges_pending_segments(self, mock_get_file):
+        customer_type = CustomerType.objects.create(
+            name='Private', description='', sharing=readings_choices.SHARING_PRIVATE)
+        Customer.objects.create(
+            customer_type=customer_type,
+            contact_name='Private',
+            contact_mail='private@example.com',
+            api_key='abc',
+        )
+        self.write_legacy_block()
+        self.flush([self.get_reading(1)], 'late')
+
+        response = self.client.get(reverse('readings-pressure-get'), {
+            'api_key': 'abc',
+            'timestamp': self.block + 5,
+        })
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [reading['daterecorded'] for reading in json.loads(response.content)],
+            [self.block, self.block + 1])
+        self.assertFalse(mock_get_file.called)
+
+    def flush_users(self, readings, segment):
+        context = BlockContext(segment, 'daily', self.block)
+        context.new_data = BlockData.from_readings(readings).sort(READING_KEY_FIELDS)
+        return PrivateS3UserHandler().handle_context(context)
+
+    def get_user_manifest(self):
+        return json.loads(self.files[get_manifest_path('user', 'daily', self.block)])
+
+    def test_user_flush_only_checks_user_block_files(self):
+        self.write_legacy_block()
+
+        result = self.flush_users([self.get_reading(1)], 'first')
+
+        self.assertEqual(result['segment'], None)
+        self.assertIn(get_file_path('json', 'daily', self.block, 'user/user-1'), self.files)
+        self.assertEqual(self.get_user_manifest(), {'segments': []})
+
+    def test_user_flush_keeps_user_block_files_written_without_manifest(self):
+        self.files[get_file_path('json', 'daily', self.block, 'user/user-1')] = json.dumps(
+            [self.get_reading(0)])
+
+        result = self.flush_users([self.get_reading(1)], 'late')
+
+        self.assertEqual(result['segment'], 'late')
+        self.assertEqual(self.get_user_manifest()['segments'], [['late', ['user/user-1']]])
+
+    def test_user_uploads_that_fail_are_retried(self):
+        self.flush_users([self.get_reading(0)], 'first')
+        self.failures['user/user-2'] = settings.USER_WRITE_RETRIES
+
+        self.flush_users([self.get_reading(1), self.get_reading(2)], 'late')
+
+        self.assertItemsEqual(self.get_user_manifest()['segments'][0][1], ['user/user-1', 'user/user-2'])
+        self.assertEqual(self.failures['user/user-2'], 0)
+
+    def test_written_user_uploads_are_registered_when_others_fail(self):
+        self.flush_users([self.get_reading(0)], 'first')
+        self.failures['user/user-2'] = settings.USER_WRITE_RETRIES + 2
+
+        self.assertRaises(
+            PartialWriteError, self.flush_users, [self.get_reading(1), self.get_reading(2)], 'late')
+
+        self.assertEqual(self.get_user_manifest()['segments'], [['late', ['user/user-1']]])
+        self.assertEqual(self.failures['user/user-2'], 1)
+        self.assertIn(
+            get_segment_path('json', 'daily', self.block, 'late', 'user/user-1'), self.files)
+
+    @mock.patch.object(DynamoDBHandler, 'durations', ('daily',))
+    @mock.patch.object(DynamoDBHandler, 'write_data')
+    @mock.patch.object(DataHandler, 'load_block_data')
+    def test_block_processor_shares_the_block_between_handlers(self, mock_load, mock_write):
+        mock_load.return_value = BlockData.from_readings(
+            [self.get_reading(1), self.get_reading(2)]).sort(READING_KEY_FIELDS)
+
+        result = BlockProcessor().handle('block-key', 'daily', self.block)
+
+        mock_load.assert_called_once_with('block-key')
+        self.assertEqual(result['new_data'], 2)
+        self.assertItemsEqual(result['handlers'].keys(), [
+            'PrivateS3Handler', 'PrivateS3UserHandler', 'DynamoDBHandler'])
+        for handler_result in result['handlers'].values():
+            self.assertTrue(handler_result['success'], handler_result.get('error'))
+            self.assertEqual(handler_result['new_data'], 2)
+            self.assertTrue(handler_result['time'] >= 0)
+        self.assertEqual(result['handlers']['DynamoDBHandler']['merged_data'], 2)
+        self.assertTrue(mock_write.called)
+
+    @mock.patch.object(DynamoDBHandler, 'write_data')
+    @mock.patch.object(DataHandler, 'load_block_data')
+    def test_block_processor_reports_failed_handlers(self, mock_load, mock_write):
+        mock_load.return_value = BlockData.from_readings([self.get_reading(1)])
+
+        with mock.patch.object(PrivateS3Handler, 'write_data', side_effect=ValueError('upload failed')):
+            result = BlockProcessor().handle('block-key', self.duration, self.block)
+
+        handler_result = result['handlers']['PrivateS3Handler']
+        self.assertFalse(handler_result['success'])
+        self.assertEqual(handler_result['error'], 'upload failed')
+        self.assertIn('time', handler_result)
+
+
+class GeohashTests(TestCase):
+    base32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+    # A regular box and one crossing the antimeridian
+    boxes = [
+        (40.0, -80.0, 47.0, -66.0),
+        (-20.0, 170.0, -10.0, -170.0),
+    ]
+
+    def get_points(self, precision):
+        rng = random.Random(precision)
+        height, width = geohash.cell_size(precision)
+        lat_cells = int(round(180 / height))
+        lon_cells = int(round(360 / width))
+
+        points = [
+            (rng.uniform(-90, 90), rng.uniform(-180, 180)) for i in range(200)]
+
+        # Points on cell boundaries, including the edges of the world
+        points.extend([
+            (-90.0, -180.0), (90.0, 180.0), (0.0, 0.0), (-90.0, 180.0), (90.0, -180.0)])
+        points.extend(
+            (-90 + rng.randint(0, lat_cells) * height, -180 + rng.randint(0, lon_cells) * width)
+            for i in range(200))
+
+        return points
+
+    def test_encode_many_matches_encode(self):
+        for precision in range(1, 13):
+            points = self.get_points(precision)
+            latitudes, longitudes = zip(*points)
+
+            self.assertEqual(
+                geohash.encode_many(latitudes, longitudes, precision=precision),
+                [geohash.encode(lat, lon, precision=precision) for lat, lon in points])
+
+    def test_encode_int_many_matches_encode(self):
+        for precision in (1, 5, 12):
+            points = self.get_points(precision)
+            latitudes, longitudes = zip(*points)
+
+            expected = []
+            for lat, lon in points:
+                value = 0
+                for char in geohash.encode(lat, lon, precision=precision):
+                    value = (value << 5) | self.base32.index(char)
+                expected.append(value)
+
+            self.assertEqual(
+                geohash.encode_int_many(latitudes, longitudes, bits=5 * precision).tolist(),
+                expected)
+
+
+    def get_stepped_hashes(self, min_lat, min_lon, max_lat, max_lon, length):
+        """Encode points stepped half a cell apart across the box"""
+        height, width = geohash.cell_size(length)
+        if min_lon > max_lon:
+            max_lon += 360.0
+
+        def steps(low, high, size):
+            return [low + index * size / 2 for index in range(int((high - low) / size * 2) + 1)] + [high]
+
+        return set(
+            geohash.encode(lat, lon - 360.0 if lon > 180.0 else lon, precision=length)
+            for lat in steps(min_lat, max_lat, height)
+            for lon in steps(min_lon, max_lon, width)
+        )
+
+    def expand(self, hashes, length):
+        return set(
+            geohash_prefix + ''.join(suffix)
+            for geohash_prefix in hashes
+            for suffix in itertools.product(self.base32, repeat=length - len(geohash_prefix))
+        )
+
+    def test_bounding_box_hashes_match_stepped_hashes(self):
+        for box in self.boxes:
+            for length in (2, 3, 4):
+                hashes = geohash.bounding_box_hashes(*(box + (length,)))
+
+                self.assertEqual(len(hashes), len(set(hashes)))
+                self.assertEqual(set(hashes), self.get_stepped_hashes(*(box + (length,))))
+                self.assertEqual(geohash.bounding_box_size(*(box + (length,))), len(hashes))
+
+    def test_bounding_box_cover_matches_stepped_hashes(self):
+        for box in self.boxes:
+            min_lat, min_lon, max_lat, max_lon = box
+            cover = geohash.bounding_box_cover(*(box + (4,)))
+
+            self.assertEqual(self.expand(cover, 4), self.get_stepped_hashes(*(box + (4,))))
+            self.assertEqual(sum(32 ** (4 - len(cell)) for cell in cover), len(self.expand(cover, 4)))
+            self.assertTrue(any(len(cell) < 4 for cell in cover))
+
+            # Coarser cells lie inside the box
+            for cell in cover:
+                if len(cell) < 4:
+                    lat, lon, lat_err, lon_err = geohash.decode_exactly(cell)
+                    self.assertTrue(min_lat <= lat - lat_err and lat + lat_err <= max_lat)
+                    if min_lon <= max_lon:
+                        self.assertTrue(min_lon <= lon - lon_err and lon + lon_err <= max_lon)
+                    else:
+                        self.assertTrue(min_lon <= lon - lon_err or lon + lon_err <= max_lon)
+
+
+class GroupStatisticsTests(TestCase):
+
+    def get_groups(self):
+        rng = random.Random(0)
+        keys, values, users = [], [], []
+
+        for key in range(50):
+            for i in range(rng.randint(1, 40)):
+                keys.append(key * 7)
+                # Rounded values repeat, so medians fall between equal values
+                values.append(round(rng.uniform(950, 1050), 1))
+                users.append(u'user-%d' % rng.randint(0, 10))
+
+        order = range(len(keys))
+        rng.shuffle(order)
+        return [keys[i] for i in order], [values[i] for i in order], [users[i] for i in order]
+
+    def test_group_statistics_match_list_statistics(self):
+        keys, values, users = self.get_groups()
+
+        group_keys, group_stats = statistics.group_statistics(keys, values, users)
+
+        for index, key in enumerate(group_keys.tolist()):
+            group_values = [value for k, value in zip(keys, values) if k == key]
+            group_users = set(user for k, user in zip(keys, users) if k == key)
+
+            self.assertEqual(group_stats['min'][index], min(group_values))
+            self.assertEqual(group_stats['max'][index], max(group_values))
+            self.assertEqual(group_stats['median'][index], statistics.median(group_values))
+            self.assertAlmostEqual(group_stats['mean'][index], statistics.mean(group_values), delta=1e-9)
+            self.assertAlmostEqual(group_stats['std_dev'][index], statistics.std_dev(group_values), delta=1e-9)
+            self.assertEqual(group_stats['samples'][index], len(group_values))
+            self.assertEqual(group_stats['users'][index], len(group_users))
+
+        self.assertEqual(group_keys.tolist(), sorted(set(keys)))
+
+    def test_group_statistics_accept_user_codes(self):
+        keys, values, users = self.get_groups()
+        user_values, user_codes = BlockData.from_readings(
+            {'user_id': user} for user in users).get_dictionary('user_id')
+
+        by_user = statistics.group_statistics(keys, values, users)[1]
+        by_code = statistics.group_statistics(keys, values, user_codes)[1]
+
+        self.assertEqual(by_code['users'].tolist(), by_user['users'].tolist())
+
+        summaries = statistics.group_summaries(keys, values, users)[1]
+        code_summaries = statistics.group_summaries(keys, values, user_codes, user_values)[1]
+        self.assertEqual(
+            [summary.registers for summary in code_summaries],
+            [summary.registers for summary in summaries])
+
+
+class SummaryTests(TestCase):
+
+    def get_values(self):
+        rng = random.Random(1)
+        return [round(rng.uniform(950, 1050), 2) for i in range(500)]
+
+    def assertSummaryEqual(self, summary, other):
+        self.assertEqual(summary.count, other.count)
+        self.assertEqual(dict(summary.bins), dict(other.bins))
+        self.assertEqual(list(summary.registers), list(other.registers))
+        for name, value in summary.finalize().items():
+            self.assertAlmostEqual(value, other.finalize()[name], delta=1e-9)
+
+    def test_update_matches_list_statistics(self):
+        values = self.get_values()
+        summary = statistics.Summary()
+        for index, value in enumerate(values):
+            summary.update(value, 'user-%d' % (index % 20))
+
+        stats = summary.finalize()
+        self.assertEqual(stats['samples'], len(values))
+        self.assertEqual(stats['min'], min(values))
+        self.assertEqual(stats['max'], max(values))
+        self.assertAlmostEqual(stats['mean'], statistics.mean(values), delta=1e-9)
+        self.assertAlmostEqual(stats['std_dev'], statistics.std_dev(values), delta=1e-9)
+        self.assertAlmostEqual(stats['median'], statistics.median(values), delta=0.05 + 1e-9)
+        self.assertEqual(stats['users'], 20)
+
+    def test_merge_matches_single_summary(self):
+        values = self.get_values()
+        users = ['user-%d' % (index % 20) for index in range(len(values))]
+
+        whole = statistics.Summary().update_many(values, users)
+        merged = statistics.Summary().update_many(values[:123], users[:123]).merge(
+            statistics.Summary().update_many(values[123:], users[123:]))
+
+        self.assertSummaryEqual(merged, whole)
+
+    def test_serialize_round_trip(self):
+        summary = statistics.Summary().update_many(self.get_values(), ['a', 'b', u'\xe9'])
+
+        self.assertSummaryEqual(
+            statistics.Summary.deserialize(summary.serialize()), summary)
+
+    def test_serialize_extreme_values(self):
+        summary = statistics.Summary()
+        for value in (1e9, -1e9, 1e300, -1e300, 1013.2):
+            summary.update(value)
+
+        restored = statistics.Summary.deserialize(summary.serialize())
+
+        self.assertEqual(restored.count, 5)
+        self.assertEqual(restored.min, -1e300)
+        self.assertEqual(restored.max, 1e300)
+        self.assertEqual(restored.median(), 1013.2)
+
+    def test_non_finite_values_are_skipped(self):
+        summary = statistics.Summary()
+        summary.update(float('inf'))
+        summary.update(float('nan'))
+        summary.update_many([float('-inf'), 1000.0])
+
+        restored = statistics.Summary.deserialize(summary.serialize())
+
+        self.assertEqual(restored.count, 1)
+        self.assertEqual(restored.finalize()['mean'], 1000.0)
+
+    def test_serialize_more_than_65535_bins(self):
+        values = [index * statistics.Summary.median_resolution for index in range(70000)]
+        summary = statistics.Summary().update_many(values)
+
+        restored = statistics.Summary.deserialize(summary.serialize())
+
+        self.assertEqual(len(restored.bins), 70000)
+        self.assertEqual(restored.median(), summary.median())
+
+
+class StatisticsHandlerTests(TestCase):
+    block = 1400000400000
+
+    def get_data(self, readings):
+        return BlockData.from_readings([
+            {'latitude': 43.65, 'longitude': -79.38, 'reading': reading, 'user_id': u'user-%d' % index}
+            for index, reading in enumerate(readings)
+        ])
+
+    def test_process_data_skips_non_finite_readings(self):
+        statistics = DynamoDBHandler().process_data(
+            self.get_data([1000.0, float('inf'), float('nan'), 1002.0]))
+
+        self.assertEqual(statistics['d']['samples'], 2)
+        self.assertEqual(statistics['d']['mean'], 1001.0)
+        self.assertEqual(decode_summary(statistics['d']['summary']).count, 2)
+
+    @mock.patch('tasks.aggregator.encode_summary')
+    def test_process_data_keeps_cells_whose_summary_fails(self, mock_encode):
+        mock_encode.side_effect = [ValueError('bad summary')] + ['summary'] * 4
+
+        statistics = DynamoDBHandler().process_data(self.get_data([1000.0, 1002.0]))
+
+        self.assertEqual(len(statistics), 5)
+        self.assertEqual(sum('summary' in stats for stats in statistics.values()), 4)
+        self.assertTrue(all(stats['samples'] == 2 for stats in statistics.values()))
+
+    @mock.patch('tasks.aggregator.write_all_items')
+    @mock.patch('tasks.aggregator.REDIS')
+    def test_write_data_registers_rollups_of_written_cells(self, mock_redis, mock_write):
+        mock_redis.hmget.return_value = [None, None]
+        mock_write.return_value = []
+        handler = DynamoDBHandler()
+        handler.table = mock.Mock()
+
+        handler.write_data('10minute', self.block, {'dpz': {'samples': 1}, 'dpx': {'samples': 2}})
+
+        pipe = mock_redis.pipeline()
+        for duration, duration_time in settings.ROLLUP_DURATIONS:
+            rollup_block = self.block - self.block % duration_time
+            rollup_key = 'rollup:%s:%s' % (duration, rollup_block)
+
+            self.assertItemsEqual(
+                [call[0][1:] for call in pipe.sadd.call_args_list if call[0][0] == rollup_key][0],
+                ['dpz', 'dpx'])
+            pipe.zadd.assert_any_call(
+                'rollup-registry', rollup_block + duration_time + settings.ROLLUP_DELAY, rollup_key)
+
+    @mock.patch('tasks.aggregator.write_all_items')
+    @mock.patch('tasks.aggregator.REDIS')
+    def test_write_data_deletes_cached_items(self, mock_redis, mock_write):
+        mock_redis.hmget.return_value = [None]
+        mock_write.return_value = []
+        handler = DynamoDBHandler()
+        handler.table = mock.Mock()
+        handler.table.name = 'statistics'
+        handler.table.new_item.side_effect = lambda hash_key, range_key, attrs: mock.Mock(
+            hash_key=hash_key, range_key=range_key)
+        cache_key = dynamodb.get_cache_key(handler.table, ('10minute-dpz', self.block))
+        dynamodb._item_cache.set(cache_key, {'samples': 1})
+        cache.set(cache_key, {'samples': 1})
+
+        handler.write_data('10minute', self.block, {'dpz': {'samples': 2}})
+
+        self.assertEqual(dynamodb._item_cache.get(cache_key), None)
+        self.assertEqual(cache.get(cache_key), None)
+
+    @mock.patch('utils.dynamodb.get_cache')
+    @mock.patch('utils.dynamodb.get_all_items')
+    def test_cached_items_keep_missing_keys_briefly(self, mock_get_items, mock_get_cache):
+        mock_get_items.return_value = [{'key': '10minute-dpz', 'block': self.block}]
+        shared_cache = mock_get_cache.return_value
+        shared_cache.get_many.return_value = {}
+        table = mock.Mock()
+        table.name = 'statistics-missing'
+        table.schema.hash_key_name = 'key'
+        table.schema.range_key_name = 'block'
+        keys = [('10minute-dpz', self.block), ('10minute-dpx', self.block)]
+
+        items = dynamodb.get_cached_items(None, table, keys, lambda key: True)
+
+        self.assertEqual(items, [{'key': '10minute-dpz', 'block': self.block}])
+        found_key, missing_key = [dynamodb.get_cache_key(table, key) for key in keys]
+        shared_cache.set_many.assert_any_call(
+            {found_key: items[0]}, settings.DYNAMODB_CACHE_TIMEOUT)
+        shared_cache.set_many.assert_any_call(
+            {missing_key: dynamodb._MISSING}, settings.DYNAMODB_MISSING_TIMEOUT)
+
+    def get_put_response(self, table, items):
+        return {'UnprocessedItems': {table.name: [
+            {'PutRequest': {'Item': {'key': item.hash_key, 'block': item.range_key}}}
+            for item in items
+        ]}}
+
+    @mock.patch('utils.dynamodb.time')
+    @mock.patch('utils.dynamodb.get_conn')
+    @mock.patch('utils.dynamodb.write_items')
+    def test_write_all_items_retries_unprocessed_items(self, mock_write, mock_conn, mock_time):
+        table = mock.Mock()
+        table.name = 'statistics'
+        table.schema.hash_key_name = 'key'
+        table.schema.range_key_name = 'block'
+        items = [mock.Mock(hash_key='10minute-%d' % index, range_key=self.block) for index in range(30)]
+        mock_write.side_effect = [
+            self.get_put_response(table, items[:2]),
+            self.get_put_response(table, items[:1]),
+            {},
+            {},
+        ]
+
+        failed = dynamodb.write_all_items(table, items, concurrency=1, retries=3, backoff=0.1)
+
+        self.assertEqual(failed, [])
+        self.assertEqual([call[0][2] for call in mock_write.call_args_list],
+                         [items[:25], items[:2], items[:1], items[25:]])
+        self.assertEqual([call[0][0] for call in mock_time.sleep.call_args_list], [0.1, 0.2])
+
+    @mock.patch('utils.dynamodb.time')
+    @mock.patch('utils.dynamodb.get_conn')
+    @mock.patch('utils.dynamodb.write_items')
+    def test_write_all_items_returns_items_unprocessed_after_retries(self, mock_write, mock_conn, mock_time):
+        table = mock.Mock()
+        table.name = 'statistics'
+        table.schema.hash_key_name = 'key'
+        table.schema.range_key_name = 'block'
+        items = [mock.Mock(hash_key='10minute-%d' % index, range_key=self.block) for index in range(3)]
+        mock_write.side_effect = lambda conn, table, batch: self.get_put_response(table, batch[-2:])
+
+        failed = dynamodb.write_all_items(table, items, concurrency=2, retries=2, backoff=0.1)
+
+        self.assertEqual(failed, items[1:])
+        self.assertEqual(mock_write.call_count, 3)
+        self.assertEqual([call[0][0] for call in mock_time.sleep.call_args_list], [0.1, 0.2])
+
+    def get_get_response(self, table, items, unprocessed_keys):
+        return {
+            'Responses': {table.name: {'Items': items}},
+            'UnprocessedKeys': {table.name: {'Keys': [
+                {'HashKeyElement': hash_key, 'RangeKeyElement': range_key}
+                for hash_key, range_key in unprocessed_keys
+            ]}},
+        }
+
+    @mock.patch('utils.dynamodb.time')
+    @mock.patch('utils.dynamodb.get_items')
+    def test_get_all_items_retries_unprocessed_keys(self, mock_get_items, mock_time):
+        table = mock.Mock()
+        table.name = 'statistics'
+        keys = [('10minute-%d' % index, self.block) for index in range(3)]
+        mock_get_items.side_effect = [
+            self.get_get_response(table, [{'key': keys[0][0]}], keys[1:]),
+            self.get_get_response(table, [{'key': keys[1][0]}, {'key': keys[2][0]}], []),
+        ]
+
+        items = list(dynamodb.get_all_items(None, table, keys, retries=2, backoff=0.1))
+
+        self.assertEqual([item['key'] for item in items], [key for key, block in keys])
+        self.assertEqual([call[0][2] for call in mock_get_items.call_args_list], [keys, keys[1:]])
+        self.assertEqual([call[0][0] for call in mock_time.sleep.call_args_list], [0.1])
+
+    @mock.patch('utils.dynamodb.time')
+    @mock.patch('utils.dynamodb.get_items')
+    def test_get_all_items_raises_after_retries(self, mock_get_items, mock_time):
+        table = mock.Mock()
+        table.name = 'statistics'
+        keys = [('10minute-0', self.block)]
+        mock_get_items.side_effect = lambda conn, table, batch: self.get_get_response(table, [], batch)
+
+        self.assertRaises(IOError, list, dynamodb.get_all_items(None, table, keys, retries=2, backoff=0.1))
+
+        self.assertEqual(mock_get_items.call_count, 3)
+        self.assertEqual([call[0][0] for call in mock_time.sleep.call_args_list], [0.1, 0.2])
+
+    @mock.patch.object(RollupHandler, 'rollup')
+    @mock.patch('tasks.aggregator.claim_block')
+    @mock.patch('tasks.aggregator.REDIS')
+    def test_rollup_handler_claims_due_rollups(self, mock_redis, mock_claim, mock_rollup):
+        mock_redis.zrangebyscore.return_value = ['rollup:hourly:%s' % self.block, 'rollup:daily:0']
+        mock_claim.side_effect = [1, 0]
+
+        result = RollupHandler().handle()
+
+        self.assertEqual(result, {'due_rollups': 2, 'claimed_rollups': 1})
+        rollup_key, duration, block = mock_rollup().delay.call_args[0]
+        self.assertEqual((duration, block), ('hourly', str(self.block)))
+        self.assertEqual(mock_claim.call_args_list[0][1]['keys'][:2], [
+            'rollup-registry', 'rollup:hourly:%s' % self.block])
+        self.assertEqual(mock_claim.call_args_list[0][1]['keys'][2], rollup_key)
+
+    @mock.patch('tasks.aggregator.get_all_items')
+    @mock.patch('tasks.aggregator.REDIS')
+    def test_statistics_rollup_merges_source_summaries(self, mock_redis, mock_get_items):
+        mock_redis.smembers.return_value = set(['dpz'])
+        first = statistics.Summary().update_many([1000.0, 1001.0], ['a', 'b'])
+        second = statistics.Summary().update_many([1004.0], ['a'])
+        mock_get_items.return_value = [
+            {'key': '10minute-dpz', 'summary': encode_summary(first)},
+            {'key': '10minute-dpz', 'summary': encode_summary(second)},
+            {'key': '10minute-dpz'},
+        ]
+
+        rollup = StatisticsRollup()
+        rollup.conn = mock.Mock()
+        rollup.table = mock.Mock()
+        rollup.table.schema.hash_key_name = 'key'
+
+        with mock.patch.object(rollup, 'write_data') as mock_write_data:
+            rollup.handle('rollup-key', 'hourly', self.block)
+
+        duration, block, rolled_up = mock_write_data.call_args[0]
+        self.assertEqual((duration, block), ('hourly', self.block))
+        self.assertEqual(rolled_up['dpz']['samples'], 3)
+        self.assertEqual(rolled_up['dpz']['users'], 2)
+        self.assertAlmostEqual(rolled_up['dpz']['mean'], 1001.6666666666666, delta=1e-9)
+        self.assertEqual(decode_summary(rolled_up['dpz']['summary']).count, 3)
+
+        # Every 10 minute block of the hour is read
+        keys = mock_get_items.call_args[0][2]
+        self.assertEqual(len(keys), 6)
+        self.assertEqual(keys[0], ('10minute-dpz', self.block - self.block % (60 * 60 * 1000)))
+        mock_redis.delete.assert_called_with('rollup-key')
@@ -6,6 +6,8 @@ urlpatterns = patterns('readings.views',
     url('^conditions/list/$', 'condition_list', name='readings-conditions-list'),
     url('^live/$', 'reading_live', name='readings-live'),
     url('^add/$', 'create_reading', name='readings-create-reading'),
+    url('^add/batch/$', 'create_reading_batch', name='readings-create-reading-batch'),
+    url('^stats/$', 'reading_stats', name='readings-stats'),
     url('^conditions/add/$', 'create_condition', name='readings-create-condition'),
 
     url('^api/pressure/$', 'get_s3_file', name='readings-pressure-get'),
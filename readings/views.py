@@ -1,29 +1,39 @@
 import datetime
 import time
 import urllib2
+from collections import defaultdict
 
 from django.conf import settings
-from django.http import HttpResponse, HttpResponseBadRequest, Http404, HttpResponseNotAllowed
+from django.http import HttpResponse, HttpResponseBadRequest, Http404, HttpResponseNotAllowed, StreamingHttpResponse
 from django.shortcuts import redirect
 from django.utils import simplejson as json
+from django.utils import timezone
+from django.utils.functional import cached_property
 from django.views.decorators.cache import cache_page
 from django.views.decorators.csrf import csrf_exempt
+from django.views.generic.base import View
 from django.views.generic.edit import CreateView
 
 from rest_framework.generics import ListAPIView
 from rest_framework.throttling import UserRateThrottle
 
 from customers import choices as customer_choices
-from customers.models import Customer, CustomerCallLog
+from customers.models import CustomerCallLog, get_customer
 
 from readings import choices as readings_choices
 from readings.filters import ReadingListFilter, ConditionListFilter
 from readings.forms import ReadingForm, ConditionForm
 from readings.models import Reading, ReadingSync, Condition, ConditionFilter
+from readings.pagination import KeysetPaginationMixin, filter_after
 from readings.serializers import ReadingListSerializer, ReadingLiveSerializer, ConditionListSerializer
 
-from utils.dynamodb import get_item
-from utils.geohash import bounding_box_hash
+from tasks.aggregator import (
+    S3_WRITERS, BatchBlockSorter, PrivateS3Handler, advance_customer_cursor,
+    buffer_call_log, clean_call_log, get_customer_cursor)
+
+from utils.db import iter_query_rows
+from utils.dynamodb import get_cached_items, get_conn, get_table
+from utils.geohash import bounding_box_hashes, bounding_box_size
 from utils.loggly import loggly, Logger
 from utils.s3 import get_file
 from utils.time_utils import to_unix
@@ -42,7 +52,7 @@ class FilteredListAPIView(ListAPIView):
         return queryset
 
 
-class ReadingListView(FilteredListAPIView):
+class ReadingListView(KeysetPaginationMixin, FilteredListAPIView):
     model = Reading
     serializer_class = ReadingListSerializer
     filter_class = ReadingListFilter
@@ -50,7 +60,7 @@ class ReadingListView(FilteredListAPIView):
 reading_list = cache_page(ReadingListView.as_view(), settings.CACHE_TIMEOUT)
 
 
-class ConditionListView(FilteredListAPIView):
+class ConditionListView(KeysetPaginationMixin, FilteredListAPIView):
     model = Condition
     serializer_class = ConditionListSerializer
     filter_class = ConditionListFilter
@@ -66,17 +76,21 @@ condition_list = cache_page(ConditionListView.as_view(), settings.CACHE_TIMEOUT)
 
 class APIKeyViewMixin(object):
 
-    def get(self, *args, **kwargs):
-        api_key = self.request.GET.get('api_key', '')
+    @cached_property
+    def customer(self):
+        return get_customer(self.request.GET.get('api_key', ''))
 
-        if not Customer.objects.filter(api_key=api_key, api_key_enabled=True).exists():
+    def get(self, *args, **kwargs):
+        if not (self.customer and self.customer.api_key_enabled):
             return HttpResponseNotAllowed('An active API Key is required')
 
         return super(APIKeyViewMixin, self).get(*args, **kwargs)
 
 
-class LoggedLocationListView(FilteredListAPIView):
+class LoggedLocationListView(Logger, KeysetPaginationMixin, FilteredListAPIView):
     """Handle requests for livestreaming"""
+    default_limit = 1000000
+    max_limit = None
 
     def unpack_parameters(self):
         return {
@@ -88,43 +102,153 @@ class LoggedLocationListView(FilteredListAPIView):
             'max_longitude': self.request.GET.get('max_lon', 180),
             'start_time': self.request.GET.get('start_time', (time.time() - 3600 * 24) * 1000),
             'end_time': self.request.GET.get('end_time', time.time() * 1000),
-            'results_limit': self.request.GET.get('limit', 1000000),
+            'results_limit': self.request.GET.get('limit', self.default_limit),
             'api_key': self.request.GET.get('api_key', ''),
             'data_format': self.request.GET.get('format', 'json'),
         }
 
+    def perform_content_negotiation(self, request, force=False):
+        # Streamed formats are encoded by the view, not a renderer
+        force = force or 'stream' in request.QUERY_PARAMS
+        return super(LoggedLocationListView, self).perform_content_negotiation(request, force)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        if isinstance(response, StreamingHttpResponse):
+            for key, value in self.headers.items():
+                response[key] = value
+            return response
+
+        return super(LoggedLocationListView, self).finalize_response(
+            request, response, *args, **kwargs)
+
     def get(self, *args, **kwargs):
         start = time.time()
+        parameters = self.unpack_parameters()
+
+        if 'stream' in self.request.GET:
+            return self.stream(parameters, start)
 
         response = super(LoggedLocationListView, self).get(*args, **kwargs)
 
-        parameters = self.unpack_parameters()
-        call_log = CustomerCallLog(call_type=self.call_type)
-        call_log.customer = Customer.objects.get(api_key=parameters['api_key'])  # TODO: Handle DoesNotExist case
-        call_log.results_returned = len(response.data)
-        call_log.query = ''
-        call_log.path = '%s?%s' % (self.request.path, self.request.META['QUERY_STRING'])
-        call_log.data_format = parameters['data_format']
-        call_log.min_latitude = parameters['min_latitude']
-        call_log.max_latitude = parameters['max_latitude']
-        call_log.min_longitude = parameters['min_longitude']
-        call_log.max_longitude = parameters['max_longitude']
-        call_log.global_data = parameters['global_data']
-        call_log.since_last_call = parameters['since_last_call']
-        call_log.start_time = parameters['start_time']
-        call_log.end_time = parameters['end_time']
-        call_log.results_limit = parameters['results_limit']
-        call_log.use_utc = ''
-        call_log.processing_time = time.time() - start
-        call_log.ip_address = self.request.META['REMOTE_ADDR']
-        call_log.save()
+        if response.status_code == 200 and response.data:
+            # Readings are listed in (daterecorded, id) order
+            latest = list(self.object_list)[-1]
+            self.advance_cursor(latest.daterecorded, latest.pk)
+
+        self.log_call(parameters, start, len(response.data))
 
         return response
 
+    def stream(self, parameters, start):
+        writer = S3_WRITERS.get(parameters['data_format'])
+        if not writer:
+            return HttpResponseBadRequest('Unsupported format')
+
+        writer = writer()
+        fields = self.get_serializer().fields.keys()
+        queryset = self.filter_queryset(self.get_queryset()).values_list(*(fields + ['id']))
+
+        return StreamingHttpResponse(
+            self.stream_rows(writer, fields, queryset, parameters, start),
+            content_type=writer.content_type,
+        )
+
+    def stream_rows(self, writer, fields, queryset, parameters, start):
+        """
+        Encode readings batch by batch as they are read from the database,
+        counting them for the call log as they go out.
+        """
+        results_returned = 0
+        latest = None
+        date_index = fields.index('daterecorded')
+
+        try:
+            yield writer.get_header(fields)
+
+            for rows in iter_query_rows(queryset, settings.OUTPUT_BATCH_SIZE):
+                # Rows come in (daterecorded, id) order and end with the id
+                latest = rows[-1][date_index], rows[-1][-1]
+                rows = [row[:-1] for row in rows]
+
+                if results_returned:
+                    yield writer.row_separator
+                yield writer.encode_rows(fields, rows)
+
+                results_returned += len(rows)
+
+            yield writer.get_footer()
+
+            # Only a complete response moves the cursor
+            if latest is not None:
+                self.advance_cursor(*latest)
+        finally:
+            self.log_call(parameters, start, results_returned)
+
+    def log_call(self, parameters, start, results_returned):
+        call_log = {
+            'call_type': self.call_type,
+            'customer_id': self.customer.id,
+            'timestamp': timezone.now(),
+            'results_returned': results_returned,
+            'query': '',
+            'path': '%s?%s' % (self.request.path, self.request.META['QUERY_STRING']),
+            'data_format': parameters['data_format'],
+            'min_latitude': parameters['min_latitude'],
+            'max_latitude': parameters['max_latitude'],
+            'min_longitude': parameters['min_longitude'],
+            'max_longitude': parameters['max_longitude'],
+            'global_data': parameters['global_data'],
+            'since_last_call': parameters['since_last_call'],
+            'start_time': parameters['start_time'],
+            'end_time': parameters['end_time'],
+            'results_limit': parameters['results_limit'],
+            'use_utc': False,
+            'ip_address': self.request.META['REMOTE_ADDR'],
+            'processing_time': time.time() - start,
+        }
+
+        # Call logs are written in batches by the CallLogWriter, a call
+        # is never failed for its log
+        try:
+            buffer_call_log(clean_call_log(call_log))
+        except Exception, e:
+            self.log(
+                error='Unable to buffer call log: %s' % e,
+                customer=self.customer.id,
+            )
+
+    def advance_cursor(self, daterecorded, pk):
+        """Record the latest reading delivered for since_last_call"""
+        try:
+            advance_customer_cursor(self.customer.id, daterecorded, pk)
+        except Exception, e:
+            self.log(
+                error='Unable to advance customer cursor: %s' % e,
+                customer=self.customer.id,
+            )
+
+    def get_cursor(self):
+        """
+        Return the customer's cursor.  Customers who called before cursors
+        were kept get one seeded from their latest call, which resumed
+        from the readings recorded since.
+        """
+        cursor = get_customer_cursor(self.customer.id)
+
+        if cursor is None:
+            call_logs = CustomerCallLog.objects.filter(
+                customer=self.customer).order_by('-timestamp')[:1]
+            if call_logs:
+                # Readings ids start at 1, so this resumes at the timestamp
+                cursor = (to_unix(call_logs[0].timestamp), 0)
+                self.advance_cursor(*cursor)
+
+        return cursor
+
     def get_queryset(self):
         parameters = self.unpack_parameters()
 
-        customer = Customer.objects.get(api_key=parameters['api_key'])  # TODO: Handle DoesNotExist case
+        customer = self.customer
         queryset = super(LoggedLocationListView, self).get_queryset()
 
         if not parameters['global_data']:
@@ -135,12 +259,12 @@ class LoggedLocationListView(FilteredListAPIView):
                 longitude__lte=parameters['max_longitude'],
             )
 
-        call_logs = CustomerCallLog.objects.filter(customer=customer)
-        if parameters['since_last_call'] and call_logs.exists():
-            call_log = call_logs.order_by('-timestamp')[:1].get()
-            queryset = queryset.filter(
-                daterecorded__gte=to_unix(call_log.timestamp),
-            )
+        cursor = None
+        if parameters['since_last_call']:
+            cursor = self.get_cursor()
+
+        if cursor is not None:
+            queryset = filter_after(queryset, *cursor)
         else:
             queryset = queryset.filter(
                 daterecorded__gte=parameters['start_time'],
@@ -163,7 +287,7 @@ class LoggedLocationListView(FilteredListAPIView):
                 readings_choices.SHARING_RESEARCHERS_FORECASTERS,
             ])
 
-        return queryset[:parameters['results_limit']]
+        return queryset
 
 
 class ReadingLiveView(APIKeyViewMixin, LoggedLocationListView):
@@ -176,6 +300,133 @@ class ReadingLiveView(APIKeyViewMixin, LoggedLocationListView):
 reading_live = ReadingLiveView.as_view()
 
 
+class ReadingStatisticsView(Logger, View):
+    """Serve precomputed geohash statistics for a bounding box and time range"""
+    fields = ('min', 'max', 'mean', 'median', 'std_dev', 'samples', 'users')
+    max_precision = 5
+
+    def get_durations(self):
+        durations = dict(settings.ROLLUP_DURATIONS)
+        durations.update(
+            (duration, duration_time)
+            for duration, duration_time in settings.ALL_DURATIONS
+            if duration in settings.STATISTICS_DURATIONS
+        )
+        return durations
+
+    def unpack_parameters(self):
+        parameters = self.request.REQUEST
+
+        return {
+            'min_latitude': max(float(parameters.get('min_lat', -90)), -90),
+            'max_latitude': min(float(parameters.get('max_lat', 90)), 90),
+            'min_longitude': max(float(parameters.get('min_lon', -180)), -180),
+            'max_longitude': min(float(parameters.get('max_lon', 180)), 180),
+            'start_time': int(float(parameters.get('start_time', (time.time() - 3600 * 24) * 1000))),
+            'end_time': int(float(parameters.get('end_time', time.time() * 1000))),
+            'duration': parameters.get('duration', settings.STATISTICS_DURATIONS[0]),
+        }
+
+    def get_precision(self, parameters, blocks):
+        """
+        Return the finest geohash precision whose cover of the bounding box
+        keeps the number of fetched items under MAX_STATISTICS_KEYS.
+        """
+        for precision in range(self.max_precision, 0, -1):
+            cells = bounding_box_size(
+                parameters['min_latitude'],
+                parameters['min_longitude'],
+                parameters['max_latitude'],
+                parameters['max_longitude'],
+                precision,
+            )
+            if cells * blocks <= settings.MAX_STATISTICS_KEYS:
+                return precision
+
+    def get_statistics(self, duration, duration_time, geo_keys, blocks):
+        conn = get_conn()
+        table = get_table(conn)
+
+        # Statistics of closed blocks never change and may come from cache
+        closed_block = time.time() * 1000 - duration_time - settings.STATISTICS_CLOSED_DELAY
+
+        keys = [
+            ('%s-%s' % (duration, geo_key), block)
+            for geo_key in geo_keys
+            for block in blocks
+        ]
+
+        statistics = defaultdict(list)
+        items = get_cached_items(
+            conn, table, keys, lambda key: key[1] <= closed_block)
+
+        for item in items:
+            geo_key = item[table.schema.hash_key_name].split('-', 1)[1]
+            statistics[geo_key].append(
+                [int(item[table.schema.range_key_name])] +
+                [item.get(field) for field in self.fields]
+            )
+
+        for geo_key_statistics in statistics.values():
+            geo_key_statistics.sort()
+
+        return statistics
+
+    def get(self, *args, **kwargs):
+        start = time.time()
+
+        try:
+            parameters = self.unpack_parameters()
+        except ValueError:
+            return HttpResponseBadRequest('Invalid statistics parameters')
+
+        duration_time = self.get_durations().get(parameters['duration'])
+        if not duration_time:
+            return HttpResponseBadRequest('Unsupported duration')
+
+        first_block = parameters['start_time'] - parameters['start_time'] % duration_time
+        blocks = range(first_block, parameters['end_time'] + 1, duration_time)
+
+        precision = self.get_precision(parameters, len(blocks)) if blocks else None
+        if not precision:
+            return HttpResponseBadRequest('Too many statistics requested, narrow the area or time range')
+
+        geo_keys = bounding_box_hashes(
+            parameters['min_latitude'],
+            parameters['min_longitude'],
+            parameters['max_latitude'],
+            parameters['max_longitude'],
+            precision,
+        )
+
+        statistics = self.get_statistics(
+            parameters['duration'], duration_time, geo_keys, blocks)
+
+        self.log(
+            duration=parameters['duration'],
+            precision=precision,
+            geo_keys=len(geo_keys),
+            blocks=len(blocks),
+            cells=len(statistics),
+            time=time.time() - start,
+        )
+
+        return HttpResponse(
+            json.dumps({
+                'duration': parameters['duration'],
+                'precision': precision,
+                'fields': ('block',) + self.fields,
+                'cells': statistics,
+            }),
+            mimetype='application/json'
+        )
+
+    def post(self, *args, **kwargs):
+        return self.get(*args, **kwargs)
+
+reading_stats = csrf_exempt(ReadingStatisticsView.as_view())
+
+
 class JSONCreateView(Logger, CreateView):
 
     def log_response(self, response):
@@ -221,6 +472,85 @@ class CreateReadingView(JSONCreateView):
 create_reading = csrf_exempt(CreateReadingView.as_view())
 
 
+class CreateReadingBatchView(Logger, View):
+    """Accept a JSON array of readings and save the valid ones in bulk"""
+    model = Reading
+    form_class = ReadingForm
+
+    def get_form_response(self, form):
+        if form is None:
+            return {
+                'success': False,
+                'client_key': '',
+                'errors': 'Each reading must be a JSON object',
+            }
+
+        if form.is_valid():
+            return {
+                'success': True,
+                'client_key': form.cleaned_data.get('client_key', ''),
+                'errors': '',
+            }
+
+        return {
+            'success': False,
+            'client_key': form.cleaned_data.get('client_key', ''),
+            'errors': form._errors,
+        }
+
+    def save_forms(self, forms):
+        self.model.objects.bulk_create([form.instance for form in forms])
+
+        try:
+            BatchBlockSorter().apply(args=[
+                [form.get_block_data() for form in forms]
+            ])
+        except Exception, e:
+            self.log(error=str(e))
+
+    def post(self, *args, **kwargs):
+        try:
+            readings_data = json.loads(self.request.body)
+        except ValueError:
+            return HttpResponseBadRequest('Expected a JSON array of readings')
+
+        if not isinstance(readings_data, list):
+            return HttpResponseBadRequest('Expected a JSON array of readings')
+
+        if len(readings_data) > settings.MAX_BATCH_LENGTH:
+            return HttpResponseBadRequest(
+                'At most %s readings may be sent in one batch' % settings.MAX_BATCH_LENGTH)
+
+        forms = [
+            self.form_class(data=reading_data)
+            if isinstance(reading_data, dict) else None
+            for reading_data in readings_data
+        ]
+
+        response = [self.get_form_response(form) for form in forms]
+
+        valid_forms = [
+            form for form, form_response in zip(forms, response)
+            if form_response['success']
+        ]
+
+        if valid_forms:
+            self.save_forms(valid_forms)
+
+        self.log(
+            received=len(forms),
+            saved=len(valid_forms),
+            rejected=len(forms) - len(valid_forms),
+        )
+
+        return HttpResponse(
+            json.dumps(response),
+            mimetype='application/json'
+        )
+
+create_reading_batch = csrf_exempt(CreateReadingBatchView.as_view())
+
+
 class CreateConditionView(JSONCreateView):
     model = Condition
     form_class = ConditionForm
@@ -243,11 +573,11 @@ def get_s3_file(request):
 
         timestamp = int(request.GET.get('timestamp', 0)) or int(time.time() * 1000)
         
-        if not (api_key and Customer.objects.filter(api_key=api_key, api_key_enabled=True).exists()):
+        customer = get_customer(api_key)
+
+        if not (customer and customer.api_key_enabled):
             response = HttpResponseNotAllowed('An active API Key is required')
         else:
-            customer = Customer.objects.get(api_key=api_key)
-
             duration_label, duration_time = settings.ALL_DURATIONS[0]
             timestamp_offset = timestamp % duration_time
             timestamp_block = timestamp - timestamp_offset
@@ -255,11 +585,18 @@ def get_s3_file(request):
             if not customer.customer_type:
                 response = HttpResponseNotAllowed('You are not authorized to request this API.  Please contact support.')
             else:
-                file_path = 'readings/pressure/combined/{sharing}/{format}/10minute/{timestamp}.{format}'.format(
-                    sharing=customer.customer_type.sharing, format=file_format, timestamp=timestamp_block)
-                s3_file = get_file(file_path)
+                file_path, content = PrivateS3Handler().resolve_output(
+                    duration_label,
+                    timestamp_block,
+                    file_format,
+                    'combined/{sharing}'.format(sharing=customer.customer_type.sharing),
+                )
+                s3_file = get_file(file_path) if file_path else None
                 if s3_file:
                     response = redirect(s3_file.generate_url(1000))
+                elif content:
+                    response = HttpResponse(
+                        content, mimetype='application/{format}'.format(format=file_format))
                 else:
                     response = HttpResponse(status=404)
     except Exception, e:
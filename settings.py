@@ -184,13 +184,71 @@ DYNAMODB_TABLE = os.environ.get('DYNAMODB_TABLE', '')
 ALL_DURATIONS = (
     ('10minute', (10 * 60 * 1000)),
     #('hourly', (60 * 60 * 1000)),
-    #('daily', (24 * 60 * 60 * 1000)),
+    ('daily', (24 * 60 * 60 * 1000)),
 )
 LOG_DURATIONS = {
     'split': [], #('daily',),
-    'combined': ('10minute', ),#'hourly', 'daily'),
+    'combined': ('10minute', 'daily'),#'hourly'),
 }
-STATISTICS_DURATIONS = ('10minute', 'hourly')
+STATISTICS_DURATIONS = ('10minute',)
+
+# Milliseconds after a block ends before its statistics are final, from
+# then on they are served through the DynamoDB item caches
+STATISTICS_CLOSED_DELAY = 60 * 60 * 1000
+
+# Items held by each process' DynamoDB item cache and for how many seconds,
+# the shared cache (a CACHES alias or None) and how long it keeps items and
+# keys found missing in seconds.  Written items are deleted from the shared
+# cache, a process keeps serving its own copy for at most the local timeout
+DYNAMODB_CACHE_SIZE = 10000
+DYNAMODB_LOCAL_CACHE_TIMEOUT = 60
+DYNAMODB_SHARED_CACHE = 'default'
+DYNAMODB_CACHE_TIMEOUT = 24 * 60 * 60
+DYNAMODB_MISSING_TIMEOUT = 5 * 60
+
+# Statistics batches written to DynamoDB at the same time, and how many
+# times and after how many seconds (doubling) unprocessed items and keys
+# of batch writes and reads are retried
+DYNAMODB_WRITE_CONCURRENCY = 4
+DYNAMODB_WRITE_RETRIES = 5
+DYNAMODB_WRITE_BACKOFF = 0.05
+
+# Statistics rolled up from the summaries of ROLLUP_SOURCE_DURATION blocks
+# once their window closes, ROLLUP_DELAY milliseconds after it ends
+ROLLUP_SOURCE_DURATION = '10minute'
+ROLLUP_DURATIONS = (
+    ('hourly', (60 * 60 * 1000)),
+    ('daily', (24 * 60 * 60 * 1000)),
+)
+ROLLUP_DELAY = 20 * 60 * 1000
+
+# Redis block encoding, 'record' (compact binary) or 'pickle'
+BLOCK_RECORD_FORMAT = 'record'
+
+# Seconds a dataset handed to the S3 writers is kept in Redis
+WRITER_DATA_EXPIRE = 60 * 60
+
+# Gzip level of S3 output files, bytes of output buffered in memory
+# before spooling to disk, and readings serialized per batch
+S3_GZIP_LEVEL = 6
+S3_SPOOL_SIZE = 8 * 1024 * 1024
+OUTPUT_BATCH_SIZE = 1000
+
+# Local directory caching bucket files read by this worker and written
+# files it reads back, disabled when empty, and its size in bytes
+S3_CACHE_DIR = os.environ.get('S3_CACHE_DIR', '')
+S3_CACHE_SIZE = 1024 * 1024 * 1024
+
+# Number of per-user archives uploaded at the same time, and how many
+# times the uploads of users that failed are retried
+USER_WRITE_CONCURRENCY = 8
+USER_WRITE_RETRIES = 2
+
+# Milliseconds after a block ends before its late segments are compacted
+BLOCK_COMPACTION_DELAY = 60 * 60 * 1000
+
+# Seconds a block manifest update may hold its lock
+MANIFEST_LOCK_TIMEOUT = 60
 
 # Storage Settings
 DEFAULT_FILE_STORAGE = 'utils.s3.MediaS3Storage'
@@ -202,11 +260,31 @@ REDIS_URL = os.environ.get('REDIS_URL', '')
 # Celery Settings
 BROKER_URL = 'redis://{redis}:6379/0'.format(redis=REDIS_URL)
 
+# Customer call logs are buffered in Redis and written in batches of
+# CALL_LOG_BATCH_SIZE at least every CALL_LOG_WRITE_INTERVAL seconds, call
+# logs beyond CALL_LOG_BUFFER_SIZE waiting to be written are dropped and as
+# many of the latest call logs that failed to be written are quarantined
+CALL_LOG_BATCH_SIZE = 500
+CALL_LOG_WRITE_INTERVAL = 10
+CALL_LOG_BUFFER_SIZE = 100000
+
 CELERYBEAT_SCHEDULE = {
     'block-handler': {
         'task': 'tasks.aggregator.BlockHandler',
         'schedule': datetime.timedelta(minutes=10),
     },
+    'compaction-handler': {
+        'task': 'tasks.aggregator.CompactionHandler',
+        'schedule': datetime.timedelta(minutes=10),
+    },
+    'rollup-handler': {
+        'task': 'tasks.aggregator.RollupHandler',
+        'schedule': datetime.timedelta(minutes=10),
+    },
+    'call-log-writer': {
+        'task': 'tasks.aggregator.CallLogWriter',
+        'schedule': datetime.timedelta(seconds=CALL_LOG_WRITE_INTERVAL),
+    },
 }
 
 CELERY_TIMEZONE = 'UTC'
@@ -229,6 +307,15 @@ REST_FRAMEWORK = {
 
 MAX_CALL_LENGTH = 10000
 
+# Customers resolved by API key kept per process, and for how many seconds
+CUSTOMER_CACHE_SIZE = 1000
+CUSTOMER_CACHE_TIMEOUT = 60
+
+MAX_BATCH_LENGTH = 5000
+
+# Most (geohash, block) statistics fetched for one stats request
+MAX_STATISTICS_KEYS = 1000
+
 # Google Play
 PLAY_STORE_URL = 'https://play.google.com/store/apps/details?id=ca.cumulonimbus.barometernetwork'
 
@@ -1,24 +1,36 @@
 import StringIO
+import base64
 import csv
+import hashlib
+import math
 import pickle
 import time
 import traceback
 import uuid
 from collections import defaultdict
+from itertools import chain
+from multiprocessing.pool import ThreadPool
 
+import numpy
 import redis as pyredis
 from celery import Celery
 from django.conf import settings
+from django.db import connection, transaction
 from django.utils import simplejson as json
 from django.utils.functional import cached_property
 
+from customers.models import CustomerCallLog
+
 from readings import choices as readings_choices
 from readings.serializers import ReadingListSerializer
 
-from utils.dynamodb import get_conn, write_items
+from utils.blocks import BlockData
+from utils.dynamodb import (
+    delete_cached_items, get_all_items, get_conn, get_table, write_all_items)
 from utils.loggly import Logger
-from utils.s3 import get_bucket, read_from_bucket, write_to_bucket
-from utils.statistics import mean, median, std_dev
+from utils.records import RECORD_FIELDS, decode_reading, encode_reading, is_record
+from utils.s3 import BucketWriter, get_bucket, read_from_bucket, write_to_bucket
+from utils.statistics import Summary, group_statistics, group_summaries
 from utils import geohash
 
 
@@ -33,32 +45,255 @@ app.config_from_object('django.conf:settings')
 REDIS = pyredis.StrictRedis(host=settings.REDIS_URL)
 ALL_SHARING_LABELS = [choice[0] for choice in readings_choices.SHARING_CHOICES]
 
+# Sorted set of open block keys scored by the end time of their block
+BLOCK_REGISTRY_KEY = 'block-registry'
+
+# Sorted set of block keys with uncompacted segments scored by the time
+# the block can be compacted
+COMPACTION_REGISTRY_KEY = 'compaction-registry'
+
+# Sorted set of rollup windows scored by the time they can be rolled up
+ROLLUP_REGISTRY_KEY = 'rollup-registry'
+
+DURATION_TIMES = dict(settings.ALL_DURATIONS)
+
+# List of customer call logs waiting to be written, and the number of
+# call logs dropped because it was full
+CALL_LOG_BUFFER_KEY = 'call-log-buffer'
+CALL_LOG_DROPPED_KEY = 'call-log-dropped'
+
+# The latest call logs that could not be written, kept for inspection,
+# and the number of call logs quarantined there
+CALL_LOG_QUARANTINE_KEY = 'call-log-quarantine'
+CALL_LOG_QUARANTINED_KEY = 'call-log-quarantined'
+
+# Numeric CustomerCallLog fields filled from request parameters, with the
+# type of their column and its largest value
+CALL_LOG_NUMBER_FIELDS = {
+    'min_latitude': (float, None),
+    'max_latitude': (float, None),
+    'min_longitude': (float, None),
+    'max_longitude': (float, None),
+    'start_time': (long, 2 ** 63 - 1),
+    'end_time': (long, 2 ** 63 - 1),
+    'results_limit': (int, 2 ** 31 - 1),
+}
+
+# Hash of the latest reading delivered to each customer by id, as
+# 'daterecorded:id'
+CUSTOMER_CURSOR_KEY = 'customer-cursors'
+
+# Unregisters a block and moves its readings to a private key in one step,
+# so readings sorted after the claim start a new block under the old key.
+claim_block = REDIS.register_script("""
+if redis.call('zrem', KEYS[1], KEYS[2]) == 0 then
+    return 0
+end
+if redis.call('exists', KEYS[2]) == 0 then
+    return 0
+end
+redis.call('rename', KEYS[2], KEYS[3])
+redis.call('expire', KEYS[3], ARGV[1])
+return 1
+""")
+
+# Appends a call log unless the buffer is full, returns the new length of
+# the buffer or 0 when the call log was dropped.
+push_call_log = REDIS.register_script("""
+if redis.call('llen', KEYS[1]) >= tonumber(ARGV[2]) then
+    redis.call('incr', KEYS[2])
+    return 0
+end
+return redis.call('rpush', KEYS[1], ARGV[1])
+""")
+
+# Moves a customer cursor forward to the given (daterecorded, id), never back
+advance_cursor = REDIS.register_script("""
+local cursor = redis.call('hget', KEYS[1], ARGV[1])
+if cursor then
+    local daterecorded, id = string.match(cursor, '^(%-?%d+):(%d+)$')
+    daterecorded, id = tonumber(daterecorded), tonumber(id)
+    local new_daterecorded, new_id = tonumber(ARGV[2]), tonumber(ARGV[3])
+    if daterecorded > new_daterecorded or (daterecorded == new_daterecorded and id >= new_id) then
+        return 0
+    end
+end
+redis.call('hset', KEYS[1], ARGV[1], ARGV[2] .. ':' .. ARGV[3])
+return 1
+""")
+
 
 # Utility functions
-def hash_dict(data):
-    return '%s%s%s' % (
-        data['latitude'],
-        data['longitude'],
-        data['daterecorded'],
+# Fields identifying a reading, blocks are kept sorted by them
+READING_KEY_FIELDS = ('daterecorded', 'latitude', 'longitude')
+
+
+def get_block_key(duration, block):
+    return 'block:%s:%s' % (duration, block)
+
+
+def unpack_block_key(block_key):
+    return block_key.split(':')[1:]
+
+
+def get_rollup_key(duration, block):
+    return 'rollup:%s:%s' % (duration, block)
+
+
+def clean_call_log(call_log):
+    """
+    Coerce the request parameters of a call log to the types of their
+    CustomerCallLog columns.  Values that aren't finite numbers are
+    stored as 0 and integers are clamped to their column, the path keeps
+    the parameters as requested.
+    """
+    call_log = dict(call_log)
+
+    for field, (number_type, maximum) in CALL_LOG_NUMBER_FIELDS.items():
+        try:
+            value = float(call_log[field])
+        except (TypeError, ValueError):
+            value = 0.0
+
+        if math.isnan(value) or math.isinf(value):
+            value = 0.0
+        if maximum is not None:
+            value = min(max(value, -maximum - 1), maximum)
+
+        call_log[field] = number_type(value)
+
+    max_length = CustomerCallLog._meta.get_field('data_format').max_length
+    call_log['data_format'] = unicode(call_log['data_format'])[:max_length]
+
+    return call_log
+
+
+def buffer_call_log(call_log):
+    """
+    Queue the fields of a CustomerCallLog for the CallLogWriter, starting
+    a writer whenever a full batch is waiting.  Returns False when the
+    buffer is full and the call log was dropped.
+    """
+    length = push_call_log(
+        keys=[CALL_LOG_BUFFER_KEY, CALL_LOG_DROPPED_KEY],
+        args=[pickle.dumps(call_log, pickle.HIGHEST_PROTOCOL), settings.CALL_LOG_BUFFER_SIZE],
     )
 
+    if length and length % settings.CALL_LOG_BATCH_SIZE == 0:
+        CallLogWriter().delay()
 
-def group_by(items, length):
-    while items:
-        yield items[:length]
-        items = items[length:]
+    return bool(length)
 
 
-def is_block_key(block_key):
-    return block_key.startswith('block:')
+def get_customer_cursor(customer_id):
+    """
+    Return the (daterecorded, id) of the latest reading delivered to a
+    customer, or None if nothing has been delivered yet.
+    """
+    cursor = REDIS.hget(CUSTOMER_CURSOR_KEY, customer_id)
+    if cursor is None:
+        return None
 
+    daterecorded, pk = cursor.split(':')
+    return long(daterecorded), long(pk)
 
-def get_block_key(duration, block):
-    return 'block:%s:%s' % (duration, block)
 
+def advance_customer_cursor(customer_id, daterecorded, pk):
+    return bool(advance_cursor(
+        keys=[CUSTOMER_CURSOR_KEY],
+        args=[customer_id, long(daterecorded), long(pk)],
+    ))
 
-def unpack_block_key(block_key):
-    return block_key.split(':')[1:]
+
+def encode_summary(summary):
+    return base64.b64encode(summary.serialize())
+
+
+def decode_summary(content):
+    return Summary.deserialize(base64.b64decode(content))
+
+
+def encode_block_reading(reading):
+    if settings.BLOCK_RECORD_FORMAT == 'record':
+        return encode_reading(reading)
+    return pickle.dumps(reading)
+
+
+def decode_block_reading(content):
+    # Blocks may still hold pickled readings queued before the switch
+    # to compact records, so both formats are accepted here.
+    if is_record(content):
+        return decode_reading(content)
+    return pickle.loads(content)
+
+
+def get_segment_path(format, duration, block, segment, path_prefix=''):
+    return 'readings/pressure/{prefix}/{format}/{duration}/{block}/{segment}.{format}'.format(
+        prefix=path_prefix,
+        format=format,
+        duration=duration,
+        block=block,
+        segment=segment,
+    )
+
+
+def get_manifest_path(name, duration, block):
+    return 'readings/pressure/manifests/{name}/{duration}/{block}.json'.format(
+        name=name,
+        duration=duration,
+        block=block,
+    )
+
+
+def read_manifest(bucket, name, duration, block):
+    content = read_from_bucket(bucket, get_manifest_path(name, duration, block))
+    if content:
+        return json.loads(content)
+
+
+def write_manifest(bucket, name, duration, block, manifest):
+    write_to_bucket(
+        bucket,
+        get_manifest_path(name, duration, block),
+        json.dumps(manifest),
+        'application/json',
+        cache=True,
+    )
+
+
+def get_pending_segments(manifest, path_prefix):
+    if not manifest:
+        return []
+
+    return [
+        segment for segment, path_prefixes in manifest['segments']
+        if path_prefix in path_prefixes
+    ]
+
+
+def store_writer_data(data, readers):
+    data_key = 'writer-data:%s' % uuid.uuid4()
+    expire = settings.WRITER_DATA_EXPIRE
+
+    pipe = REDIS.pipeline(transaction=True)
+    pipe.setex(data_key, expire, data.serialize())
+    pipe.setex('%s:readers' % data_key, expire, readers)
+    pipe.execute()
+
+    return data_key
+
+
+def load_writer_data(data_key):
+    content = REDIS.get(data_key)
+    if content is None:
+        raise KeyError('Writer data %s has expired' % data_key)
+    return BlockData.deserialize(content)
+
+
+def release_writer_data(data_key):
+    readers_key = '%s:readers' % data_key
+    if REDIS.decr(readers_key) <= 0:
+        REDIS.delete(data_key, readers_key)
 
 
 def get_file_path(format, duration, block, path_prefix=''):
@@ -70,6 +305,12 @@ def get_file_path(format, duration, block, path_prefix=''):
     )
 
 
+# Output files handlers read back, the combined private JSON block files
+# and segments, the only outputs kept in the disk cache
+CACHED_OUTPUT_PREFIX = 'readings/pressure/combined/{label}/json/'.format(
+    label=readings_choices.SHARING_PRIVATE)
+
+
 # Base Task
 class BaseTask(app.Task, Logger):
 
@@ -100,23 +341,83 @@ class BaseTask(app.Task, Logger):
 
 
 # Writers
+def get_output_fields(data):
+    """
+    Return the column order of output files, the record fields the data
+    has in record order followed by any other fields by name.
+    """
+    fields = [field for field in RECORD_FIELDS if field in data.fields]
+    return fields + sorted(field for field in data.fields if field not in fields)
+
+
+def write_outputs(bucket_name, outputs, data):
+    """
+    Write data in the format of each (writer, output_path) of outputs,
+    extracting the rows once and streaming them through every writer.
+    """
+    bucket = get_bucket(bucket_name)
+    fields = get_output_fields(data)
+
+    streams = []
+    for writer, output_path in outputs:
+        stream = BucketWriter(
+            bucket, output_path, writer.content_type, compress=True,
+            cache=output_path.startswith(CACHED_OUTPUT_PREFIX))
+        stream.write(writer.get_header(fields))
+        streams.append((writer, stream))
+
+    for index, rows in enumerate(
+            data.iter_row_batches(fields, settings.OUTPUT_BATCH_SIZE)):
+        for writer, stream in streams:
+            if index:
+                stream.write(writer.row_separator)
+            stream.write(writer.encode_rows(fields, rows))
+
+    failed_paths = []
+    for writer, stream in streams:
+        stream.write(writer.get_footer())
+        if stream.close() is None:
+            failed_paths.append(stream.key)
+
+    if failed_paths:
+        raise IOError('Unable to upload %s' % ', '.join(failed_paths))
+
+
 class BaseS3Writer(BaseTask):
+    row_separator = ''
 
-    def prepare(self, data):
-        raise NotImplementedError
+    @property
+    def content_type(self):
+        return 'application/{format}'.format(format=self.file_format)
 
-    def write(self, bucket_name, output_path, output_content):
-        write_to_bucket(
-            get_bucket(bucket_name),
-            output_path,
-            output_content,
-            'application/{format}'.format(format=self.file_format),
-            compress=True,
-        )
+    def get_header(self, fields):
+        return ''
+
+    def get_footer(self):
+        return ''
 
-    def handle(self, bucket_name, output_path, data):
-        output_content = self.prepare(data)
-        self.write(bucket_name, output_path, output_content)
+    def encode_rows(self, fields, rows):
+        raise NotImplementedError
+
+    def prepare(self, data):
+        fields = get_output_fields(data)
+        return ''.join([self.get_header(fields)] + [
+            self.row_separator.join(
+                self.encode_rows(fields, rows)
+                for rows in data.iter_row_batches(fields, settings.OUTPUT_BATCH_SIZE)
+            ),
+            self.get_footer(),
+        ])
+
+    def write_data(self, bucket_name, output_path, data):
+        write_outputs(bucket_name, [(self, output_path)], data)
+
+    def handle(self, bucket_name, output_path, data_key):
+        try:
+            data = load_writer_data(data_key)
+            self.write_data(bucket_name, output_path, data)
+        finally:
+            release_writer_data(data_key)
 
         return {
             'format': self.file_format,
@@ -128,23 +429,44 @@ class BaseS3Writer(BaseTask):
 
 class JSONS3Writer(BaseS3Writer):
     file_format = 'json'
+    row_separator = ', '
+    encode = json.JSONEncoder().encode
 
-    def prepare(self, data):
-        return json.dumps(data)
+    def get_header(self, fields):
+        return '['
+
+    def get_footer(self):
+        return ']'
+
+    def encode_objects(self, fields, rows):
+        keys = ['%s: ' % self.encode(field) for field in fields]
+        encode = self.encode
+
+        return [
+            '{%s}' % ', '.join([key + encode(value) for key, value in zip(keys, row)])
+            for row in rows
+        ]
+
+    def encode_rows(self, fields, rows):
+        return ', '.join(self.encode_objects(fields, rows))
 
 
 class CSVS3Writer(BaseS3Writer):
     file_format = 'csv'
 
-    def prepare(self, data):
-        output = StringIO.StringIO()
-        writer = csv.writer(output)
+    def encode_row(self, row):
+        return [
+            value.encode('utf-8') if isinstance(value, unicode) else value
+            for value in row
+        ]
 
-        labels = data[0].keys()
-        writer.writerow(labels)
+    def get_header(self, fields):
+        return self.encode_rows(fields, [fields])
 
-        for row in data:
-            writer.writerow(row.values())
+    def encode_rows(self, fields, rows):
+        output = StringIO.StringIO()
+        writer = csv.writer(output)
+        writer.writerows(self.encode_row(row) for row in rows)
 
         output_content = output.getvalue()
         output.close()
@@ -152,43 +474,176 @@ class CSVS3Writer(BaseS3Writer):
         return output_content
 
 
+class NDJSONS3Writer(JSONS3Writer):
+    file_format = 'ndjson'
+    content_type = 'application/x-ndjson'
+    row_separator = ''
+
+    def get_header(self, fields):
+        return ''
+
+    def get_footer(self):
+        return ''
+
+    def encode_rows(self, fields, rows):
+        return ''.join(
+            encoded + '\n' for encoded in self.encode_objects(fields, rows))
+
+
+S3_WRITERS = dict(
+    (writer.file_format, writer) for writer in (JSONS3Writer, NDJSONS3Writer, CSVS3Writer))
+
+
+class S3Writer(BaseTask):
+    """Write a stored dataset in several formats in one pass"""
+
+    def handle(self, bucket_name, output_paths, data_key, flush=None):
+        """
+        flush is the (handler name, duration, block, segment, path_prefix)
+        of a segment, registered in its handler's manifest once written.
+        """
+        try:
+            data = load_writer_data(data_key)
+            write_outputs(bucket_name, [
+                (S3_WRITERS[file_format](), output_path)
+                for file_format, output_path in output_paths
+            ], data)
+        finally:
+            release_writer_data(data_key)
+
+        if flush:
+            handler_name, duration, block, segment, path_prefix = flush
+            S3_HANDLERS[handler_name]().finish_flush(
+                get_bucket(bucket_name), duration, block, segment, [path_prefix])
+
+        return {
+            'formats': [file_format for file_format, output_path in output_paths],
+            'count': len(data),
+            'bucket': bucket_name,
+            'output_paths': [output_path for file_format, output_path in output_paths],
+        }
+
+
 # Handlers
+class PartialWriteError(Exception):
+    """Some outputs of a flush were written, path_prefixes lists them"""
+
+    def __init__(self, path_prefixes, errors):
+        super(PartialWriteError, self).__init__('Unable to write %s' % ', '.join(
+            '%s (%s)' % (path_prefix, error) for path_prefix, error in sorted(errors.items())))
+        self.path_prefixes = path_prefixes
+        self.errors = errors
+
+
+def partition_data(data, field):
+    if not isinstance(data, BlockData):
+        data = BlockData.from_readings(data)
+    return data.partition(field)
+
+
+class BlockContext(object):
+    """Block readings loaded once and shared between handlers"""
+
+    def __init__(self, block_key, duration, block):
+        self.block_key = block_key
+        self.duration = duration
+        self.block = block
+        self.new_data = None
+        self.existing_data = {}
+        self.merged_data = {}
+
+
 class DataHandler(BaseTask):
     bucket = None
+    read_manifest_name = 'sharing'
     read_sharing_type = 'combined'
     read_sharing_label = readings_choices.SHARING_PRIVATE
 
     def load_block_data(self, block_key):
-        block_data = REDIS.lrange(block_key, 0, -1)
-        return [pickle.loads(datum) for datum in block_data]
+        # Blocks queued before they were kept in sorted sets are lists
+        if REDIS.type(block_key) == 'list':
+            block_data = REDIS.lrange(block_key, 0, -1)
+        else:
+            block_data = REDIS.zrange(block_key, 0, -1)
+
+        return BlockData.from_readings(
+            decode_block_reading(datum) for datum in block_data
+        ).sort(READING_KEY_FIELDS)
 
     def merge_data(self, existing_data, new_data):
-        existing_dict = dict(
-            [(hash_dict(record), record) for record in existing_data])
-        new_dict = dict([(hash_dict(record), record) for record in new_data])
+        # Files written before blocks were kept sorted are sorted here
+        return BlockData.merge(
+            existing_data.sort(READING_KEY_FIELDS),
+            new_data.sort(READING_KEY_FIELDS),
+            READING_KEY_FIELDS,
+        )
+
+    def load_output_data(self, bucket, duration, block, path_prefix, segments):
+        input_files = [
+            get_file_path('json', duration, block, path_prefix=path_prefix)
+        ] + [
+            get_segment_path('json', duration, block, segment, path_prefix=path_prefix)
+            for segment in segments
+        ]
 
-        existing_dict.update(new_dict)
+        data = None
+        for input_file in input_files:
+            content = read_from_bucket(bucket, input_file)
 
-        return existing_dict.values()
+            if content:
+                file_data = BlockData.from_readings(
+                    json.loads(content)).sort(READING_KEY_FIELDS)
+                data = self.merge_data(data, file_data) if data else file_data
+
+        return data
 
     def load_existing_data(self, duration, block):
         path_prefix = '{type}/{label}'.format(
             type=self.read_sharing_type,
             label=self.read_sharing_label
         )
-        input_file = get_file_path(
-            'json',
+        bucket = get_bucket(self.bucket)
+        manifest = read_manifest(
+            bucket, self.read_manifest_name, duration, block)
+
+        return self.load_output_data(
+            bucket,
             duration,
             block,
-            path_prefix=path_prefix
+            path_prefix,
+            get_pending_segments(manifest, path_prefix),
         )
 
-        existing_content = read_from_bucket(
-            get_bucket(self.bucket),
-            input_file,
+    def get_existing_source(self):
+        return (self.bucket, self.read_sharing_type, self.read_sharing_label)
+
+    def load_new_data(self, context):
+        if context.new_data is None:
+            context.new_data = self.load_block_data(context.block_key)
+
+        return context.new_data
+
+    def load_context(self, context):
+        new_data = self.load_new_data(context)
+
+        source = self.get_existing_source()
+        if source not in context.merged_data:
+            existing_data = self.load_existing_data(
+                context.duration, context.block)
+
+            if existing_data:
+                all_data = self.merge_data(existing_data, new_data)
+            else:
+                all_data = new_data
+
+            context.existing_data[source] = existing_data
+            context.merged_data[source] = all_data
+
+        return (
+            new_data,
+            context.existing_data[source],
+            context.merged_data[source],
         )
-        if existing_content:
-            return json.loads(existing_content)
 
     def process_data(self, data):
         return data
@@ -196,15 +651,9 @@ class DataHandler(BaseTask):
     def write_data(self, duration, block, data):
         raise NotImplementedError
 
-    def handle(self, block_key, duration, block):
-        new_data = self.load_block_data(block_key)
-
-        existing_data = self.load_existing_data(duration, block)
-
-        if existing_data:
-            all_data = self.merge_data(existing_data, new_data)
-        else:
-            all_data = new_data
+    def handle_context(self, context):
+        new_data, existing_data, all_data = self.load_context(context)
+        duration, block = context.duration, context.block
 
         processed_data = self.process_data(all_data)
 
@@ -220,6 +669,9 @@ class DataHandler(BaseTask):
             'bucket': self.bucket,
         }
 
+    def handle(self, block_key, duration, block):
+        return self.handle_context(BlockContext(block_key, duration, block))
+
 
 class S3Handler(DataHandler):
     durations = reduce(set.union, map(set, settings.LOG_DURATIONS.values()))
@@ -229,22 +681,225 @@ class S3Handler(DataHandler):
         CSVS3Writer,
     ]
 
-    def write_data(self, duration, block, data):
+    manifest_name = None
+
+    def get_output_path(self, writer, duration, block, path_prefix, segment=None):
+        if segment:
+            return get_segment_path(
+                writer.file_format, duration, block, segment, path_prefix=path_prefix)
+
+        return get_file_path(
+            writer.file_format, duration, block, path_prefix=path_prefix)
+
+    def get_writer(self, file_format):
         for writer in self.writers:
-            output_path = get_file_path(writer.file_format, duration, block)
-            writer().delay(self.bucket, output_path, data)
+            if writer.file_format == file_format:
+                return writer
+
+    def write_output(self, duration, block, data, path_prefix='', segment=None):
+        data_key = store_writer_data(data, 1)
+
+        # A segment is registered by its writer once its files are uploaded,
+        # so compaction never sees a segment that isn't there yet
+        flush = None
+        if segment:
+            flush = (self.__class__.__name__, duration, block, segment, path_prefix)
+
+        S3Writer().delay(self.bucket, [
+            (writer.file_format, self.get_output_path(
+                writer, duration, block, path_prefix, segment))
+            for writer in self.writers
+        ], data_key, flush)
+
+        return path_prefix
+
+    def get_path_prefixes(self, duration, data):
+        return ['']
+
+    def write_data(self, duration, block, data, segment=None):
+        return [self.write_output(duration, block, data, segment=segment)]
+
+    def get_manifest_lock(self, duration, block):
+        return REDIS.lock(
+            'manifest-lock:{bucket}:{name}:{duration}:{block}'.format(
+                bucket=self.bucket,
+                name=self.manifest_name,
+                duration=duration,
+                block=block,
+            ),
+            timeout=settings.MANIFEST_LOCK_TIMEOUT,
+        )
+
+    def has_block_files(self, bucket, duration, block, path_prefixes):
+        """
+        Whether block files this flush would overwrite were written before
+        the block had a manifest.
+        """
+        file_format = self.writers[0].file_format
+        return any(
+            bucket.get_key(get_file_path(
+                file_format, duration, block, path_prefix=path_prefix)) is not None
+            for path_prefix in path_prefixes
+        )
+
+    def start_flush(self, bucket, duration, block, segment, path_prefixes):
+        """
+        Returns the segment this flush should write to, or None when it is
+        the first flush of the block and can write the block files directly.
+        """
+        with self.get_manifest_lock(duration, block):
+            if read_manifest(bucket, self.manifest_name, duration, block) is None:
+                write_manifest(
+                    bucket, self.manifest_name, duration, block, {'segments': []})
+
+                # Block files written without a manifest are kept, the
+                # flush is merged into them as a segment
+                if not self.has_block_files(bucket, duration, block, path_prefixes):
+                    return None
+
+        return segment
+
+    def finish_flush(self, bucket, duration, block, segment, path_prefixes):
+        """Register the written path prefixes of a segment for compaction"""
+        with self.get_manifest_lock(duration, block):
+            manifest = read_manifest(
+                bucket, self.manifest_name, duration, block) or {'segments': []}
+
+            for entry in manifest['segments']:
+                if entry[0] == segment:
+                    entry[1].extend(
+                        path_prefix for path_prefix in path_prefixes
+                        if path_prefix not in entry[1])
+                    break
+            else:
+                manifest['segments'].append([segment, list(path_prefixes)])
+
+            write_manifest(bucket, self.manifest_name, duration, block, manifest)
+
+        self.schedule_compaction(duration, block)
+
+    def schedule_compaction(self, duration, block, score=None):
+        if score is None:
+            score = int(block) + DURATION_TIMES[duration] + settings.BLOCK_COMPACTION_DELAY
+
+        REDIS.zadd(COMPACTION_REGISTRY_KEY, score, get_block_key(duration, block))
+
+    def handle_context(self, context):
+        duration, block = context.duration, context.block
+        new_data = self.load_new_data(context)
+        bucket = get_bucket(self.bucket)
+
+        processed_data = self.process_data(new_data)
+        segment = self.start_flush(
+            bucket, duration, block, context.block_key,
+            self.get_path_prefixes(duration, processed_data))
+
+        self.write_data(duration, block, processed_data, segment)
+
+        return {
+            'duration': duration,
+            'block': block,
+            'new_data': len(new_data),
+            'processed_data': len(processed_data),
+            'segment': segment,
+            'bucket': self.bucket,
+        }
+
+    def resolve_output(self, duration, block, file_format, path_prefix):
+        """
+        Returns the path of a block file that is up to date, or the merged
+        content of the block when it still has uncompacted segments.
+        """
+        bucket = get_bucket(self.bucket)
+        manifest = read_manifest(bucket, self.manifest_name, duration, block)
+        segments = get_pending_segments(manifest, path_prefix)
+        writer = self.get_writer(file_format)
+
+        if not (segments and writer):
+            return get_file_path(file_format, duration, block, path_prefix=path_prefix), None
+
+        data = self.load_output_data(bucket, duration, block, path_prefix, segments)
+        return None, (writer().prepare(data) if data else None)
+
+    def compact(self, duration, block):
+        bucket = get_bucket(self.bucket)
+        manifest = read_manifest(bucket, self.manifest_name, duration, block)
+        if not (manifest and manifest['segments']):
+            return 0
+
+        # Segments whose files are missing stay registered for a later run
+        file_format = self.writers[0].file_format
+        compacted = set()
+        missing = set()
+        for segment, segment_prefixes in manifest['segments']:
+            for path_prefix in segment_prefixes:
+                segment_path = get_segment_path(
+                    file_format, duration, block, segment, path_prefix=path_prefix)
+                if bucket.get_key(segment_path) is None:
+                    missing.add((segment, path_prefix))
+                else:
+                    compacted.add((segment, path_prefix))
+
+        for path_prefix in set(path_prefix for segment, path_prefix in compacted):
+            data = self.load_output_data(
+                bucket,
+                duration,
+                block,
+                path_prefix,
+                [segment for segment in get_pending_segments(manifest, path_prefix)
+                 if (segment, path_prefix) in compacted],
+            )
+
+            if data:
+                write_outputs(self.bucket, [
+                    (writer(), self.get_output_path(writer, duration, block, path_prefix))
+                    for writer in self.writers
+                ], data)
+
+        with self.get_manifest_lock(duration, block):
+            manifest = read_manifest(bucket, self.manifest_name, duration, block)
+            segments = []
+            for segment, segment_prefixes in manifest['segments']:
+                remaining = [
+                    path_prefix for path_prefix in segment_prefixes
+                    if (segment, path_prefix) not in compacted
+                ]
+                if remaining:
+                    segments.append([segment, remaining])
+            manifest['segments'] = segments
+            write_manifest(bucket, self.manifest_name, duration, block, manifest)
+
+        if compacted:
+            bucket.delete_keys([
+                self.get_output_path(writer, duration, block, path_prefix, segment)
+                for segment, path_prefix in compacted
+                for writer in self.writers
+            ])
+
+        if missing:
+            self.schedule_compaction(
+                duration, block, int(time.time() * 1000) + settings.BLOCK_COMPACTION_DELAY)
+
+        return len(set(segment for segment, path_prefix in compacted))
 
 
 class S3SharingHandler(S3Handler):
 
-    def write_data(self, duration, block, data):
+    def get_sharing_labels(self):
+        return set(chain.from_iterable(
+            chain.from_iterable(self.sharing_types.values())))
+
+    def get_sharing_outputs(self, duration, data):
+        """Yield the (path_prefix, data) of each sharing file of the block"""
+        partitions = partition_data(data, 'sharing')
+
         for sharing_type, sharing_label_groups in self.sharing_types.items():
             if duration in self.sharing_durations[sharing_type]:
                 for sharing_labels in sharing_label_groups:
-                    filtered_data = [
-                        datum for datum in data
-                        if datum['sharing'] in sharing_labels
-                    ]
+                    filtered_data = BlockData.concatenate([
+                        partitions[label]
+                        for label in sharing_labels if label in partitions
+                    ])
 
                     if filtered_data:
                         path_label = sharing_labels[-1]
@@ -253,29 +908,35 @@ class S3SharingHandler(S3Handler):
                             label=path_label
                         )
 
-                        for writer in self.writers:
-                            output_path = get_file_path(
-                                writer.file_format,
-                                duration,
-                                block,
-                                path_prefix=path_prefix
-                            )
-                            writer().delay(self.bucket, output_path, filtered_data)
+                        yield path_prefix, filtered_data
+
+    def get_path_prefixes(self, duration, data):
+        return [
+            path_prefix for path_prefix, filtered_data
+            in self.get_sharing_outputs(duration, data)
+        ]
+
+    def write_data(self, duration, block, data, segment=None):
+        return [
+            self.write_output(duration, block, filtered_data, path_prefix, segment)
+            for path_prefix, filtered_data in self.get_sharing_outputs(duration, data)
+        ]
 
 
 class S3FieldFilteredHandler(S3SharingHandler):
 
     def process_data(self, data):
         if self.allowed_fields:
-            filtered_data = []
+            partitions = partition_data(data, 'sharing')
+            filtered_partitions = dict(
+                (label, partitions[label].project(self.allowed_fields))
+                for label in self.get_sharing_labels() if label in partitions
+            )
 
-            for data_point in data:
-                filtered_data_point = dict([
-                    (field, value) for (field, value) in data_point.items()
-                    if field in self.allowed_fields
-                ])
-
-                filtered_data.append(filtered_data_point)
+            # Keep the sharing partitions so write_data doesn't need
+            # the sharing field to survive the projection.
+            filtered_data = BlockData.concatenate(filtered_partitions.values())
+            filtered_data.partitions['sharing'] = filtered_partitions
 
         else:
             filtered_data = data
@@ -285,25 +946,77 @@ class S3FieldFilteredHandler(S3SharingHandler):
 
 class S3UserHandler(S3Handler):
     durations = ('daily',)
-
-    def write_data(self, duration, block, data):
-        user_ids = set([datum['user_id'] for datum in data])
-        for user_id in user_ids:
-            user_data = [datum for datum in data if datum['user_id'] == user_id]
-            path_prefix = 'user/{user_id}'.format(user_id=user_id)
-
-            for writer in self.writers:
-                output_path = get_file_path(
-                    writer.file_format,
-                    duration,
-                    block,
-                    path_prefix=path_prefix
-                )
-                writer().delay(self.bucket, output_path, user_data)
+    write_concurrency = settings.USER_WRITE_CONCURRENCY
+    write_retries = settings.USER_WRITE_RETRIES
+
+    def write_user_data(self, duration, block, path_prefix, user_data, segment):
+        write_outputs(self.bucket, [
+            (writer(), self.get_output_path(writer, duration, block, path_prefix, segment))
+            for writer in self.writers
+        ], user_data)
+
+    def get_user_prefix(self, user_id):
+        return 'user/{user_id}'.format(user_id=user_id)
+
+    def get_path_prefixes(self, duration, data):
+        return [
+            self.get_user_prefix(user_id)
+            for user_id in partition_data(data, 'user_id')
+        ]
+
+    def write_data(self, duration, block, data, segment=None):
+        # Each user's slice is written straight from this task rather than
+        # through the broker, with at most write_concurrency S3 uploads
+        # in flight at a time.
+        partitions = partition_data(data, 'user_id')
+        pending = dict(
+            (self.get_user_prefix(user_id), user_data)
+            for user_id, user_data in partitions.items()
+        )
+        path_prefixes = []
+        errors = {}
+
+        def write_partition(partition):
+            path_prefix, user_data = partition
+            try:
+                self.write_user_data(duration, block, path_prefix, user_data, segment)
+                return path_prefix, None
+            except Exception, e:
+                return path_prefix, e
+
+        pool = ThreadPool(self.write_concurrency)
+        try:
+            # Only the users whose uploads failed are retried
+            for attempt in range(self.write_retries + 1):
+                errors = {}
+                for path_prefix, error in pool.imap_unordered(
+                        write_partition, pending.items()):
+                    if error is None:
+                        path_prefixes.append(path_prefix)
+                        del pending[path_prefix]
+                    else:
+                        errors[path_prefix] = error
+
+                if not pending:
+                    break
+        finally:
+            pool.close()
+            pool.join()
+
+        # The uploads are done, the written ones are registered even when
+        # others failed
+        if segment and path_prefixes:
+            self.finish_flush(get_bucket(self.bucket), duration, block, segment, path_prefixes)
+
+        if errors:
+            raise PartialWriteError(path_prefixes, errors)
+
+        return path_prefixes
 
 
 class PrivateS3Handler(S3SharingHandler):
     bucket = settings.S3_PRIVATE_BUCKET
+    manifest_name = 'sharing'
     sharing_types = {
         'split': [
             [label] for label in ALL_SHARING_LABELS
@@ -317,19 +1030,29 @@ class PrivateS3Handler(S3SharingHandler):
 
 class PrivateS3UserHandler(S3UserHandler):
     bucket = settings.S3_PRIVATE_BUCKET
+    manifest_name = 'user'
 
 
 class PublicS3Handler(S3FieldFilteredHandler):
     bucket = settings.S3_PUBLIC_BUCKET
+    manifest_name = 'public'
     allowed_fields = ReadingListSerializer.Meta.fields
     sharing_types = {
         'combined': [[readings_choices.SHARING_PUBLIC]],
     }
 
 
+S3_HANDLERS = dict(
+    (handler.__name__, handler)
+    for handler in (PrivateS3Handler, PrivateS3UserHandler, PublicS3Handler))
+
+
 class DynamoDBHandler(DataHandler):
     durations = settings.STATISTICS_DURATIONS
     bucket = settings.S3_PRIVATE_BUCKET
+    geohash_precision = 5
+    rollup_expire = 2 * 24 * 60 * 60
+    fingerprints_expire = 2 * 24 * 60 * 60
 
     @cached_property
     def conn(self):
@@ -337,90 +1060,481 @@ class DynamoDBHandler(DataHandler):
 
     @cached_property
     def table(self):
-        return self.conn.get_table(settings.DYNAMODB_TABLE)
+        return get_table(self.conn)
+
+    def encode_summaries(self, summaries):
+        """
+        Encode each summary on its own, a summary that cannot be encoded
+        leaves only its cell without one.
+        """
+        encoded = []
+        for summary in summaries:
+            try:
+                encoded.append(encode_summary(summary))
+            except Exception, e:
+                self.log(error='Unable to encode summary: %s' % e)
+                encoded.append(None)
+
+        return encoded
 
     def process_data(self, data):
-        geo_sorted = defaultdict(list)
+        # Infinite and NaN readings have no statistics
+        if data:
+            data = data.filter(numpy.isfinite(data.get_column('reading')))
 
-        for data_point in data:
-            for geo_key_length in range(1, 6):
-                geo_key = geohash.encode(
-                    data_point['latitude'],
-                    data_point['longitude'],
-                    precision=geo_key_length,
-                )
-                geo_sorted[geo_key].append(data_point)
+        if not data:
+            return {}
 
-        statistics = {}
+        precision = self.geohash_precision
+        precision_shift = numpy.uint64(5 * precision)
 
-        for geo_key, data_points in geo_sorted.items():
-            readings = [data_point['reading'] for data_point in data_points]
-            unique_users = len(
-                set([data_point['user_id'] for data_point in data_points]))
-
-            statistics[geo_key] = {
-                'min': min(readings),
-                'max': max(readings),
-                'mean': mean(readings),
-                'median': median(readings),
-                'std_dev': std_dev(readings),
-                'samples': len(readings),
-                'users': unique_users,
-            }
+        cells = geohash.encode_int_many(
+            data.get_column('latitude'),
+            data.get_column('longitude'),
+            bits=5 * precision,
+        )
+
+        # Key each reading once per geohash precision, tagging the keys
+        # with their precision so every precision is grouped in one pass.
+        keys = numpy.concatenate([
+            (cells >> numpy.uint64(5 * (precision - key_precision))) |
+            (numpy.uint64(key_precision) << precision_shift)
+            for key_precision in range(1, precision + 1)
+        ])
+
+        # Users are grouped by their dictionary codes, only the summaries
+        # need the user ids themselves
+        user_values, user_codes = data.get_dictionary('user_id')
+        readings = numpy.tile(data.get_column('reading'), precision)
+        users = numpy.tile(user_codes, precision)
+
+        group_keys, group_stats = group_statistics(keys, readings, users)
+        group_stats['summary'] = numpy.array(self.encode_summaries(
+            group_summaries(keys, readings, users, user_values)[1]), dtype=object)
+
+        key_precisions = group_keys >> precision_shift
+        key_cells = group_keys & numpy.uint64((1 << (5 * precision)) - 1)
+        geo_keys = numpy.empty(len(group_keys), dtype=object)
+
+        for key_precision in range(1, precision + 1):
+            precision_mask = key_precisions == key_precision
+            geo_keys[precision_mask] = geohash.int_to_geohash(
+                key_cells[precision_mask], key_precision)
+
+        columns = dict(
+            (name, column.tolist()) for name, column in group_stats.items())
+
+        return dict(
+            (geo_key, dict(
+                (name, column[index]) for name, column in columns.items()
+                if column[index] is not None))
+            for index, geo_key in enumerate(geo_keys)
+        )
+
+    def get_fingerprints_key(self, duration, block):
+        return 'statistics-fingerprints:%s:%s' % (duration, block)
 
-        return statistics
+    def get_fingerprint(self, stats):
+        return hashlib.md5(json.dumps(stats, sort_keys=True)).hexdigest()
+
+    def get_changed_data(self, duration, block, data):
+        """
+        Drop the geohash statistics identical to those last written for
+        this block, returning the rest with their fingerprints.
+        """
+        geo_keys = data.keys()
+        fingerprints = [self.get_fingerprint(data[geo_key]) for geo_key in geo_keys]
+
+        written_fingerprints = REDIS.hmget(
+            self.get_fingerprints_key(duration, block), geo_keys) if geo_keys else []
+
+        return dict(
+            (geo_key, (data[geo_key], fingerprint))
+            for geo_key, fingerprint, written_fingerprint
+            in zip(geo_keys, fingerprints, written_fingerprints)
+            if fingerprint != written_fingerprint
+        )
 
     def write_data(self, duration, block, data):
+        changed_data = self.get_changed_data(duration, block, data)
+
         put_items = [
             self.table.new_item(
                 hash_key='%s-%s' % (duration, geo_key),
                 range_key=int(block),
                 attrs=stats,
-            ) for geo_key, stats in data.items()]
+            ) for geo_key, (stats, fingerprint) in changed_data.items()]
+
+        failed_items = write_all_items(
+            self.table,
+            put_items,
+            concurrency=settings.DYNAMODB_WRITE_CONCURRENCY,
+            retries=settings.DYNAMODB_WRITE_RETRIES,
+            backoff=settings.DYNAMODB_WRITE_BACKOFF,
+        )
+        delete_cached_items(
+            self.table, [(item.hash_key, item.range_key) for item in put_items])
+        failed_keys = set(item.hash_key for item in failed_items)
+
+        written_fingerprints = dict(
+            (geo_key, fingerprint)
+            for geo_key, (stats, fingerprint) in changed_data.items()
+            if '%s-%s' % (duration, geo_key) not in failed_keys
+        )
+        if written_fingerprints:
+            fingerprints_key = self.get_fingerprints_key(duration, block)
+            pipe = REDIS.pipeline(transaction=True)
+            pipe.hmset(fingerprints_key, written_fingerprints)
+            pipe.expire(fingerprints_key, self.fingerprints_expire)
+            pipe.execute()
+
+        if written_fingerprints and duration == settings.ROLLUP_SOURCE_DURATION:
+            self.register_rollups(block, written_fingerprints.keys())
+
+        self.log(
+            duration=duration,
+            block=block,
+            statistics=len(data),
+            unchanged=len(data) - len(changed_data),
+            written=len(written_fingerprints),
+            failed=len(failed_items),
+        )
+
+    def register_rollups(self, block, geo_keys):
+        pipe = REDIS.pipeline(transaction=True)
+
+        for rollup_duration, rollup_time in settings.ROLLUP_DURATIONS:
+            rollup_block = int(block) - int(block) % rollup_time
+            rollup_key = get_rollup_key(rollup_duration, rollup_block)
+
+            pipe.sadd(rollup_key, *geo_keys)
+            pipe.expire(rollup_key, self.rollup_expire)
+            pipe.zadd(
+                ROLLUP_REGISTRY_KEY,
+                rollup_block + rollup_time + settings.ROLLUP_DELAY,
+                rollup_key,
+            )
+
+        pipe.execute()
+
+
+class StatisticsRollup(DynamoDBHandler):
+    """
+    Derive the statistics of a longer duration by merging the stored
+    summaries of the ROLLUP_SOURCE_DURATION blocks it covers.
+    """
+    durations = [duration for duration, duration_time in settings.ROLLUP_DURATIONS]
+    source_duration = settings.ROLLUP_SOURCE_DURATION
+
+    def load_summaries(self, duration, block, geo_keys):
+        duration_time = dict(settings.ROLLUP_DURATIONS)[duration]
+        source_time = DURATION_TIMES[self.source_duration]
+        source_blocks = range(int(block), int(block) + duration_time, source_time)
 
-        for batch_items in group_by(put_items, 25):
-            write_items(self.conn, self.table, batch_items)
+        keys = [
+            ('%s-%s' % (self.source_duration, geo_key), source_block)
+            for geo_key in geo_keys
+            for source_block in source_blocks
+        ]
+
+        summaries = defaultdict(Summary)
+        for item in get_all_items(self.conn, self.table, keys):
+            if 'summary' in item:
+                geo_key = item[self.table.schema.hash_key_name].split('-', 1)[1]
+                summaries[geo_key].merge(decode_summary(item['summary']))
+
+        return summaries
+
+    def handle(self, rollup_key, duration, block):
+        geo_keys = REDIS.smembers(rollup_key)
+        summaries = self.load_summaries(duration, block, geo_keys)
+
+        statistics = {}
+        for geo_key, summary in summaries.items():
+            statistics[geo_key] = summary.finalize()
+
+            encoded_summary = self.encode_summaries([summary])[0]
+            if encoded_summary:
+                statistics[geo_key]['summary'] = encoded_summary
+
+        self.write_data(duration, block, statistics)
+        REDIS.delete(rollup_key)
+
+        return {
+            'duration': duration,
+            'block': block,
+            'geo_keys': len(geo_keys),
+            'rolled_up': len(statistics),
+        }
 
 
 class BlockSorter(BaseTask):
 
-    def write_to_redis(self, duration, block, reading):
-        block_key = get_block_key(duration, block)
-        pickled_reading = pickle.dumps(reading)
-        REDIS.lpush(block_key, pickled_reading)
+    def write_to_redis(self, pipe, block_key, reading_date, encoded_reading):
+        # Blocks are sorted sets scored by daterecorded, so they are read
+        # back in time order and identical readings are stored once.
+        pipe.zadd(block_key, reading_date, encoded_reading)
+
+    def register_blocks(self, pipe, block_ends):
+        for block_key, block_end in block_ends.items():
+            pipe.zadd(BLOCK_REGISTRY_KEY, block_end, block_key)
+
+    def sort_readings(self, readings):
+        pipe = REDIS.pipeline(transaction=True)
+        block_ends = {}
+
+        for reading in readings:
+            reading_date = reading['daterecorded']
+            encoded_reading = encode_block_reading(reading)
+
+            for duration, duration_time in settings.ALL_DURATIONS:
+                reading_date_offset = reading_date % duration_time
+                block = reading_date - reading_date_offset
+                block_key = get_block_key(duration, block)
+
+                self.write_to_redis(pipe, block_key, reading_date, encoded_reading)
+                block_ends[block_key] = block + duration_time
+
+        self.register_blocks(pipe, block_ends)
+        pipe.execute()
 
     def handle(self, reading):
-        reading_date = reading['daterecorded']
+        self.sort_readings([reading])
 
-        for duration, duration_time in settings.ALL_DURATIONS:
-            reading_date_offset = reading_date % duration_time
-            block = reading_date - reading_date_offset
 
-            self.write_to_redis(duration, block, reading)
+class BatchBlockSorter(BlockSorter):
 
+    def handle(self, readings):
+        self.sort_readings(readings)
 
-class BlockHandler(BaseTask):
+        return {
+            'count': len(readings),
+        }
+
+
+class BlockProcessor(BaseTask):
     handlers = (
         PrivateS3Handler,
+        PrivateS3UserHandler,
         #PublicS3Handler,
         DynamoDBHandler,
     )
+
+    @classmethod
+    def get_handlers(cls, duration):
+        return [
+            handler for handler in cls.handlers
+            if duration in handler.durations
+        ]
+
+    def run_handler(self, handler, context):
+        start = time.time()
+
+        try:
+            log_info = handler().handle_context(context)
+            log_info['success'] = True
+        except Exception, e:
+            log_info = {
+                'success': False,
+                'error': str(e),
+                'traceback': str(traceback.format_exc()),
+            }
+
+        log_info['time'] = time.time() - start
+
+        return log_info
+
+    def handle(self, block_key, duration, block):
+        context = BlockContext(block_key, duration, block)
+
+        handler_logs = dict(
+            (handler.__name__, self.run_handler(handler, context))
+            for handler in self.get_handlers(duration)
+        )
+
+        return {
+            'duration': duration,
+            'block': block,
+            'new_data': len(context.new_data or []),
+            'handlers': handler_logs,
+        }
+
+
+class BlockHandler(BaseTask):
+    processor = BlockProcessor
     block_expire = 60 * 60
 
     def handle(self):
-        handled_keys = []
-        for key in REDIS.keys():
-            if is_block_key(key):
-                self.handle_block(key)
-                handled_keys.append(key)
+        now = int(time.time() * 1000)
+        due_keys = REDIS.zrangebyscore(BLOCK_REGISTRY_KEY, '-inf', now)
+
+        handled_keys = [
+            block_key for block_key in due_keys
+            if self.handle_block(block_key)
+        ]
+
+        return {
+            'due_blocks': len(due_keys),
+            'handled_blocks': len(handled_keys),
+        }
 
     def handle_block(self, block_key):
         duration, block = unpack_block_key(block_key)
         new_block_key = str(uuid.uuid4())
 
-        REDIS.rename(block_key, new_block_key)
-        REDIS.expire(new_block_key, self.block_expire)
+        claimed = claim_block(
+            keys=[BLOCK_REGISTRY_KEY, block_key, new_block_key],
+            args=[self.block_expire],
+        )
+        if not claimed:
+            return False
 
-        for handler in self.handlers:
-            if duration in handler.durations:
-                handler().delay(new_block_key, duration, block)
+        if self.processor.get_handlers(duration):
+            self.processor().delay(new_block_key, duration, block)
+
+        return True
+
+
+class BlockCompactor(BaseTask):
+    processor = BlockProcessor
+
+    def handle(self, duration, block):
+        compacted_segments = dict(
+            (handler.__name__, handler().compact(duration, block))
+            for handler in self.processor.get_handlers(duration)
+            if issubclass(handler, S3Handler)
+        )
+
+        return {
+            'duration': duration,
+            'block': block,
+            'compacted_segments': compacted_segments,
+        }
+
+
+class CompactionHandler(BaseTask):
+    compactor = BlockCompactor
+
+    def handle(self):
+        now = int(time.time() * 1000)
+        due_keys = REDIS.zrangebyscore(COMPACTION_REGISTRY_KEY, '-inf', now)
+
+        claimed_keys = [
+            block_key for block_key in due_keys
+            if REDIS.zrem(COMPACTION_REGISTRY_KEY, block_key)
+        ]
+
+        for block_key in claimed_keys:
+            duration, block = unpack_block_key(block_key)
+            self.compactor().delay(duration, block)
+
+        return {
+            'due_blocks': len(due_keys),
+            'compacted_blocks': len(claimed_keys),
+        }
+
+
+class RollupHandler(BaseTask):
+    rollup = StatisticsRollup
+    rollup_expire = 60 * 60
+
+    def handle(self):
+        now = int(time.time() * 1000)
+        due_keys = REDIS.zrangebyscore(ROLLUP_REGISTRY_KEY, '-inf', now)
+
+        claimed_keys = 0
+        for rollup_key in due_keys:
+            duration, block = unpack_block_key(rollup_key)
+            new_rollup_key = str(uuid.uuid4())
+
+            claimed = claim_block(
+                keys=[ROLLUP_REGISTRY_KEY, rollup_key, new_rollup_key],
+                args=[self.rollup_expire],
+            )
+            if claimed:
+                self.rollup().delay(new_rollup_key, duration, block)
+                claimed_keys += 1
+
+        return {
+            'due_rollups': len(due_keys),
+            'claimed_rollups': claimed_keys,
+        }
+
+
+class CallLogWriter(BaseTask):
+
+    def pop_call_logs(self):
+        pipe = REDIS.pipeline()
+        pipe.lrange(CALL_LOG_BUFFER_KEY, 0, settings.CALL_LOG_BATCH_SIZE - 1)
+        pipe.ltrim(CALL_LOG_BUFFER_KEY, settings.CALL_LOG_BATCH_SIZE, -1)
+        return pipe.execute()[0]
+
+    def write_call_logs(self, call_logs):
+        with transaction.commit_on_success():
+            CustomerCallLog.objects.bulk_create([
+                CustomerCallLog(**pickle.loads(call_log))
+                for call_log in call_logs
+            ])
+
+    def write_each_call_log(self, call_logs):
+        """
+        Write call logs one at a time, quarantining the ones that fail.
+        Returns the failed call logs.
+        """
+        failed_logs = []
+        for call_log in call_logs:
+            try:
+                self.write_call_logs([call_log])
+            except Exception, e:
+                self.log(error='Unable to write call log: %s' % e)
+                failed_logs.append(call_log)
+
+        if failed_logs:
+            pipe = REDIS.pipeline(transaction=True)
+            pipe.rpush(CALL_LOG_QUARANTINE_KEY, *failed_logs)
+            pipe.ltrim(CALL_LOG_QUARANTINE_KEY, -settings.CALL_LOG_BUFFER_SIZE, -1)
+            pipe.incrby(CALL_LOG_QUARANTINED_KEY, len(failed_logs))
+            pipe.execute()
+
+        return failed_logs
+
+    def is_database_available(self):
+        try:
+            connection.cursor().execute('SELECT 1')
+            return True
+        except Exception:
+            return False
+
+    def handle(self):
+        written_logs = 0
+        quarantined_logs = 0
+
+        while True:
+            call_logs = self.pop_call_logs()
+            if not call_logs:
+                break
+
+            try:
+                self.write_call_logs(call_logs)
+                written_logs += len(call_logs)
+            except Exception:
+                if not self.is_database_available():
+                    # Put the batch back for the next writer
+                    REDIS.lpush(CALL_LOG_BUFFER_KEY, *reversed(call_logs))
+                    raise
+
+                # Some call logs can't be written, the others are written
+                # one by one and the failing ones quarantined
+                failed_logs = self.write_each_call_log(call_logs)
+                written_logs += len(call_logs) - len(failed_logs)
+                quarantined_logs += len(failed_logs)
+
+            if len(call_logs) < settings.CALL_LOG_BATCH_SIZE:
+                break
+
+        return {
+            'written_logs': written_logs,
+            'quarantined_logs': quarantined_logs,
+            'buffered_logs': REDIS.llen(CALL_LOG_BUFFER_KEY),
+            'dropped_logs': int(REDIS.get(CALL_LOG_DROPPED_KEY) or 0),
+        }
@@ -0,0 +1,317 @@
+import pickle
+from bisect import bisect_left
+from itertools import chain
+
+import numpy
+
+
+def is_number(value):
+    return isinstance(value, (int, long, float)) and not isinstance(value, bool)
+
+
+def encode_dictionary(values):
+    """
+    Dictionary encode a sequence of values, returning the distinct values
+    in order of first appearance and the code of every value.
+    """
+    dictionary = {}
+    codes = numpy.fromiter(
+        (dictionary.setdefault(value, len(dictionary)) for value in values),
+        dtype=numpy.int32,
+    )
+
+    dictionary_values = numpy.empty(len(dictionary), dtype=object)
+    for value, code in dictionary.items():
+        dictionary_values[code] = value
+
+    return dictionary_values, codes
+
+
+class BlockData(object):
+    """
+    Block readings held by column.  Numeric fields are numpy arrays and
+    every other field is dictionary encoded, an array of integer codes
+    into the distinct values of the field.
+    """
+
+    def __init__(self, fields=(), columns=None, dictionaries=None, length=0):
+        self.fields = list(fields)
+        self.columns = columns or {}
+        self.dictionaries = dictionaries or {}
+        self.length = length
+        self.partitions = {}
+
+    @classmethod
+    def from_readings(cls, readings):
+        fields = []
+        values = {}
+        length = 0
+
+        for reading in readings:
+            for field, value in reading.iteritems():
+                if field not in values:
+                    fields.append(field)
+                    values[field] = [None] * length
+                values[field].append(value)
+            length += 1
+
+            for field in fields:
+                if len(values[field]) < length:
+                    values[field].append(None)
+
+        block = cls(fields, length=length)
+        for field in fields:
+            block.set_column(field, values.pop(field))
+
+        return block
+
+    @classmethod
+    def concatenate(cls, blocks):
+        blocks = [block for block in blocks if len(block)]
+        if len(blocks) == 1:
+            return blocks[0]
+
+        fields = []
+        for block in blocks:
+            fields.extend(field for field in block.fields if field not in fields)
+
+        concatenated = cls(fields, length=sum(len(block) for block in blocks))
+
+        for field in fields:
+            if all(field in block.columns and field not in block.dictionaries
+                   for block in blocks):
+                concatenated.columns[field] = numpy.concatenate(
+                    [block.columns[field] for block in blocks])
+            else:
+                concatenated.set_dictionary_column(field, numpy.concatenate(
+                    [block.get_column(field, missing=None) for block in blocks]))
+
+        return concatenated
+
+    @classmethod
+    def merge(cls, existing, new, fields):
+        """
+        Merge two blocks sorted by the given fields into one sorted block,
+        readings of the new block replacing existing readings with the
+        same key.  Both blocks must hold distinct keys, as sort() leaves
+        them.
+        """
+        if not len(existing):
+            return new
+        if not len(new):
+            return existing
+
+        existing_keys = [existing.get_column(field) for field in fields]
+        new_keys = [new.get_column(field) for field in fields]
+
+        # Place each new reading by its first key field, only readings
+        # sharing that value with existing readings compare whole keys.
+        positions = numpy.searchsorted(existing_keys[0], new_keys[0], 'left')
+        ends = numpy.searchsorted(existing_keys[0], new_keys[0], 'right')
+        replaced = numpy.zeros(len(new), dtype=bool)
+
+        for index in numpy.flatnonzero(ends > positions):
+            start, end = positions[index], ends[index]
+            key = tuple(column[index] for column in new_keys)
+            candidates = zip(*[column[start:end].tolist() for column in existing_keys])
+
+            offset = bisect_left(candidates, key)
+            positions[index] = start + offset
+            replaced[index] = offset < len(candidates) and candidates[offset] == key
+
+        removed = positions[replaced]
+        kept = numpy.ones(len(existing), dtype=bool)
+        kept[removed] = False
+
+        # Output position of each new reading, after the kept existing
+        # readings before it and the new readings before it.
+        new_positions = (
+            positions - numpy.searchsorted(removed, positions, 'left') +
+            numpy.arange(len(new)))
+
+        is_new = numpy.zeros(len(existing) - len(removed) + len(new), dtype=bool)
+        is_new[new_positions] = True
+
+        indexes = numpy.empty(len(is_new), dtype=numpy.intp)
+        indexes[is_new] = len(existing) + numpy.arange(len(new))
+        indexes[~is_new] = numpy.flatnonzero(kept)
+
+        return cls.concatenate([existing, new]).take(indexes)
+
+    @classmethod
+    def deserialize(cls, content):
+        fields, columns, dictionaries, length = pickle.loads(content)
+        return cls(fields, columns, dictionaries, length)
+
+    def serialize(self):
+        return pickle.dumps(
+            (self.fields, self.columns, self.dictionaries, self.length),
+            pickle.HIGHEST_PROTOCOL,
+        )
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        return self.iter_dicts()
+
+    def set_column(self, field, values):
+        if values and all(is_number(value) for value in values):
+            if all(isinstance(value, (int, long)) for value in values):
+                self.columns[field] = numpy.array(values, dtype=numpy.int64)
+            else:
+                self.columns[field] = numpy.array(values, dtype=numpy.float64)
+        else:
+            self.set_dictionary_column(field, values)
+
+    def set_dictionary_column(self, field, values):
+        self.dictionaries[field], self.columns[field] = encode_dictionary(values)
+
+    def get_column(self, field, **kwargs):
+        """
+        Return the values of a field, decoding dictionary encoded fields.
+        A field the block lacks raises a KeyError unless a missing value
+        is given.
+        """
+        if field not in self.columns:
+            if 'missing' not in kwargs:
+                raise KeyError(field)
+            column = numpy.empty(self.length, dtype=object)
+            column.fill(kwargs['missing'])
+            return column
+
+        if field in self.dictionaries:
+            return self.dictionaries[field][self.columns[field]]
+        return self.columns[field]
+
+    def get_dictionary(self, field):
+        """
+        Return the distinct values of a field and the code of every
+        reading, dictionary encoding the field if it is not already.
+        """
+        if field in self.dictionaries:
+            return self.dictionaries[field], self.columns[field]
+        return encode_dictionary(self.get_column(field).tolist())
+
+    def take(self, indexes):
+        """
+        Return the readings at the given indexes, sharing the dictionaries
+        of this block.
+        """
+        return type(self)(
+            self.fields,
+            dict((field, column[indexes]) for field, column in self.columns.items()),
+            self.dictionaries,
+            len(indexes),
+        )
+
+    def filter(self, mask):
+        return self.take(numpy.flatnonzero(mask))
+
+    def project(self, fields):
+        """
+        Return the readings with only the given fields, sharing the
+        columns of this block rather than copying them.
+        """
+        fields = [field for field in self.fields if field in fields]
+        return type(self)(
+            fields,
+            dict((field, self.columns[field]) for field in fields),
+            dict((field, self.dictionaries[field])
+                 for field in fields if field in self.dictionaries),
+            self.length,
+        )
+
+    def is_sorted(self, fields):
+        if self.length < 2:
+            return True
+
+        ordered = numpy.zeros(self.length - 1, dtype=bool)
+        tied = numpy.ones(self.length - 1, dtype=bool)
+        for field in fields:
+            column = self.get_column(field)
+            ordered |= tied & (column[:-1] < column[1:])
+            tied &= column[:-1] == column[1:]
+
+        return bool(numpy.all(ordered | tied))
+
+    def sort(self, fields):
+        """
+        Return the readings sorted by the given fields, keeping only the
+        last of readings with equal keys.
+        """
+        if not self.length:
+            return self
+
+        block = self
+        if not self.is_sorted(fields):
+            # lexsort is stable, so later readings stay last among equals
+            order = numpy.lexsort([self.get_column(field) for field in reversed(fields)])
+            block = self.take(order)
+
+        duplicate = numpy.ones(block.length - 1, dtype=bool)
+        for field in fields:
+            column = block.get_column(field)
+            duplicate &= column[:-1] == column[1:]
+
+        if duplicate.any():
+            block = block.filter(numpy.append(~duplicate, True))
+
+        return block
+
+    def partition(self, field):
+        if field not in self.partitions:
+            partitions = {}
+
+            if self.length:
+                codes = self.columns[field]
+                order = numpy.argsort(codes, kind='mergesort')
+                sorted_codes = codes[order]
+                starts = numpy.flatnonzero(numpy.concatenate(
+                    ([True], sorted_codes[1:] != sorted_codes[:-1])))
+                ends = numpy.append(starts[1:], len(order))
+
+                values = self.dictionaries.get(field)
+                for start, end in zip(starts, ends):
+                    code = sorted_codes[start]
+                    value = values[code] if values is not None else code.item()
+                    partitions[value] = self.take(order[start:end])
+
+            self.partitions[field] = partitions
+
+        return self.partitions[field]
+
+    def get_values(self, field, start, end):
+        """
+        Return the values of a field for the readings from start to end
+        as a list, decoding only that slice.
+        """
+        if field not in self.columns:
+            return [None] * (min(end, self.length) - start)
+
+        column = self.columns[field][start:end]
+        if field in self.dictionaries:
+            column = self.dictionaries[field][column]
+        return column.tolist()
+
+    def iter_row_batches(self, fields=None, batch_size=1000):
+        """
+        Yield lists of at most batch_size readings, each a tuple of the
+        values of the given fields, all fields by default.
+        """
+        fields = self.fields if fields is None else fields
+
+        for start in xrange(0, self.length, batch_size):
+            end = start + batch_size
+            columns = [self.get_values(field, start, end) for field in fields]
+            yield zip(*columns) if columns else [()] * (min(end, self.length) - start)
+
+    def iter_rows(self, fields=None):
+        return chain.from_iterable(self.iter_row_batches(fields))
+
+    def iter_dicts(self):
+        for row in self.iter_rows():
+            yield dict(zip(self.fields, row))
+
+    def to_dicts(self):
+        return list(self.iter_dicts())
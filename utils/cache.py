@@ -0,0 +1,199 @@
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    A thread safe in-process cache holding at most max_size entries,
+    evicting the least recently used, with an optional timeout in seconds.
+    """
+
+    def __init__(self, max_size, timeout=None):
+        self.max_size = max_size
+        self.timeout = timeout
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return default
+
+            value, expires = entry
+            if expires is not None and expires < time.time():
+                return default
+
+            self.entries[key] = entry
+            return value
+
+    def get_many(self, keys):
+        missing = object()
+        values = {}
+        for key in keys:
+            value = self.get(key, missing)
+            if value is not missing:
+                values[key] = value
+        return values
+
+    def set(self, key, value):
+        expires = time.time() + self.timeout if self.timeout else None
+
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (value, expires)
+
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class DiskCache(object):
+    """
+    Bucket file contents cached in a local directory with their ETags,
+    shared by the processes of a worker.  Past max_bytes the least
+    recently used files are evicted.  The size of the directory is
+    tracked as entries are committed and only rescanned once it passes
+    max_bytes or every evict_interval seconds, catching the entries of
+    other processes.
+    """
+    # Every entry starts with its ETag, padded to a fixed length
+    header_length = 128
+
+    def __init__(self, directory, max_bytes, evict_interval=60):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.evict_interval = evict_interval
+        self.total_bytes = None
+        self.evicted = 0
+        self.lock = threading.Lock()
+
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                pass
+
+    def get_path(self, bucket_name, key):
+        name = hashlib.sha1('%s/%s' % (bucket_name, key)).hexdigest()
+        return os.path.join(self.directory, name)
+
+    def get(self, bucket_name, key):
+        """
+        Returns the (etag, content) cached for a bucket key, or None.
+        """
+        path = self.get_path(bucket_name, key)
+
+        try:
+            with open(path, 'rb') as entry:
+                etag = entry.read(self.header_length).rstrip()
+                content = entry.read()
+            os.utime(path, None)
+        except (IOError, OSError):
+            return None
+
+        return etag, content
+
+    def open_entry(self):
+        """
+        Returns a temporary file to write the content of a new entry to,
+        which becomes visible once committed.
+        """
+        entry = tempfile.NamedTemporaryFile(
+            dir=self.directory, prefix='.', delete=False)
+        entry.write(' ' * self.header_length)
+        return entry
+
+    def commit(self, entry, bucket_name, key, etag):
+        if not etag or len(etag) > self.header_length:
+            return self.discard(entry)
+
+        entry.seek(0)
+        entry.write(etag)
+        entry.seek(0, os.SEEK_END)
+        size = entry.tell()
+        entry.close()
+
+        path = self.get_path(bucket_name, key)
+        replaced_size = self.get_size(path)
+        os.rename(entry.name, path)
+
+        with self.lock:
+            if self.total_bytes is not None:
+                self.total_bytes += size - replaced_size
+            due = (
+                self.total_bytes is None or
+                self.total_bytes > self.max_bytes or
+                time.time() - self.evicted > self.evict_interval)
+
+        if due:
+            self.evict()
+
+    def discard(self, entry):
+        entry.close()
+        try:
+            os.remove(entry.name)
+        except OSError:
+            pass
+
+    def set(self, bucket_name, key, etag, content):
+        entry = self.open_entry()
+        entry.write(content)
+        self.commit(entry, bucket_name, key, etag)
+
+    def delete(self, bucket_name, key):
+        path = self.get_path(bucket_name, key)
+        size = self.get_size(path)
+        try:
+            os.remove(path)
+        except OSError:
+            return
+
+        with self.lock:
+            if self.total_bytes is not None:
+                self.total_bytes -= size
+
+    def get_size(self, path):
+        try:
+            return os.path.getsize(path)
+        except OSError:
+            return 0
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.startswith('.'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+
+        total_bytes = sum(size for mtime, size, name in entries)
+        for mtime, size, name in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+            total_bytes -= size
+
+        with self.lock:
+            self.total_bytes = total_bytes
+            self.evicted = time.time()
@@ -1,11 +1,12 @@
 import gzip
 import io
 import StringIO
+import zlib
 
 
-def gzip_compress(content):
+def gzip_compress(content, level=9):
     stringio = StringIO.StringIO()
-    gzip_file = gzip.GzipFile(None, 'wb', 9, stringio)
+    gzip_file = gzip.GzipFile(None, 'wb', level, stringio)
     gzip_file.write(content)
     gzip_file.close()
     return stringio.getvalue()
@@ -18,3 +19,17 @@ def gzip_decompress(content):
         return gzip_file.read()
     except IOError:
         return None
+
+
+class GzipCompressor(object):
+    """Gzip compress content passed in successive chunks"""
+
+    def __init__(self, level=9):
+        # A window size above 16 makes zlib write a gzip header and trailer
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, content):
+        return self.compressor.compress(content)
+
+    def flush(self):
+        return self.compressor.flush()
@@ -0,0 +1,31 @@
+import uuid
+
+from django.db import connections
+
+
+def iter_query_rows(queryset, batch_size):
+    """
+    Yield lists of at most batch_size rows of a values_list queryset.  On
+    PostgreSQL the rows are read from a server side cursor, so the result
+    is never held in memory whole.
+    """
+    connection = connections[queryset.db]
+    sql, params = queryset.query.sql_with_params()
+
+    if connection.vendor == 'postgresql':
+        # A named psycopg2 cursor, which needs the connection open first
+        connection.cursor()
+        cursor = connection.connection.cursor(name='stream_%s' % uuid.uuid4().hex)
+        cursor.itersize = batch_size
+    else:
+        cursor = connection.cursor()
+
+    try:
+        cursor.execute(sql, params)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield rows
+    finally:
+        cursor.close()
@@ -1,19 +1,78 @@
+import os
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
 from django.conf import settings
+from django.core.cache import get_cache
 
 from boto import dynamodb
 from boto.dynamodb.condition import BETWEEN
+from boto.dynamodb.table import Table
+
+from utils.cache import LRUCache
+
+
+# Connections are kept per process and thread, a forked worker opens its
+# own connection instead of sharing the parent's socket.
+_local = threading.local()
+
+# Write pools by size, kept per process like connections so their threads
+# reuse the connections get_conn opens for them
+_pools = {}
+_pools_pid = None
+_pools_lock = threading.Lock()
+
+# DescribeTable responses by table name, they only change on a schema change
+_table_schemas = {}
+
+# Items of closed blocks by (hash_key, range_key), late data and rollups
+# still rewrite them so entries expire and writers delete them
+_item_cache = LRUCache(
+    settings.DYNAMODB_CACHE_SIZE, settings.DYNAMODB_LOCAL_CACHE_TIMEOUT)
+
+# Marks keys known to have no item, so empty cells are cached as well
+_MISSING = 'missing'
 
 
 def get_conn():
-    return dynamodb.connect_to_region(
-        'us-west-2',
-        aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
-        aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY
-    )
+    if getattr(_local, 'pid', None) != os.getpid():
+        _local.pid = os.getpid()
+        _local.conn = dynamodb.connect_to_region(
+            'us-west-2',
+            aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
+            aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY
+        )
+        _local.tables = {}
+    return _local.conn
+
+def get_pool(size):
+    global _pools_pid
+
+    with _pools_lock:
+        if _pools_pid != os.getpid():
+            _pools_pid = os.getpid()
+            _pools.clear()
+        if size not in _pools:
+            _pools[size] = ThreadPool(size)
+        return _pools[size]
+
+def get_table(conn=None, name=None):
+    conn = conn or get_conn()
+    name = name or settings.DYNAMODB_TABLE
+
+    if conn is not getattr(_local, 'conn', None):
+        return conn.get_table(name)
+
+    if name not in _local.tables:
+        if name not in _table_schemas:
+            _table_schemas[name] = conn.describe_table(name)
+        _local.tables[name] = Table(conn, _table_schemas[name])
+
+    return _local.tables[name]
 
 def get_item(hash_key, range_start, range_end):
-    conn = get_conn()
-    table = conn.get_table(settings.DYNAMODB_TABLE)
+    table = get_table()
     return list(table.query(
         hash_key=hash_key,
         range_key_condition=BETWEEN(
@@ -27,7 +86,164 @@ def write_items(conn, table, items):
     batch.add_batch(table, puts=items)
     return conn.batch_write_item(batch)
 
+def write_batch(table, items, retries, backoff):
+    """
+    Write one batch of at most 25 items, resubmitting the items DynamoDB
+    leaves unprocessed with exponential backoff.  Returns the items that
+    were still unprocessed after the last retry.
+    """
+    conn = get_conn()
+    hash_key_name = table.schema.hash_key_name
+    range_key_name = table.schema.range_key_name
+
+    for attempt in range(retries + 1):
+        if attempt:
+            time.sleep(backoff * (2 ** (attempt - 1)))
+
+        response = write_items(conn, table, items)
+        unprocessed = (response.get('UnprocessedItems') or {}).get(table.name, [])
+        if not unprocessed:
+            return []
+
+        unprocessed_keys = set(
+            (request['PutRequest']['Item'][hash_key_name],
+             request['PutRequest']['Item'][range_key_name])
+            for request in unprocessed
+        )
+        items = [
+            item for item in items
+            if (item.hash_key, item.range_key) in unprocessed_keys
+        ]
+
+    return items
+
+def write_all_items(table, items, concurrency=1, retries=0, backoff=0.05):
+    """
+    Write items in batches of 25 across a pool of concurrency threads,
+    each retrying its unprocessed items.  Returns the items that could
+    not be written.
+    """
+    batches = [items[start:start + 25] for start in range(0, len(items), 25)]
+    if not batches:
+        return []
+
+    failed = get_pool(concurrency).map(
+        lambda batch: write_batch(table, batch, retries, backoff), batches)
+
+    return [item for batch in failed for item in batch]
+
 def get_items(conn, table, keys):
     batch = dynamodb.batch.BatchList(conn)
     batch.add_batch(table, keys)
     return conn.batch_get_item(batch)
+
+def get_all_items(conn, table, keys, batch_size=100, retries=None, backoff=None):
+    """
+    Fetch items by (hash_key, range_key) in as few batch requests as
+    possible, resubmitting any keys DynamoDB leaves unprocessed with the
+    exponential backoff of write_batch.  Raises IOError when keys are
+    still unprocessed after the last retry.
+    """
+    if retries is None:
+        retries = settings.DYNAMODB_WRITE_RETRIES
+    if backoff is None:
+        backoff = settings.DYNAMODB_WRITE_BACKOFF
+
+    keys = list(keys)
+
+    for start in range(0, len(keys), batch_size):
+        batch_keys = keys[start:start + batch_size]
+
+        for attempt in range(retries + 1):
+            if attempt:
+                time.sleep(backoff * (2 ** (attempt - 1)))
+
+            response = get_items(conn, table, batch_keys)
+
+            for item in response['Responses'].get(table.name, {}).get('Items', []):
+                yield item
+
+            unprocessed = response.get('UnprocessedKeys') or {}
+            batch_keys = [
+                (key['HashKeyElement'], key['RangeKeyElement'])
+                for key in unprocessed.get(table.name, {}).get('Keys', [])
+            ]
+            if not batch_keys:
+                break
+        else:
+            raise IOError('Unable to fetch %d items from %s' % (len(batch_keys), table.name))
+
+def get_cache_key(table, key):
+    return 'dynamodb:%s:%s:%s' % (table.name, key[0], key[1])
+
+def get_shared_cache():
+    if settings.DYNAMODB_SHARED_CACHE:
+        return get_cache(settings.DYNAMODB_SHARED_CACHE)
+    return None
+
+def delete_cached_items(table, keys):
+    """
+    Drop the items at keys from the in-process and the shared cache,
+    so rewritten items are fetched again.
+    """
+    cache_keys = [get_cache_key(table, key) for key in keys]
+    for cache_key in cache_keys:
+        _item_cache.delete(cache_key)
+
+    shared_cache = get_shared_cache()
+    if shared_cache is not None and cache_keys:
+        shared_cache.delete_many(cache_keys)
+
+def get_cached_items(conn, table, keys, is_cacheable):
+    """
+    Fetch items like get_all_items, reading the keys for which
+    is_cacheable(key) holds through the in-process cache and, when
+    DYNAMODB_SHARED_CACHE names a cache, through that cache as well.
+    """
+    cache_keys = dict(
+        (get_cache_key(table, key), key) for key in keys if is_cacheable(key))
+
+    cached = _item_cache.get_many(cache_keys)
+
+    shared_cache = get_shared_cache()
+    if shared_cache is not None:
+        shared = shared_cache.get_many(
+            [cache_key for cache_key in cache_keys if cache_key not in cached])
+        for cache_key, item in shared.items():
+            _item_cache.set(cache_key, item)
+        cached.update(shared)
+
+    missing_keys = [
+        key for key in keys
+        if get_cache_key(table, key) not in cached
+    ]
+
+    fetched = dict(
+        (get_cache_key(table, (item[table.schema.hash_key_name], item[table.schema.range_key_name])), item)
+        for item in get_all_items(conn, table, missing_keys)
+    )
+
+    cache_items = dict(
+        (cache_key, fetched.get(cache_key, _MISSING))
+        for cache_key in cache_keys
+        if cache_key not in cached
+    )
+    for cache_key, item in cache_items.items():
+        _item_cache.set(cache_key, item)
+
+    if shared_cache is not None:
+        found = dict(
+            (cache_key, item) for cache_key, item in cache_items.items()
+            if item != _MISSING)
+        if found:
+            shared_cache.set_many(found, settings.DYNAMODB_CACHE_TIMEOUT)
+
+        # Missing cells are the ones late data fills in, keep them briefly
+        missing = dict(
+            (cache_key, item) for cache_key, item in cache_items.items()
+            if item == _MISSING)
+        if missing:
+            shared_cache.set_many(missing, settings.DYNAMODB_MISSING_TIMEOUT)
+
+    cached.update(fetched)
+    return [item for item in cached.values() if item != _MISSING]
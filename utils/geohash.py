@@ -19,10 +19,13 @@ License along with Geohash.  If not, see
 """
 from math import log10
 
+import numpy
+
 #  Note: the alphabet in geohash differs from the common base32
 #  alphabet described in IETF's RFC 4648
 #  (http://tools.ietf.org/html/rfc4648)
 __base32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+__base32_array = numpy.array(list(__base32))
 __decodemap = { }
 for i in range(len(__base32)):
     __decodemap[__base32[i]] = i
@@ -108,23 +111,240 @@ def encode(latitude, longitude, precision=12):
     return ''.join(geohash)
 
 
+def __quantize(values, low, high, bits):
+    """
+    Return the index of the cell holding each value when [low, high] is
+    split into 2 ** bits equal cells.  Values on a cell boundary fall in
+    the lower cell, exactly as the bisection in encode() places them.
+    """
+    cells = 1 << bits
+    width = (high - low) / float(cells)
+
+    index = numpy.ceil((values - low) / width).astype(numpy.int64) - 1
+    index = numpy.clip(index, 0, cells - 1)
+
+    # The scaled estimate may be one cell off through rounding, the cell
+    # bounds themselves are exact so compare against them to correct it.
+    lower = low + index * width
+    index -= (values <= lower) & (index > 0)
+    index += (values > lower + width) & (index < cells - 1)
+
+    return index.astype(numpy.uint64)
+
+def __spread_bits(values):
+    """
+    Spread the low 32 bits of each value over the even bits of a 64 bit
+    integer.
+    """
+    values = values & numpy.uint64(0x00000000FFFFFFFF)
+    for shift, mask in ((16, 0x0000FFFF0000FFFF),
+                        (8, 0x00FF00FF00FF00FF),
+                        (4, 0x0F0F0F0F0F0F0F0F),
+                        (2, 0x3333333333333333),
+                        (1, 0x5555555555555555)):
+        values = (values | (values << numpy.uint64(shift))) & numpy.uint64(mask)
+    return values
+
+def __interleave(lat_cells, lon_cells, bits):
+    """
+    Combine latitude and longitude cell indexes into integer geohashes of
+    the given number of bits.
+    """
+    lon_cells = __spread_bits(numpy.asarray(lon_cells).astype(numpy.uint64))
+    lat_cells = __spread_bits(numpy.asarray(lat_cells).astype(numpy.uint64))
+
+    # Geohash bits alternate starting with longitude, so the last bit is
+    # a longitude bit when the bit count is odd.
+    if bits % 2:
+        return lon_cells | (lat_cells << numpy.uint64(1))
+    return (lon_cells << numpy.uint64(1)) | lat_cells
+
+def encode_int_many(latitudes, longitudes, bits=60):
+    """
+    Encode arrays of latitudes and longitudes to integer geohashes of the
+    given number of bits (at most 64), returned as a numpy uint64 array.
+    The bits are those of the base32 geohash, so a geohash of precision p
+    is the integer geohash of 5 * p bits.
+    """
+    lon_bits = (bits + 1) // 2
+    lat_bits = bits // 2
+
+    lon_cells = __quantize(
+        numpy.asarray(longitudes, dtype=numpy.float64), -180.0, 180.0, lon_bits)
+    lat_cells = __quantize(
+        numpy.asarray(latitudes, dtype=numpy.float64), -90.0, 90.0, lat_bits)
+
+    return __interleave(lat_cells, lon_cells, bits)
+
+def encode_int(latitude, longitude, bits=60):
+    """
+    Encode a position to an integer geohash of the given number of bits,
+    for use as a compact index key.
+    """
+    return int(encode_int_many([latitude], [longitude], bits=bits)[0])
+
+def int_to_geohash(values, precision):
+    """
+    Convert an array of integer geohashes of 5 * precision bits to
+    geohash strings.
+    """
+    values = numpy.asarray(values, dtype=numpy.uint64)
+    shifts = numpy.arange(precision - 1, -1, -1).astype(numpy.uint64) * numpy.uint64(5)
+
+    codes = (values[:, numpy.newaxis] >> shifts) & numpy.uint64(31)
+    chars = numpy.ascontiguousarray(__base32_array[codes.astype(numpy.intp)])
+
+    return chars.view('S%d' % precision).ravel().tolist()
+
+def encode_many(latitudes, longitudes, precision=12):
+    """
+    Encode arrays of latitudes and longitudes to a list of geohashes of
+    the given precision, giving the same geohashes as encode().
+    """
+    return int_to_geohash(
+        encode_int_many(latitudes, longitudes, bits=5 * precision), precision)
+
+def prefixes(geohash):
+    """
+    Return the geohashes of every precision up to that of the given
+    geohash, which are its prefixes.
+    """
+    return [geohash[:length] for length in range(1, len(geohash) + 1)]
+
+def encode_prefixes(latitude, longitude, precision=12):
+    """
+    Encode a position to geohashes of every precision from 1 up to the
+    given precision with a single encode.
+    """
+    return prefixes(encode(latitude, longitude, precision=precision))
+
+
+def cell_size(precision):
+    """
+    Return the (height, width) in degrees of a geohash cell.
+    """
+    bits = 5 * precision
+    return 180.0 / (1 << (bits // 2)), 360.0 / (1 << (bits - bits // 2))
+
+def __split_box(min_lat, min_lon, max_lat, max_lon):
+    """
+    Split a bounding box that crosses the antimeridian, given with
+    min_lon east of max_lon, into boxes on either side of it.
+    """
+    if min_lon > max_lon:
+        return [
+            (min_lat, min_lon, max_lat, 180.0),
+            (min_lat, -180.0, max_lat, max_lon),
+        ]
+    return [(min_lat, min_lon, max_lat, max_lon)]
+
+def __box_cells(box, precision):
+    """
+    Return the inclusive ranges of latitude and longitude cell indexes
+    of the given precision covering a box.
+    """
+    min_lat, min_lon, max_lat, max_lon = box
+    bits = 5 * precision
+
+    lat_cells = __quantize(
+        numpy.array([min_lat, max_lat], dtype=numpy.float64), -90.0, 90.0, bits // 2)
+    lon_cells = __quantize(
+        numpy.array([min_lon, max_lon], dtype=numpy.float64), -180.0, 180.0, bits - bits // 2)
+
+    return (
+        (int(lat_cells[0]), int(lat_cells[1])),
+        (int(lon_cells[0]), int(lon_cells[1])),
+    )
+
+def __lattice(lat_range, lon_range):
+    """
+    Enumerate every (latitude, longitude) cell index pair in the given
+    inclusive ranges.
+    """
+    lat_cells, lon_cells = numpy.meshgrid(
+        numpy.arange(lat_range[0], lat_range[1] + 1, dtype=numpy.int64),
+        numpy.arange(lon_range[0], lon_range[1] + 1, dtype=numpy.int64),
+    )
+    return lat_cells.ravel(), lon_cells.ravel()
+
+def bounding_box_size(min_lat, min_lon, max_lat, max_lon, length):
+    """
+    Return the number of geohashes bounding_box_hashes() would return,
+    without enumerating them.
+    """
+    size = 0
+    for box in __split_box(min_lat, min_lon, max_lat, max_lon):
+        lat_range, lon_range = __box_cells(box, length)
+        size += (lat_range[1] - lat_range[0] + 1) * (lon_range[1] - lon_range[0] + 1)
+    return size
+
 def bounding_box_hashes(min_lat, min_lon, max_lat, max_lon, length):
-    top_left = encode(min_lat, min_lon, precision=length)
-    decoded = decode_exactly(top_left)
-    delta = decoded[2]
-
-    hashes = set()
-
-    curr_lat = min_lat
-    curr_lon = min_lon
-    while curr_lat <= max_lat:
-        while curr_lon <= max_lon:
-            hashes.add(encode(curr_lat, curr_lon, precision=length))
-            curr_lon += delta
-        curr_lat += delta
-        curr_lon = min_lon
-
-    return list(hashes)
+    """
+    Return the geohashes of the given length covering a bounding box,
+    enumerated directly from the cell lattice.  A box with min_lon east
+    of max_lon crosses the antimeridian.
+    """
+    hashes = []
+    for box in __split_box(min_lat, min_lon, max_lat, max_lon):
+        lat_cells, lon_cells = __lattice(*__box_cells(box, length))
+        hashes.extend(int_to_geohash(
+            __interleave(lat_cells, lon_cells, 5 * length), length))
+    return hashes
+
+def bounding_box_cover(min_lat, min_lon, max_lat, max_lon, max_length, min_length=1):
+    """
+    Return a cover of a bounding box with geohashes of mixed lengths, the
+    coarsest cells that lie inside the box and cells of max_length along
+    its edges.
+    """
+    cover = []
+
+    for box in __split_box(min_lat, min_lon, max_lat, max_lon):
+        box_min_lat, box_min_lon, box_max_lat, box_max_lon = box
+        lat_cells, lon_cells = __lattice(*__box_cells(box, min_length))
+
+        for length in range(min_length, max_length + 1):
+            bits = 5 * length
+            height, width = cell_size(length)
+
+            if length == max_length:
+                inside = numpy.ones(len(lat_cells), dtype=bool)
+            else:
+                lat_lower = -90.0 + lat_cells * height
+                lon_lower = -180.0 + lon_cells * width
+                inside = (
+                    (lat_lower >= box_min_lat) & (lat_lower + height <= box_max_lat) &
+                    (lon_lower >= box_min_lon) & (lon_lower + width <= box_max_lon)
+                )
+
+            cover.extend(int_to_geohash(
+                __interleave(lat_cells[inside], lon_cells[inside], bits), length))
+
+            if length == max_length:
+                break
+
+            # Split the cells on the edge of the box into the cells of the
+            # next length, keeping those that still overlap the box.
+            lat_factor = 1 << ((bits + 5) // 2 - bits // 2)
+            lon_factor = 32 // lat_factor
+            lat_range, lon_range = __box_cells(box, length + 1)
+
+            edge = ~inside
+            child_lats = numpy.repeat(
+                lat_cells[edge][:, numpy.newaxis] * lat_factor + numpy.arange(lat_factor),
+                lon_factor, axis=1).ravel()
+            child_lons = numpy.tile(
+                lon_cells[edge][:, numpy.newaxis] * lon_factor + numpy.arange(lon_factor),
+                (1, lat_factor)).ravel()
+
+            overlaps = (
+                (child_lats >= lat_range[0]) & (child_lats <= lat_range[1]) &
+                (child_lons >= lon_range[0]) & (child_lons <= lon_range[1])
+            )
+            lat_cells = child_lats[overlaps]
+            lon_cells = child_lons[overlaps]
+
+    return cover
 
 def bounding_box_hash(min_lat, min_lon, max_lat, max_lon):
     center_lat = ((max_lat - min_lat)/2) + min_lat
@@ -0,0 +1,79 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from utils.geohash import bounding_box_cover, bounding_box_hashes, decode_exactly, encode
+
+# (name, min_lat, min_lon, max_lat, max_lon)
+BOUNDING_BOXES = (
+    ('city', 43.58, -79.64, 43.86, -79.11),
+    ('province', 41.68, -95.16, 56.86, -74.34),
+    ('continent', 24.52, -124.77, 49.38, -66.95),
+    ('antimeridian', 50.0, 170.0, 66.0, -168.0),
+)
+
+
+def stepped_bounding_box_hashes(min_lat, min_lon, max_lat, max_lon, length):
+    """The original cover, stepping over the box and encoding every step"""
+    top_left = encode(min_lat, min_lon, precision=length)
+    decoded = decode_exactly(top_left)
+    delta = decoded[2]
+
+    hashes = set()
+
+    curr_lat = min_lat
+    curr_lon = min_lon
+    while curr_lat <= max_lat:
+        while curr_lon <= max_lon:
+            hashes.add(encode(curr_lat, curr_lon, precision=length))
+            curr_lon += delta
+        curr_lat += delta
+        curr_lon = min_lon
+
+    return list(hashes)
+
+
+class Command(BaseCommand):
+    help = 'Compares geohash cover computation against the stepped cover'
+    option_list = BaseCommand.option_list + (
+        make_option('--precision', type='int', default=4,
+            help='Geohash length of the cover'),
+        make_option('--skip-stepped', action='store_true', default=False,
+            help='Only time the lattice covers'),
+    )
+
+    def time_cover(self, cover, *args):
+        start = time.time()
+        hashes = cover(*args)
+        return hashes, time.time() - start
+
+    def handle(self, *args, **options):
+        precision = options['precision']
+
+        for name, min_lat, min_lon, max_lat, max_lon in BOUNDING_BOXES:
+            box = (min_lat, min_lon, max_lat, max_lon)
+
+            hashes, lattice_time = self.time_cover(
+                bounding_box_hashes, *box + (precision,))
+            cover, cover_time = self.time_cover(
+                bounding_box_cover, *box + (precision,))
+
+            print '%s (precision %s)' % (name, precision)
+            print '  lattice: %8d cells %10.4fs' % (len(hashes), lattice_time)
+            print '  mixed:   %8d cells %10.4fs' % (len(cover), cover_time)
+
+            if options['skip_stepped']:
+                continue
+
+            # The stepped cover cannot wrap around the antimeridian
+            if min_lon > max_lon:
+                print '  stepped: unsupported'
+                continue
+
+            stepped, stepped_time = self.time_cover(
+                stepped_bounding_box_hashes, *box + (precision,))
+            missing = len(set(stepped) - set(hashes))
+
+            print '  stepped: %8d cells %10.4fs (%.0fx, %d missing from lattice)' % (
+                len(stepped), stepped_time, stepped_time / max(lattice_time, 1e-6), missing)
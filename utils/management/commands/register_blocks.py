@@ -0,0 +1,53 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from tasks.aggregator import (
+    BLOCK_REGISTRY_KEY, DURATION_TIMES, REDIS, get_block_key, unpack_block_key)
+
+
+class Command(BaseCommand):
+    help = 'Registers block keys written before the block registry so they are processed'
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', default=1000,
+            help='Keys scanned and registered per round trip'),
+        make_option('--dry-run', action='store_true', default=False,
+            help='Only count the blocks that would be registered'),
+    )
+
+    def get_block_end(self, block_key):
+        # Anything else under the block: prefix is not a block
+        try:
+            duration, block = unpack_block_key(block_key)
+            return long(block) + DURATION_TIMES[duration]
+        except (KeyError, ValueError):
+            return None
+
+    def register(self, block_ends, dry_run):
+        if block_ends and not dry_run:
+            pipe = REDIS.pipeline(transaction=False)
+            for block_key, block_end in block_ends.items():
+                pipe.zadd(BLOCK_REGISTRY_KEY, block_end, block_key)
+            pipe.execute()
+
+        return len(block_ends)
+
+    def handle(self, *args, **options):
+        registered = skipped = 0
+        block_ends = {}
+
+        for block_key in REDIS.scan_iter(match=get_block_key('*', '*'), count=options['batch_size']):
+            block_end = self.get_block_end(block_key)
+            if block_end is None:
+                skipped += 1
+                continue
+
+            block_ends[block_key] = block_end
+            if len(block_ends) >= options['batch_size']:
+                registered += self.register(block_ends, options['dry_run'])
+                block_ends = {}
+
+        registered += self.register(block_ends, options['dry_run'])
+
+        self.stdout.write('%s %d blocks, skipped %d other keys' % (
+            'Found' if options['dry_run'] else 'Registered', registered, skipped))
@@ -0,0 +1,83 @@
+import struct
+
+from readings import choices as readings_choices
+
+
+# Every encoded record starts with its format version so that the layout
+# can change without breaking blocks that are already queued in Redis.
+RECORD_VERSION = 1
+RECORD_HEADER = chr(RECORD_VERSION)
+
+# Fixed field order of a version 1 record
+RECORD_FLOAT_FIELDS = (
+    'latitude',
+    'longitude',
+    'altitude',
+    'reading',
+    'reading_accuracy',
+    'location_accuracy',
+)
+RECORD_INTEGER_FIELDS = (
+    'daterecorded',
+    'tzoffset',
+)
+RECORD_STRING_FIELDS = (
+    'user_id',
+    'provider',
+    'observation_type',
+    'observation_unit',
+    'is_charging',
+    'model_type',
+    'version_number',
+    'package_name',
+)
+RECORD_FIELDS = (
+    RECORD_FLOAT_FIELDS + RECORD_INTEGER_FIELDS + ('sharing',) + RECORD_STRING_FIELDS)
+
+SHARING_LABELS = [choice[0] for choice in readings_choices.SHARING_CHOICES]
+
+record_struct = struct.Struct('<c%dd%dqB' % (
+    len(RECORD_FLOAT_FIELDS),
+    len(RECORD_INTEGER_FIELDS),
+))
+length_struct = struct.Struct('<H')
+
+
+def is_record(content):
+    return content[:1] == RECORD_HEADER
+
+
+def encode_string(value):
+    value = (value or u'')
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return length_struct.pack(len(value)) + value
+
+
+def encode_reading(reading):
+    values = [RECORD_HEADER]
+    values.extend(float(reading[field]) for field in RECORD_FLOAT_FIELDS)
+    values.extend(long(reading[field]) for field in RECORD_INTEGER_FIELDS)
+    values.append(SHARING_LABELS.index(reading['sharing']))
+
+    return record_struct.pack(*values) + ''.join(
+        encode_string(reading.get(field)) for field in RECORD_STRING_FIELDS)
+
+
+def decode_reading(content):
+    if not is_record(content):
+        raise ValueError('Unsupported record version %r' % content[:1])
+
+    values = record_struct.unpack_from(content)[1:]
+    offset = record_struct.size
+
+    for field in RECORD_STRING_FIELDS:
+        length = length_struct.unpack_from(content, offset)[0]
+        offset += length_struct.size
+        values += (content[offset:offset + length].decode('utf-8'),)
+        offset += length
+
+    reading = dict(zip(RECORD_FIELDS, values))
+    reading['sharing'] = SHARING_LABELS[reading['sharing']]
+
+    return reading
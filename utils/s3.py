@@ -1,66 +1,156 @@
+import tempfile
 import urlparse
 
 from django.conf import settings
 from django.utils import simplejson as json
 
-from boto.exception import BotoServerError
+from boto.exception import BotoServerError, S3ResponseError
 from boto.s3.connection import S3Connection
 from boto.s3.key import Key
 from storages.backends.s3boto import S3BotoStorage
 
-from utils.compression import gzip_compress, gzip_decompress
+from utils.cache import DiskCache
+from utils.compression import GzipCompressor, gzip_compress, gzip_decompress
 
 
 s3_conn = S3Connection(settings.AWS_ACCESS_KEY_ID, settings.AWS_SECRET_ACCESS_KEY)
 
+# Buckets already validated by this process
+buckets = {}
+
+# Decompressed bucket files kept on local disk, when S3_CACHE_DIR is set
+disk_cache = DiskCache(
+    settings.S3_CACHE_DIR, settings.S3_CACHE_SIZE) if settings.S3_CACHE_DIR else None
+
 
 def get_bucket(bucket_name):
     try:
-        return s3_conn.get_bucket(bucket_name)
+        if bucket_name not in buckets:
+            buckets[bucket_name] = s3_conn.get_bucket(bucket_name)
+        return buckets[bucket_name]
 
     except BotoServerError:
         return None
 
 
 def read_from_bucket(bucket, filename):
+    # A cached copy is revalidated with a conditional GET, which only
+    # transfers the file when it changed.
+    cached = disk_cache.get(bucket.name, filename) if disk_cache else None
+    headers = {'If-None-Match': cached[0]} if cached else {}
+
     try:
-        key = bucket.get_key(filename)
+        key = bucket.new_key(filename)
+        content = key.get_contents_as_string(headers=headers)
+
+        if key.content_encoding == 'gzip':
+            content = gzip_decompress(content)
+
+        if disk_cache and content is not None:
+            disk_cache.set(bucket.name, filename, key.etag, content)
 
-        if key:
-            content = key.get_contents_as_string()
+        return content
 
-            if key.content_encoding == 'gzip':
-                content = gzip_decompress(content)
+    except S3ResponseError, e:
+        if cached and e.status == 304:
+            return cached[1]
 
-            return content
+        if disk_cache and e.status == 404:
+            disk_cache.delete(bucket.name, filename)
+
+        return None
 
     except BotoServerError:
         return None
 
 
-def write_to_bucket(bucket, key, content, content_type='', content_encoding='', compress=False):
+def write_to_bucket(bucket, key, content, content_type='', content_encoding='', compress=False,
+                    cache=False):
     try:
         s3_file = Key(bucket)
         s3_file.key = str(key)
 
+        output_content = content
         if compress:
-            content = gzip_compress(content)
+            output_content = gzip_compress(content, settings.S3_GZIP_LEVEL)
             content_encoding = 'gzip'
 
         s3_file.set_contents_from_string(
-            content,
+            output_content,
             headers={
                 'Content-Type': content_type,
                 'Content-Encoding': content_encoding,
             },
         )
 
+        if disk_cache and cache:
+            disk_cache.set(bucket.name, s3_file.key, s3_file.etag, content)
+
         return s3_file
 
     except BotoServerError:
         return None
 
 
+class BucketWriter(object):
+    """
+    Write content to a bucket key in chunks, optionally gzip compressing
+    it as it arrives.  The output is spooled to disk past S3_SPOOL_SIZE
+    bytes and uploaded when the writer is closed, and kept in the disk
+    cache when cache is set.
+    """
+
+    def __init__(self, bucket, key, content_type='', compress=False, cache=False):
+        self.bucket = bucket
+        self.key = key
+        self.content_type = content_type
+        self.compressor = GzipCompressor(settings.S3_GZIP_LEVEL) if compress else None
+        self.output = tempfile.SpooledTemporaryFile(max_size=settings.S3_SPOOL_SIZE)
+        self.cache_entry = disk_cache.open_entry() if disk_cache and cache else None
+
+    def write(self, content):
+        if isinstance(content, unicode):
+            content = content.encode('utf-8')
+        if self.cache_entry:
+            self.cache_entry.write(content)
+        if self.compressor:
+            content = self.compressor.compress(content)
+        self.output.write(content)
+
+    def close(self):
+        uploaded = None
+
+        try:
+            if self.compressor:
+                self.output.write(self.compressor.flush())
+
+            s3_file = Key(self.bucket)
+            s3_file.key = str(self.key)
+            s3_file.set_contents_from_file(
+                self.output,
+                headers={
+                    'Content-Type': self.content_type,
+                    'Content-Encoding': 'gzip' if self.compressor else '',
+                },
+                rewind=True,
+            )
+
+            uploaded = s3_file
+            return s3_file
+
+        except BotoServerError:
+            return None
+
+        finally:
+            self.output.close()
+
+            if self.cache_entry and uploaded:
+                disk_cache.commit(
+                    self.cache_entry, self.bucket.name, uploaded.key, uploaded.etag)
+            elif self.cache_entry:
+                disk_cache.discard(self.cache_entry)
+
+
 def get_file(file_path):
     bucket = get_bucket(settings.S3_PRIVATE_BUCKET)
     return bucket.get_key(file_path)
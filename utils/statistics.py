@@ -1,4 +1,9 @@
+import hashlib
 import math
+import struct
+from collections import defaultdict
+
+import numpy
 
 def mean(data):
     return sum(data)/float(len(data))
@@ -12,3 +17,334 @@ def variance(data):
 
 def std_dev(data):
     return math.sqrt(mean(variance(data)))
+
+def group_statistics(keys, values, users):
+    """
+    Compute the statistics of values grouped by key in one vectorized
+    pass, matching min, max, mean, median, std_dev, the sample count and
+    the number of distinct users of each group computed one by one.
+    Users may be given as integer codes, which are counted as they are.
+    Returns the sorted group keys and a dict of statistic arrays.
+    """
+    keys = numpy.asarray(keys)
+    values = numpy.asarray(values, dtype=numpy.float64)
+    user_codes = numpy.asarray(users)
+    if user_codes.dtype.kind not in 'iu':
+        user_codes = numpy.unique(user_codes, return_inverse=True)[1]
+
+    if not len(keys):
+        return keys, {}
+
+    order = numpy.lexsort((values, keys))
+    keys = keys[order]
+    values = values[order]
+    user_codes = user_codes[order]
+
+    starts = numpy.flatnonzero(numpy.r_[True, keys[1:] != keys[:-1]])
+    counts = numpy.diff(numpy.r_[starts, len(keys)])
+
+    means = numpy.add.reduceat(values, starts) / counts
+    deviations = values - numpy.repeat(means, counts)
+    std_devs = numpy.sqrt(numpy.add.reduceat(deviations ** 2, starts) / counts)
+
+    # Sorting by user within each group keeps the group boundaries, so
+    # the first reading of each distinct user can be counted per group.
+    user_codes = user_codes[numpy.lexsort((user_codes, keys))]
+    first_users = numpy.r_[
+        True,
+        (keys[1:] != keys[:-1]) | (user_codes[1:] != user_codes[:-1]),
+    ]
+
+    return keys[starts], {
+        'min': numpy.minimum.reduceat(values, starts),
+        'max': numpy.maximum.reduceat(values, starts),
+        'mean': means,
+        'median': values[starts + counts // 2],
+        'std_dev': std_devs,
+        'samples': counts,
+        'users': numpy.add.reduceat(first_users.astype(numpy.int64), starts),
+    }
+
+
+class Summary(object):
+    """
+    Mergeable summary of a stream of readings.  Keeps the count, sum,
+    Welford mean and sum of squared deviations, min and max exactly, a
+    fixed resolution histogram for the median and a HyperLogLog sketch
+    of the distinct users, so summaries of separate batches can be
+    merged instead of recomputing from every raw reading.
+    """
+    version = 1
+    median_resolution = 0.1
+    user_bits = 8
+
+    # Bins past max_bin, far beyond any real reading, share the last bin
+    max_bin = (1 << 62) - 1
+
+    header_struct = struct.Struct('<BQddddd')
+    length_struct = struct.Struct('<I')
+    bin_struct = struct.Struct('<qI')
+    register_struct = struct.Struct('<BB')
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = float('inf')
+        self.max = float('-inf')
+        self.bins = defaultdict(int)
+        self.registers = [0] * (1 << self.user_bits)
+
+    @classmethod
+    def get_bin(cls, values):
+        """
+        Return the median histogram bin of a finite value or array of
+        finite values.
+        """
+        if isinstance(values, numpy.ndarray):
+            return numpy.clip(
+                numpy.floor(values / cls.median_resolution + 0.5),
+                -cls.max_bin, cls.max_bin,
+            ).astype(numpy.int64)
+        return int(max(-cls.max_bin, min(cls.max_bin,
+            math.floor(values / cls.median_resolution + 0.5))))
+
+    @classmethod
+    def hash_user(cls, user):
+        """Return the HyperLogLog register and rank of a user"""
+        if isinstance(user, unicode):
+            user = user.encode('utf-8')
+
+        user_hash = struct.unpack('<Q', hashlib.md5(user).digest()[:8])[0]
+        value_bits = 64 - cls.user_bits
+        index = user_hash >> value_bits
+        rank = value_bits - (user_hash & ((1 << value_bits) - 1)).bit_length() + 1
+
+        return index, rank
+
+    def add_user(self, user):
+        index, rank = self.hash_user(user)
+        self.registers[index] = max(self.registers[index], rank)
+
+    def update(self, value, user=None):
+        # Infinite and NaN readings would poison every statistic
+        if not numpy.isfinite(value):
+            return self
+
+        self.count += 1
+        self.sum += value
+
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        self.bins[self.get_bin(value)] += 1
+
+        if user is not None:
+            self.add_user(user)
+
+        return self
+
+    def update_many(self, values, users=()):
+        values = numpy.asarray(values, dtype=numpy.float64)
+        values = values[numpy.isfinite(values)]
+
+        if len(values):
+            other = Summary()
+            other.count = len(values)
+            other.sum = float(values.sum())
+            other.mean = other.sum / other.count
+            other.m2 = float(((values - other.mean) ** 2).sum())
+            other.min = float(values.min())
+            other.max = float(values.max())
+
+            bins, counts = numpy.unique(
+                self.get_bin(values), return_counts=True)
+            other.bins.update(zip(bins.tolist(), counts.tolist()))
+
+            self.merge(other)
+
+        for user in set(users):
+            self.add_user(user)
+
+        return self
+
+    def merge(self, other):
+        count = self.count + other.count
+        if other.count:
+            delta = other.mean - self.mean
+            self.mean += delta * other.count / count
+            self.m2 += other.m2 + delta ** 2 * self.count * other.count / count
+
+        self.count = count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+        for value_bin, bin_count in other.bins.items():
+            self.bins[value_bin] += bin_count
+
+        self.registers = map(max, self.registers, other.registers)
+
+        return self
+
+    def median(self):
+        # Same rank as median(): the middle value, or the upper middle one
+        position = self.count // 2
+        for value_bin in sorted(self.bins):
+            position -= self.bins[value_bin]
+            if position < 0:
+                return value_bin * self.median_resolution
+
+    def users(self):
+        registers = len(self.registers)
+        zeros = self.registers.count(0)
+
+        estimate = (0.7213 / (1 + 1.079 / registers)) * registers ** 2 / sum(
+            2.0 ** -register for register in self.registers)
+
+        if estimate <= 2.5 * registers and zeros:
+            estimate = registers * math.log(registers / float(zeros))
+
+        return int(round(estimate))
+
+    def finalize(self):
+        if not self.count:
+            return {}
+
+        return {
+            'min': self.min,
+            'max': self.max,
+            'mean': self.mean,
+            'median': self.median(),
+            'std_dev': math.sqrt(self.m2 / self.count),
+            'samples': self.count,
+            'users': self.users(),
+        }
+
+    def serialize(self):
+        registers = [
+            (index, register) for index, register in enumerate(self.registers)
+            if register
+        ]
+
+        return ''.join(
+            [self.header_struct.pack(
+                self.version,
+                self.count,
+                self.sum,
+                self.mean,
+                self.m2,
+                self.min,
+                self.max,
+            ), self.length_struct.pack(len(self.bins))] +
+            [self.bin_struct.pack(*item) for item in sorted(self.bins.items())] +
+            [self.length_struct.pack(len(registers))] +
+            [self.register_struct.pack(*item) for item in registers]
+        )
+
+    @classmethod
+    def deserialize(cls, content):
+        summary = cls()
+
+        (version, summary.count, summary.sum, summary.mean, summary.m2,
+            summary.min, summary.max) = cls.header_struct.unpack_from(content)
+        if version != cls.version:
+            raise ValueError('Unsupported summary version %s' % version)
+        offset = cls.header_struct.size
+
+        for item_struct, add_item in (
+                (cls.bin_struct, summary.bins.__setitem__),
+                (cls.register_struct, summary.registers.__setitem__)):
+            length = cls.length_struct.unpack_from(content, offset)[0]
+            offset += cls.length_struct.size
+
+            for index in range(length):
+                add_item(*item_struct.unpack_from(content, offset))
+                offset += item_struct.size
+
+        return summary
+
+
+def group_summaries(keys, values, users, user_values=None):
+    """
+    Build the Summary of the values and users of each group key in one
+    vectorized pass.  Users are given as codes into user_values when it
+    is given.  Returns the sorted group keys, as group_statistics does,
+    and an iterator of their summaries, built one at a time.
+    """
+    keys = numpy.asarray(keys)
+    values = numpy.asarray(values, dtype=numpy.float64)
+    if user_values is None:
+        user_values, users = numpy.unique(numpy.asarray(users), return_inverse=True)
+
+    # Only the users in the groups are hashed
+    used_codes, user_codes = numpy.unique(numpy.asarray(users), return_inverse=True)
+    unique_users = numpy.asarray(user_values, dtype=object)[used_codes]
+
+    if not len(keys):
+        return keys, iter([])
+
+    group_keys, group_index = numpy.unique(keys, return_inverse=True)
+    groups = len(group_keys)
+
+    counts = numpy.bincount(group_index, minlength=groups)
+    sums = numpy.bincount(group_index, weights=values, minlength=groups)
+    means = sums / counts
+    m2s = numpy.bincount(
+        group_index, weights=(values - means[group_index]) ** 2, minlength=groups)
+
+    order = numpy.lexsort((values, group_index))
+    sorted_groups = group_index[order]
+    starts = numpy.searchsorted(sorted_groups, numpy.arange(groups))
+    mins = values[order][starts]
+    maxes = values[order][numpy.r_[starts[1:], len(order)] - 1]
+
+    # Count the readings in each (group, median bin) pair
+    bins = Summary.get_bin(values[order])
+    first_bins = numpy.flatnonzero(numpy.r_[
+        True,
+        (sorted_groups[1:] != sorted_groups[:-1]) | (bins[1:] != bins[:-1]),
+    ])
+    bin_counts = numpy.diff(numpy.r_[first_bins, len(bins)])
+    bin_starts = numpy.searchsorted(sorted_groups[first_bins], numpy.arange(groups + 1))
+
+    # Hash every distinct user once and fold the ranks into each group's
+    # registers, ranks are at most 57 so a byte holds each register
+    user_hashes = numpy.array(
+        [Summary.hash_user(user) for user in unique_users.tolist()],
+        dtype=numpy.int64,
+    ).reshape(-1, 2)
+    registers = numpy.zeros((groups, 1 << Summary.user_bits), dtype=numpy.uint8)
+    numpy.maximum.at(
+        registers,
+        (group_index, user_hashes[user_codes, 0]),
+        user_hashes[user_codes, 1].astype(numpy.uint8),
+    )
+
+    bin_values = bins[first_bins].tolist()
+    bin_counts = bin_counts.tolist()
+    bin_starts = bin_starts.tolist()
+
+    def iter_summaries():
+        for index, (count, total, mean, m2, minimum, maximum) in enumerate(zip(
+                counts.tolist(), sums.tolist(), means.tolist(), m2s.tolist(),
+                mins.tolist(), maxes.tolist())):
+            summary = Summary()
+            summary.count = count
+            summary.sum = total
+            summary.mean = mean
+            summary.m2 = m2
+            summary.min = minimum
+            summary.max = maximum
+
+            bin_slice = slice(bin_starts[index], bin_starts[index + 1])
+            summary.bins.update(zip(bin_values[bin_slice], bin_counts[bin_slice]))
+            summary.registers = registers[index].tolist()
+
+            yield summary
+
+    return group_keys, iter_summaries()